@@ -1,14 +1,344 @@
 import requests
 import json
+import random
+import re
+import time
+from collections import deque
+from os import environ
+from threading import Lock
+from requests.adapters import HTTPAdapter
+import metrics
 
 base_url = 'https://alttpr.com/en/h/'
 
-seed_url = 'https://alttpr.com/seed'
+# Overridable so a local stand-in can replace alttpr.com
+seed_url = environ.get('ALTTPR_SEED_URL', 'https://alttpr.com/seed')
+
+# Seconds to establish a connection and to wait for the seed response
+CONNECT_TIMEOUT = float(environ.get('ALTTPR_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(environ.get('ALTTPR_READ_TIMEOUT', 30))
+
+# Retries after the first attempt, with full-jitter exponential backoff in seconds
+MAX_RETRIES = int(environ.get('ALTTPR_MAX_RETRIES', 2))
+BACKOFF_BASE = float(environ.get('ALTTPR_BACKOFF_BASE', 0.5))
+BACKOFF_MAX = float(environ.get('ALTTPR_BACKOFF_MAX', 8))
+
+# Consecutive failed calls that open the circuit, and seconds before it is retried
+BREAKER_THRESHOLD = int(environ.get('ALTTPR_BREAKER_THRESHOLD', 5))
+BREAKER_RESET = float(environ.get('ALTTPR_BREAKER_RESET', 30))
+
+# Keep-alive connections kept open to alttpr.com
+POOL_SIZE = int(environ.get('ALTTPR_POOL_SIZE', 10))
+
+# Status codes worth retrying, anything else is a problem with the request itself
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Fields of the seed response that are kept, nested dicts select fields of objects.
+# Everything else, notably the ROM patch, is skipped while streaming without being built.
+SEED_FIELDS = {
+    'hash': True,
+    'generated': True,
+    'spoiler': {'meta': True}
+}
+
+# Size of the decoded text chunks read from the seed response
+STREAM_CHUNK_SIZE = 16 * 1024
+
+WHITESPACE = re.compile(r'\s*')
+STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+SCALAR = re.compile(r'[^,}\]\s]+(?=[,}\]\s])')
+STRUCTURAL = re.compile(r'["\[\]{}]')
+
+
+class UpstreamError(Exception):
+    """Seed generation failed"""
+
+
+class CircuitOpenError(UpstreamError):
+    """alttpr.com is considered down, the call was not attempted"""
+
+
+class CircuitBreaker:
+
+    def __init__(self, threshold: int = BREAKER_THRESHOLD, reset_after: float = BREAKER_RESET) -> None:
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = Lock()
+
+    def before_call(self) -> None:
+        """Raise CircuitOpenError unless a call may go through"""
+        with self.lock:
+            if self.opened_at is None:
+                return
+            # Half open, let a single trial call through once the reset period passed
+            if time.monotonic() - self.opened_at >= self.reset_after and not self.trial_running:
+                self.trial_running = True
+                return
+            raise CircuitOpenError('alttpr.com is unavailable')
+
+    def success(self) -> None:
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+    def accepting(self) -> bool:
+        """Whether a call made now would be attempted, without taking the half-open trial"""
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            return time.monotonic() - self.opened_at >= self.reset_after and not self.trial_running
+
+    @property
+    def state(self) -> str:
+        with self.lock:
+            if self.opened_at is None:
+                return 'closed'
+            if time.monotonic() - self.opened_at >= self.reset_after:
+                return 'half-open'
+            return 'open'
+
+
+class LatencyStats:
+
+    def __init__(self, window: int = 1000) -> None:
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = Lock()
+
+    def record(self, seconds: float, error: bool = False) -> None:
+        with self.lock:
+            self.samples.append(seconds)
+            self.count += 1
+            self.errors += int(error)
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def snapshot(self) -> dict:
+        """Totals since startup and percentiles over the most recent calls"""
+        with self.lock:
+            recent = sorted(self.samples)
+            count, errors, total, maximum = self.count, self.errors, self.total, self.max
+
+        def percentile(p):
+            if not recent:
+                return 0.0
+            return recent[min(len(recent) - 1, int(p * len(recent)))]
+
+        return {
+            'count': count,
+            'errors': errors,
+            'mean': total / count if count else 0.0,
+            'p50': percentile(0.50),
+            'p95': percentile(0.95),
+            'p99': percentile(0.99),
+            'max': maximum
+        }
+
+
+class StreamParser:
+    """Incremental JSON reader that keeps selected fields and skips the rest"""
+
+    def __init__(self, chunks) -> None:
+        self.chunks = iter(chunks)
+        self.buf = ''
+        self.pos = 0
+        self.keep_from = None
+
+    def fill(self) -> bool:
+        """Append the next chunk, dropping text that is no longer needed"""
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            return False
+        cut = self.pos if self.keep_from is None else self.keep_from
+        self.buf = self.buf[cut:] + chunk
+        self.pos -= cut
+        if self.keep_from is not None:
+            self.keep_from -= cut
+        return True
+
+    def match(self, pattern):
+        """Match the pattern at the current position, reading more text as needed"""
+        while True:
+            found = pattern.match(self.buf, self.pos)
+            if found and found.end() < len(self.buf):
+                self.pos = found.end()
+                return found
+            if not self.fill():
+                if found:
+                    self.pos = found.end()
+                    return found
+                raise ValueError('Unexpected end of seed response')
+
+    def peek(self) -> str:
+        self.match(WHITESPACE)
+        # Whitespace is only matched up to the end of the text once every chunk was read
+        if self.pos >= len(self.buf):
+            raise ValueError('Unexpected end of seed response')
+        return self.buf[self.pos]
+
+    def expect(self, char: str) -> None:
+        if self.peek() != char:
+            raise ValueError(f'Expected {char!r} in seed response')
+        self.pos += 1
+
+    def skip_container(self) -> None:
+        """Skip an array or object by tracking bracket depth"""
+        depth = 0
+        while True:
+            found = STRUCTURAL.search(self.buf, self.pos)
+            if not found:
+                # Nothing but numbers and separators left in the buffer
+                self.pos = len(self.buf)
+                if not self.fill():
+                    raise ValueError('Unexpected end of seed response')
+                continue
+            if found.group() == '"':
+                self.pos = found.start()
+                self.match(STRING)
+                continue
+            self.pos = found.end()
+            depth += 1 if found.group() in '[{' else -1
+            if depth == 0:
+                return
+
+    def skip_value(self) -> None:
+        char = self.peek()
+        if char == '"':
+            self.match(STRING)
+        elif char in '[{':
+            self.skip_container()
+        else:
+            self.match(SCALAR)
+
+    def read_value(self):
+        """Parse a single kept value"""
+        self.peek()
+        self.keep_from = self.pos
+        self.skip_value()
+        text = self.buf[self.keep_from:self.pos]
+        self.keep_from = None
+        return json.loads(text)
+
+    def read_object(self, fields: dict) -> dict:
+        """Parse an object keeping only the selected fields"""
+        result = {}
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return result
+        while True:
+            if self.peek() != '"':
+                raise ValueError('Malformed seed response')
+            key = json.loads(self.match(STRING).group())
+            self.expect(':')
+            selected = fields.get(key)
+            if isinstance(selected, dict) and self.peek() == '{':
+                result[key] = self.read_object(selected)
+            elif selected:
+                result[key] = self.read_value()
+            else:
+                self.skip_value()
+            char = self.peek()
+            self.pos += 1
+            if char == '}':
+                return result
+            if char != ',':
+                raise ValueError('Malformed seed response')
+
+
+def parse_seed(chunks, fields: dict = None) -> dict:
+    """Stream-parse a seed response from text chunks, keeping only SEED_FIELDS"""
+    return StreamParser(chunks).read_object(fields or SEED_FIELDS)
+
+
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE))
+session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE))
+
+breaker = CircuitBreaker()
+
+latency = LatencyStats()
+
+
+def backoff(attempt: int) -> float:
+    """Full-jitter exponential backoff delay before the given retry"""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def post_seed(payload: str) -> dict:
+    """Single timed attempt, returns the parsed seed"""
+    start = time.perf_counter()
+    try:
+        with session.post(url=seed_url, data=payload, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+                          headers={'Content-Type': 'application/json'}, stream=True) as response:
+            response.raise_for_status()
+            response.encoding = response.encoding or 'utf-8'
+            seed = parse_seed(response.iter_content(chunk_size=STREAM_CHUNK_SIZE, decode_unicode=True))
+    except Exception:
+        latency.record(time.perf_counter() - start, error=True)
+        raise
+    latency.record(time.perf_counter() - start)
+    return seed
+
 
 def generate_seed(params: dict) -> dict:
+    """Seed for the parameters, the duration is recorded by outcome"""
+    start = time.perf_counter()
+    outcome = 'error'
+    try:
+        seed = request_seed(params)
+        outcome = 'success'
+        return seed
+    except CircuitOpenError:
+        outcome = 'circuit_open'
+        raise
+    finally:
+        metrics.seed_duration.observe(time.perf_counter() - start, outcome)
+
+
+def request_seed(params: dict) -> dict:
+    breaker.before_call()
     payload = json.dumps(params)
-    response = requests.post(url=seed_url, data=payload)
-    return response.json()
+    # Whatever ends the call, the breaker learns its outcome and a half-open trial is over
+    answered = False
+    try:
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                seed = post_seed(payload)
+            except requests.HTTPError as error:
+                if error.response.status_code not in RETRY_STATUSES:
+                    answered = True
+                    raise UpstreamError(f'alttpr.com rejected the seed request: {error}') from error
+                last_error = error
+            except (requests.RequestException, ValueError) as error:
+                # Connection errors, timeouts, dropped streams and unreadable responses
+                last_error = error
+            else:
+                answered = True
+                return seed
+            if attempt < MAX_RETRIES:
+                time.sleep(backoff(attempt))
+        raise UpstreamError(f'Seed generation failed after {MAX_RETRIES + 1} attempts: {last_error}') from last_error
+    finally:
+        if answered:
+            breaker.success()
+        else:
+            breaker.failure()
+
 
 def get_url(seed: str) -> str:
     return f'{base_url}{seed}'
@@ -0,0 +1,202 @@
+"""Read-only JSON API
+
+Rows are selected as plain column tuples and serialized directly, without
+loading ORM objects.
+"""
+import json
+from datetime import datetime
+from hashlib import sha1
+from flask import Blueprint, Response, abort, request, stream_with_context
+from sqlalchemy import func
+from app import db
+from database import Player, Room, RoomPlayer, Settings, Difficulty, Goal, Logic, Mode, Variation, Weapons, ROOM_READY
+import alttpr_api
+import leaderboards
+import queries
+import ratings
+import routing
+
+API_PAGE_SIZE = 30
+API_MAX_PAGE_SIZE = 100
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+# Settings filters and the lookup name column each one matches
+LOOKUP_FILTERS = {
+	'difficulty': Difficulty.name,
+	'goal': Goal.name,
+	'logic': Logic.name,
+	'mode': Mode.name,
+	'variation': Variation.name,
+	'weapons': Weapons.name
+}
+
+FLAG_FILTERS = {
+	'enemizer': Settings.enemizer,
+	'spoilers': Settings.spoilers,
+	'tournament': Settings.tournament
+}
+
+
+def room_rows():
+	"""Room columns joined with settings names, creator and player count"""
+	player_count = db.session.query(func.count(RoomPlayer.player_id)) \
+		.filter(RoomPlayer.room_id == Room.id) \
+		.correlate(Room) \
+		.as_scalar()
+	return db.session.query(
+		Room.id, Room.create_time, Room.hash_code, Room.chat_url, Player.name, player_count,
+		Difficulty.name, Goal.name, Logic.name, Mode.name, Variation.name, Weapons.name,
+		Settings.enemizer, Settings.spoilers, Settings.tournament,
+		Room.expire_time, Room.version
+	) \
+		.join(Settings, Settings.id == Room.settings_id) \
+		.join(Difficulty, Difficulty.id == Settings.difficulty_id) \
+		.join(Goal, Goal.id == Settings.goal_id) \
+		.join(Logic, Logic.id == Settings.logic_id) \
+		.join(Mode, Mode.id == Settings.mode_id) \
+		.join(Variation, Variation.id == Settings.variation_id) \
+		.join(Weapons, Weapons.id == Settings.weapons_id) \
+		.join(Player, Player.id == Room.creator_id) \
+		.filter(Room.status == ROOM_READY, Room.expire_time > datetime.now())
+
+
+def room_json(row) -> dict:
+	(_, create_time, hash_code, chat_url, creator, players, difficulty, goal, logic, mode, variation, weapons,
+		enemizer, spoilers, tournament, expire_time, version) = row
+	return {
+		'hash_code': hash_code,
+		'seed_url': alttpr_api.get_url(hash_code),
+		'chat_url': chat_url,
+		'creator': creator,
+		'players': players,
+		'settings': {
+			'difficulty': difficulty,
+			'goal': goal,
+			'logic': logic,
+			'mode': mode,
+			'variation': variation,
+			'weapons': weapons,
+			'enemizer': bool(enemizer),
+			'spoilers': bool(spoilers),
+			'tournament': bool(tournament)
+		},
+		'created': create_time.isoformat(timespec='seconds'),
+		'expires': expire_time.isoformat(timespec='seconds'),
+		'version': version
+	}
+
+
+def dumps(value) -> str:
+	return json.dumps(value, separators=(',', ':'))
+
+
+def flag(value: str) -> bool:
+	return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def filtered_rooms(args):
+	"""Room rows matching the settings filters of the query string"""
+	query = room_rows()
+	for name, column in LOOKUP_FILTERS.items():
+		if args.get(name):
+			query = query.filter(column == args[name])
+	for name, column in FLAG_FILTERS.items():
+		if args.get(name):
+			query = query.filter(column == flag(args[name]))
+	return query
+
+
+def json_response(body: str) -> Response:
+	"""JSON response answering a matching If-None-Match with 304"""
+	response = Response(body, mimetype='application/json')
+	response.set_etag(sha1(body.encode()).hexdigest())
+	response.cache_control.no_cache = True
+	return response.make_conditional(request)
+
+
+@api.errorhandler(400)
+@api.errorhandler(404)
+def error(exception):
+	return Response(dumps({'error': exception.name}), status=exception.code, mimetype='application/json')
+
+
+def page_size() -> int:
+	try:
+		return max(1, min(int(request.args.get('limit', API_PAGE_SIZE)), API_MAX_PAGE_SIZE))
+	except ValueError:
+		return abort(400)
+
+
+@api.route('/rooms')
+@routing.replica_reads
+def rooms():
+	limit = page_size()
+
+	query = queries.after_cursor(filtered_rooms(request.args), request.args.get('before')) \
+		.order_by(Room.create_time.desc(), Room.id.desc())
+
+	# Every matching room, one JSON document per line, without building the whole result
+	if request.args.get('format') == 'ndjson':
+		rows = query.yield_per(500)
+		lines = stream_with_context(dumps(room_json(row)) + '\n' for row in rows)
+		return Response(lines, mimetype='application/x-ndjson')
+
+	rows = query.limit(limit + 1).all()
+	page = rows[:limit]
+	next_cursor = queries.encode_cursor(page[-1]) if len(rows) > len(page) else None
+	return json_response(dumps({'rooms': [room_json(row) for row in page], 'next': next_cursor}))
+
+
+@api.route('/rooms/<hash_code>')
+@routing.replica_reads
+def room(hash_code):
+	row = room_rows().filter(Room.hash_code == hash_code).first()
+	# A lagging replica may not have the room yet
+	if not row and routing.use_primary():
+		row = room_rows().filter(Room.hash_code == hash_code).first()
+	if not row:
+		abort(404)
+	return json_response(dumps(room_json(row)))
+
+
+@api.route('/rooms/<hash_code>/times')
+@routing.replica_reads
+def times(hash_code):
+	room_id = db.session.query(Room.id).filter(Room.hash_code == hash_code).scalar()
+	if room_id is None and routing.use_primary():
+		room_id = db.session.query(Room.id).filter(Room.hash_code == hash_code).scalar()
+	if room_id is None:
+		abort(404)
+	rows = db.session.query(Player.name, RoomPlayer.time) \
+		.join(Player, Player.id == RoomPlayer.player_id) \
+		.filter(RoomPlayer.room_id == room_id) \
+		.order_by(RoomPlayer.time.is_(None), RoomPlayer.time, RoomPlayer.player_id) \
+		.all()
+	return json_response(dumps({'times': [{'player': name, 'time': time} for name, time in rows]}))
+
+
+@api.route('/leaderboards')
+@routing.replica_reads
+def leaderboard():
+	"""Fastest players of a logic, goal and mode category, of all time or of a week"""
+	names = [request.args.get(name) for name in ('logic', 'goal', 'mode')]
+	if not all(names):
+		abort(400)
+	category = ratings.category_name(*names)
+	period = request.args.get('period', leaderboards.PERIOD_ALL)
+	if period == 'week':
+		period = leaderboards.current_week()
+	standings = leaderboards.top(category, period, page_size())
+	return json_response(dumps({
+		'category': category,
+		'period': period,
+		'median_time': leaderboards.median_time(category, period),
+		'standings': [{
+			'player': standing.name,
+			'best_time': standing.best_time,
+			'mean_time': standing.mean_time,
+			'median_time': standing.median_time,
+			'races': standing.races
+		} for standing in standings]
+	}))
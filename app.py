@@ -1,16 +1,17 @@
 """Main Flask App"""
 from os import environ, path
 from uuid import uuid4
-from flask import Flask, redirect, abort, session, render_template, make_response, request
+from hashlib import sha1
+from hmac import compare_digest
+from threading import Lock
+from flask import Flask, Response, redirect, abort, session, render_template, make_response, request, jsonify, g
 from flask_recaptcha import ReCaptcha
 from flask_sslify import SSLify
-from flask_sqlalchemy import SQLAlchemy
 from flask_debugtoolbar import DebugToolbarExtension
 import validation
-import alttpr_api
-import chat
-
-# TODO Add way to clean up expired database entries
+import metrics
+import matchmaking
+import routing
 
 app = Flask(__name__)
 
@@ -47,6 +48,12 @@ app.config.update({
 	#"SQLALCHEMY_ECHO": True
 })
 
+# Connections kept open per worker to the primary, and opened beyond them at peak
+if environ.get('DATABASE_POOL_SIZE'):
+	app.config['SQLALCHEMY_POOL_SIZE'] = int(environ.get('DATABASE_POOL_SIZE'))
+if environ.get('DATABASE_MAX_OVERFLOW'):
+	app.config['SQLALCHEMY_MAX_OVERFLOW'] = int(environ.get('DATABASE_MAX_OVERFLOW'))
+
 
 # App secret key for sessions
 # Stored in file called secret_key
@@ -54,20 +61,42 @@ app.secret_key = environ.get('APP_SECRET_KEY')
 
 toolbar = DebugToolbarExtension(app)
 
-# Connect SQLAlchemy to app
-db = SQLAlchemy(app)
-
-from database import Player, Room, RoomPlayer, Settings, Difficulty, Logic, Goal, Mode, Variation, Weapons, init_db_values
+# Connect SQLAlchemy to app, read-only views read from the replicas
+db = routing.RoutingSQLAlchemy(app)
+
+metrics.install(app)
+
+from database import Player, Room, RoomPlayer, QueueTicket, QueueEntry
+from database import ROOM_PENDING, ROOM_READY
+import queries
+import identity
+import events
+import fragments
+from api import api
+import seed_jobs
+import ratings
+import leaderboards
+import reaper
+import seed_pool
+import interning
+import catalog
+import alttpr_api
+import chat
+import ratelimit
+import assets
+import compression
+import startup
 
-init_db_values()
+app.register_blueprint(api)
 
 
 # Protect against CSRF attacks
+# The token lasts as long as the session, so the forms of every open tab stay valid
 @app.before_request
 def csrf_protect():
 	if request.method == "POST":
-		token = session.pop('_csrf_token', None)
-		if not token or token != request.form.get('_csrf_token'):
+		token = session.get('_csrf_token')
+		if not token or not compare_digest(token.encode(), request.form.get('_csrf_token', '').encode()):
 			abort(403)
 
 
@@ -77,134 +106,314 @@ def generate_csrf_token():
 	return session['_csrf_token']
 
 
+def render_csrf_token():
+	# A page carrying the token is sent uncompressed, see compression.py
+	g.csrf_token_rendered = True
+	return generate_csrf_token()
+
+
 # Enable the use of csrf tokens in jinja templates
-app.jinja_env.globals['csrf_token'] = generate_csrf_token  # pylint: disable=no-member
+app.jinja_env.globals['csrf_token'] = render_csrf_token  # pylint: disable=no-member
 
 # Global var to handle recaptcha
 recaptcha = ReCaptcha(app=app)
 
-settings_values = {
-	"difficulty": Difficulty.query.all(),
-	"goal": Goal.query.all(),
-	"logic": Logic.query.all(),
-	"mode": Mode.query.all(),
-	"variation": Variation.query.all(),
-	"weapons": Weapons.query.all()
-}
+# Players waiting for a match, built for the current catalog
+match_queue = None
+match_queue_catalog = None
+match_queue_lock = Lock()
+
+# Seconds matched players are sent to their room once it is opened
+MATCHED_ROOM_TTL = 600
 
 
+def get_match_queue() -> matchmaking.DatabaseQueue:
+	global match_queue, match_queue_catalog  # pylint: disable=global-statement
+	current = catalog.get()
+	if match_queue_catalog is not current:
+		with match_queue_lock:
+			if match_queue_catalog is not current:
+				# The tickets are in the database, a queue for the reloaded catalog picks them up
+				match_queue = matchmaking.DatabaseQueue(current.names(), db, QueueTicket.__table__, QueueEntry.__table__,
+					expire_after=MATCHED_ROOM_TTL)
+				match_queue_catalog = current
+	return match_queue
+
 
 # Main page
 @app.route('/')
+@routing.replica_reads
 def index():
 	return render_template('index.html')
 
 
 # Rooms listing
 @app.route('/rooms')
+@routing.replica_reads
 def rooms():
-	rooms = Room.query.order_by(Room.create_time.desc()).all()
-	return render_template('rooms.html', rooms=rooms)
+	body, next_cursor = fragments.render_rooms_page(request.args.get('before'))
+	return render_template('rooms.html', body=body, next_cursor=next_cursor)
+
+
+def open_room(settings: catalog.Selection, player_ids: list) -> (str, str):
+	"""Create a room for the players, the first one being its creator. Returns the url to send them to or an error"""
+	params = settings.to_dict()
+	settings_id = interning.settings_id(settings.key())
+
+	# Popular settings are served from the pool of pre-generated seeds
+	seed = seed_pool.pool.take(params)
+	if seed:
+		hash_code = seed['hash']
+		room = Room(settings_id=settings_id, chat_url=chat.get_chat_room(hash_code), creator_id=player_ids[0], hash_code=hash_code)
+		room.members.extend(RoomPlayer(player_id=player_id) for player_id in player_ids[1:])
+		db.session.add(room)
+		db.session.commit()
+		return f'/room/{room.hash_code}', None
+
+	# Fail fast instead of queueing rooms that cannot get a seed, also while a half-open trial decides
+	if not alttpr_api.breaker.accepting():
+		return None, 'alttpr.com is currently unavailable, please try again later.'
+
+	# Create a pending game room, the seed is generated in the background
+	room = Room(settings_id=settings_id, chat_url=None, creator_id=player_ids[0], hash_code=None, status=ROOM_PENDING)
+	room.members.extend(RoomPlayer(player_id=player_id) for player_id in player_ids[1:])
+
+	db.session.add(room)
+
+	db.session.commit()
+
+	if not seed_jobs.submit(room, params):
+		db.session.delete(room)
+		db.session.commit()
+		return None, 'Too many rooms are being created, please try again.'
+
+	# The page waiting on the seed
+	return f'/pending/{room.id}', None
 
 
 # Room creation form
 @app.route('/create', methods=['GET', 'POST'])
+@ratelimit.limited('create', player='5/300', ip='20/300')
 def create():
-	# Get player id stored in a cookie
-	player_id = request.cookies.get('uuid')
-	# List of all players on the website
-	player = Player.query.filter_by(uuid=player_id).first()
+	player = identity.current_player()
 
 	# If user doesnt have a name and id assigned, redirect them to create one
-	if not player_id or not player:
+	if not player:
 		return redirect('/name/create')
 
 	if request.method == 'POST':
 
 		# User has not accepted the use of cookies
 		if not request.cookies.get('cookies'):
-			return render_template('create.html', settings=settings_values, error='You must accept the use of cookies before proceeding.')
+			return render_template('create.html', settings=catalog.get().options, error='You must accept the use of cookies before proceeding.')
 
 		# Validate recaptcha
 		if not recaptcha.verify():
-			return render_template('create.html', settings=settings_values, error='ReCaptcha failed.')
-
-		difficulty = Difficulty.query.filter_by(name=request.form.get('difficulty')).first()
-		goal = Goal.query.filter_by(name=request.form.get('goal')).first()
-		logic = Logic.query.filter_by(name=request.form.get('logic')).first()
-		mode = Mode.query.filter_by(name=request.form.get('mode')).first()
-		variation = Variation.query.filter_by(name=request.form.get('variation')).first()
-		weapons = Weapons.query.filter_by(name=request.form.get('weapons')).first()
-	
-		settings = Settings(difficulty, bool(request.form.get('enemizer')), goal, logic, mode, bool(
-			request.form.get('spoilers')), bool(request.form.get('tournament')), variation, weapons)
+			return render_template('create.html', settings=catalog.get().options, error='ReCaptcha failed.')
+
+		settings = catalog.get().resolve(request.form)
 
 		settings_validate, settings_error = validation.validate_settings(settings)
 
 		# Make certain that all selected settings exist
 		if not settings_validate:
-			return render_template('create.html', settings=settings, error=settings_error)
+			return render_template('create.html', settings=catalog.get().options, error=settings_error)
 
-		seed = alttpr_api.generate_seed(settings.to_dict())
+		url, error = open_room(settings, [player.id])
+		if error:
+			return render_template('create.html', settings=catalog.get().options, error=error)
 
-		hash_code = seed['hash']
+		return make_response(redirect(url))
+	else:
+		return render_template('create.html', settings=catalog.get().options, error=None)
 
-		chat_url = chat.get_chat_room(hash_code)
 
-		# Create a game room
-		room =  Room(settings=settings, chat_url=chat_url, creator=player, hash_code=hash_code)
+def start_matches(matches: list):
+	"""Open a room for every match and record where its players go"""
+	for match in matches:
+		url, error = open_room(catalog.get().resolve(match.settings), match.player_ids)
+		get_match_queue().matched(match.player_ids, url, error)
 
-		#db.session.add(settings)
-		db.session.add(room)
 
-		db.session.commit()
+def queue_preferences(form) -> dict:
+	"""Accepted values of each settings field from the queue form, flags are submitted as on and off"""
+	accepted = {field: form.getlist(field) for field in catalog.LOOKUPS}
+	for flag in catalog.FLAGS:
+		accepted[flag] = [value == 'on' for value in form.getlist(flag)]
+	return accepted
 
-		# generate response that redirects to the game room just created
-		response = make_response(redirect(f'/room/{room.hash_code}'))
 
-		return response
-	else:
-		return render_template('create.html', settings=settings_values, error=None)
+# Matchmaking queue
+@app.route('/queue', methods=['GET', 'POST'])
+@ratelimit.limited('queue', player='10/300', ip='30/300')
+def queue():
+	player = identity.current_player()
+
+	if not player:
+		return redirect('/name/queue')
+
+	if request.method == 'POST':
+
+		# User has not accepted the use of cookies
+		if not request.cookies.get('cookies'):
+			return render_template('queue.html', settings=catalog.get().options, ticket=None, error='You must accept the use of cookies before proceeding.')
+
+		preferences = queue_preferences(request.form)
+		try:
+			matches = get_match_queue().enqueue(player.id, preferences)
+		except ValueError as error:
+			return render_template('queue.html', settings=catalog.get().options, ticket=None, error=str(error))
+		# Kept to queue the player again should their ticket be lost
+		session['queue'] = preferences
+		start_matches(matches)
+		return redirect('/queue')
+
+	ticket = get_match_queue().waiting(player.id)
+	if ticket and (ticket.url or ticket.error):
+		resolve_match(player)
+		if ticket.url:
+			return redirect(ticket.url)
+		return render_template('queue.html', settings=catalog.get().options, ticket=None, error=ticket.error)
+	return render_template('queue.html', settings=catalog.get().options, ticket=ticket, error=None)
+
+
+def resolve_match(player):
+	"""The player was sent to their match, or told why it failed, and can queue again"""
+	session.pop('queue', None)
+	get_match_queue().consume(player.id)
+
+
+# Match state polled by the queue page, also relaxes the tickets that waited long enough
+@app.route('/queue/status')
+def queue_status():
+	player = identity.current_player()
+	if not player:
+		abort(404)
+	start_matches(get_match_queue().widen())
+	ticket = get_match_queue().waiting(player.id)
+	if not ticket and session.get('queue'):
+		# The player never left the queue, put them back rather than sending them to the form
+		try:
+			start_matches(get_match_queue().enqueue(player.id, session['queue']))
+		except ValueError:
+			session.pop('queue')
+		ticket = get_match_queue().waiting(player.id)
+	if not ticket:
+		return jsonify(status='idle')
+	if ticket.url or ticket.error:
+		resolve_match(player)
+		return jsonify(status='matched' if ticket.url else 'failed', url=ticket.url, error=ticket.error)
+	# A matched ticket without a room yet is still opening its room
+	return jsonify(status='waiting', waited=int(get_match_queue().clock() - ticket.enqueued_at), widened=ticket.widened, waiting=len(get_match_queue()))
+
+
+@app.route('/queue/leave', methods=['POST'])
+def queue_leave():
+	player = identity.current_player()
+	session.pop('queue', None)
+	if player:
+		get_match_queue().cancel(player.id)
+	return redirect('/queue')
+
+
+# Page shown while the seed of a new room is being generated
+@app.route('/pending/<int:room_key>')
+def pending(room_key):
+	room = Room.query.get(room_key)
+	if not room:
+		return render_template('room.html', error='Room does not exist.')
+	if room.status == ROOM_READY:
+		return redirect(f'/room/{room.hash_code}')
+	return render_template('pending.html', room=room)
+
+
+# Seed generation status polled by the pending page
+@app.route('/pending/<int:room_key>/status')
+def pending_status(room_key):
+	room = Room.query.get(room_key)
+	if not room:
+		abort(404)
+	return jsonify(status=room.status, hash_code=room.hash_code)
+
+
+def room_etag(room, player) -> str:
+	"""Validator of a rendered room page, which also depends on the viewer and their csrf token"""
+	key = f'{room.id}:{room.version}:{player.id}:{player.name}:{generate_csrf_token()}'
+	return sha1(key.encode()).hexdigest()
 
 
 @app.route('/room/<room_id>')
+@routing.replica_reads
 def room(room_id):
-	# List of all game rooms
-	rooms = Room.query.all()
 	# Get current game room based on url paramater room_id
-	room = Room.query.filter_by(hash_code=room_id).first()
-	# Get the players id stored in the cookie
-	player_id = request.cookies.get('uuid')
-	player = Player.query.filter_by(uuid=player_id).first()
+	room = queries.load_room(room_id)
+	# A lagging replica may not have the room yet
+	if not room and routing.use_primary():
+		room = queries.load_room(room_id)
+	player = identity.current_player()
 
 	# Validate that the room exists
 	if not room:
 		return render_template('room.html', error='Room does not exist.')
 
 	# Validate that the player exists
-	elif not player_id or not player:
+	elif not player:
 		return redirect(f'/name/room/{room_id}')
 
 	# Join the room
 	else:
-		if not player in room.players:
-			room.players.append(player)
+		# A replica may not have the player's join yet, decide and write on the primary
+		if not any(member.player_id == player.id for member in room.members) and routing.use_primary():
+			db.session.expunge_all()
+			room = queries.load_room(room_id)
+			if not room:
+				return render_template('room.html', error='Room does not exist.')
+		if not any(member.player_id == player.id for member in room.members):
+			db.session.add(RoomPlayer(room_id=room.id, player_id=player.id))
+			room.touch()
+			events.publish(room, 'join')
 			db.session.commit()
-		room_times = RoomPlayer.query.join(Room).filter(Room.hash_code==room_id).all()
-		return render_template('room.html', player=player, room=room, room_times=room_times, error=None)
+			db.session.expunge_all()
+			room = queries.load_room(room_id)
+
+		# Repeat refreshes of an unchanged room are answered without rendering
+		etag = room_etag(room, player)
+		if request.if_none_match.contains_weak(etag):
+			response = make_response('', 304)
+		else:
+			response = make_response(render_template('room.html', player=player, room=room, room_times=room.members, error=None))
+		response.set_etag(etag)
+		response.last_modified = room.get_update_time()
+		response.cache_control.private = True
+		response.cache_control.no_cache = True
+		return response
+
+
+# Live updates of a room's players and times
+@app.route('/room/<room_id>/events')
+def room_events(room_id):
+	if not db.session.query(Room.id).filter_by(hash_code=room_id).first():
+		abort(404)
+	# Do not hold a database connection for the lifetime of the stream
+	db.session.remove()
+	# Every open stream holds a thread of this worker, past the limit the page polls
+	if not events.open_stream():
+		return events.busy()
+	response = Response(events.stream(room_id), mimetype='text/event-stream',
+		headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+	response.call_on_close(events.close_stream)
+	return response
 
 
 @app.route('/leave/<room_id>')
 def leave(room_id: str):
 	# Get room the user desires to leave
 	room = Room.query.filter_by(hash_code=room_id).first()
-	# Get the players id from the cookie
-	player_id = request.cookies.get('uuid')
-	# Get player data
-	player = Player.query.filter_by(uuid=player_id).first()
+	player = identity.current_player()
 	# validate that room and player exists and that the player is in the room
-	if room and player and player in room.players:
-		room.players.remove(player)
+	if room and player and RoomPlayer.query.filter_by(room_id=room.id, player_id=player.id).delete():
+		room.touch()
+		events.publish(room, 'leave')
 		db.session.commit()
 	return redirect('/rooms')
 
@@ -212,39 +421,41 @@ def leave(room_id: str):
 @app.route('/remove/<room_id>')
 def remove(room_id):
 	room = Room.query.filter_by(hash_code=room_id).first()
-	player_id = request.cookies.get('uuid')
-	player = Player.query.filter_by(uuid=player_id).first()
+	player = identity.current_player()
 
-	if player_id and player and room and room.creator == player:
+	if player and room and room.creator_id == player.id:
 		db.session.delete(room)
+		events.publish(room, 'removed')
 		db.session.commit()
 	
 	return redirect('/rooms')
 
 
 @app.route('/time/<room_id>', methods=['POST'])
+@ratelimit.limited('time', player='20/60', ip='60/60')
 def time(room_id):
 	room = Room.query.filter_by(hash_code=room_id).first()
-	player_id = request.cookies.get('uuid')
-	player = Player.query.filter_by(uuid=player_id).first()
+	player = identity.current_player()
+	room_player = RoomPlayer.query.get((room.id, player.id)) if room and player else None
 
-	if player_id and player and room and player in room.players:
+	if room_player:
 		hours = request.form.get('hours')
 		minutes = request.form.get('minutes')
 		seconds = request.form.get('seconds')
 
-		time_validation, time_error = validation.validate_time(hours, minutes, seconds)
+		time_valid, _ = validation.validate_time(hours, minutes, seconds)
 
-		if not validation:
+		if not time_valid:
 			return redirect(f'/room/{room_id}')
 
 		time = int(seconds) + (int(minutes) * 60) + (int(hours) * 60  * 60)
 
-		room_player = RoomPlayer.query.filter(RoomPlayer.room==room, RoomPlayer.player==player).first()
-
 		room_player.time = time
+		leaderboards.record_time(room, player.id, time)
+		ratings.record_result(room, player.id, time)
+		room.touch()
+		events.publish(room, 'time')
 
-		#db.session.add(room_player)
 		db.session.commit()
 	return redirect(f'/room/{room_id}')
 
@@ -261,6 +472,7 @@ def cookie_accept():
 # Page to set your name
 @app.route('/name', methods=['GET', 'POST'])
 @app.route('/name/<path:redir>', methods=['GET', 'POST'])
+@ratelimit.limited('name', player='5/300', ip='10/300')
 def name(redir=None):
 	if request.method == 'POST':
 		# Redirect to previous page after setting name
@@ -286,19 +498,25 @@ def name(redir=None):
 		if not name_validation:
 			return render_template('name.html', error=name_error, redir=redir)
 
-		player_id = request.cookies.get('uuid')
-		player = Player.query.filter_by(uuid=player_id).first()
+		current = identity.current_player()
 
 		# If player already exists, just change the name
-		if player_id and player:
+		if current:
+			player = Player.query.get(current.id)
+			# Cached cards and room pages showing the old name become stale
+			if player.name != name:
+				queries.touch_player_rooms(player.id)
 			player.name = name
 		else:
 			player: Player = Player(name)
 			db.session.add(player)
-			response.set_cookie('uuid', player.uuid)
 
 		db.session.commit()
 
+		# Refresh the cached record and hand out a cookie carrying the new name
+		g.player = identity.remember(player)
+		identity.set_cookie(response, player)
+
 		return response
 
 	else:
@@ -0,0 +1,110 @@
+"""Fingerprinted static assets
+
+Files under static/ are also served from /assets/ under a name carrying a
+hash of their content, so responses can be cached for good: a changed file
+gets a new name. Each process hashes the files and compresses them with
+gzip, and with brotli when the package is installed, once on first use.
+Every request gets the smallest variant the client accepts without any
+compression work. Templates link to assets with asset_url().
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+from collections import namedtuple
+from os import environ
+from threading import Lock
+from flask import Response, abort, request, url_for
+from app import app
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+# Files smaller than this are served as they are
+ASSET_COMPRESS_MIN_SIZE = int(environ.get('ASSET_COMPRESS_MIN_SIZE', 256))
+
+ASSET_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Content of one file under each encoding, 'identity' being the file itself
+Asset = namedtuple('Asset', ['mimetype', 'digest', 'variants'])
+
+# Fingerprinted name of each file and the asset served under each fingerprinted name
+Bundle = namedtuple('Bundle', ['names', 'assets'])
+
+
+def fingerprint(name: str, digest: str) -> str:
+	root, extension = os.path.splitext(name)
+	return f'{root}.{digest}{extension}'
+
+
+def compress(data: bytes) -> dict:
+	"""Variants of the content by encoding, only those smaller than the content itself"""
+	variants = {'identity': data}
+	if len(data) < ASSET_COMPRESS_MIN_SIZE:
+		return variants
+	candidates = {'gzip': gzip.compress(data, 9)}
+	if brotli:
+		candidates['br'] = brotli.compress(data, quality=11)
+	variants.update((encoding, variant) for encoding, variant in candidates.items() if len(variant) < len(data))
+	return variants
+
+
+def build(folder: str) -> Bundle:
+	names, assets = {}, {}
+	for root, _, files in os.walk(folder):
+		for file_name in files:
+			file_path = os.path.join(root, file_name)
+			name = os.path.relpath(file_path, folder).replace(os.sep, '/')
+			with open(file_path, 'rb') as asset_file:
+				data = asset_file.read()
+			digest = hashlib.sha256(data).hexdigest()[:12]
+			names[name] = fingerprint(name, digest)
+			assets[names[name]] = Asset(mimetypes.guess_type(name)[0] or 'application/octet-stream', digest, compress(data))
+	return Bundle(names, assets)
+
+
+current = None
+lock = Lock()
+
+
+def get() -> Bundle:
+	"""Assets of this process, built on first use"""
+	global current  # pylint: disable=global-statement
+	if current is None:
+		with lock:
+			if current is None:
+				current = build(app.static_folder)
+	return current
+
+
+def asset_url(name: str) -> str:
+	"""Url of a static file under its fingerprinted name, or its plain url when it is not known"""
+	fingerprinted = get().names.get(name)
+	if not fingerprinted:
+		return url_for('static', filename=name)
+	return url_for('asset', filename=fingerprinted)
+
+
+app.jinja_env.globals['asset_url'] = asset_url  # pylint: disable=no-member
+
+
+def preferred_encoding(variants: dict) -> str:
+	accepted = [encoding for encoding in variants if encoding == 'identity' or request.accept_encodings[encoding] > 0]
+	return min(accepted, key=lambda encoding: len(variants[encoding]))
+
+
+@app.route('/assets/<path:filename>')
+def asset(filename):
+	found = get().assets.get(filename)
+	if not found:
+		abort(404)
+	encoding = preferred_encoding(found.variants)
+	response = Response(found.variants[encoding], mimetype=found.mimetype)
+	if encoding != 'identity':
+		response.content_encoding = encoding
+	response.vary.add('Accept-Encoding')
+	response.set_etag(f'{found.digest}-{encoding}')
+	response.headers['Cache-Control'] = ASSET_CACHE_CONTROL
+	return response.make_conditional(request)
@@ -0,0 +1 @@
+"""Benchmarks and checks, run each one with python -m bench.<name> from the repository root"""
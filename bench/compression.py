@@ -0,0 +1,113 @@
+"""Bytes on the wire and CPU time per request, with and without compression
+
+Fills a temporary database with synthetic rooms and requests static files
+from /static/ and from their fingerprinted /assets/ urls, and dynamic pages
+and API responses, under several Accept-Encoding headers. Also totals a
+first and a repeat page load, where the repeat load finds the fingerprinted
+assets in the browser cache. Prints a JSON report.
+
+Usage: python -m bench.compression [--requests 200] [--rooms 2000] [--output FILE]
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from datetime import datetime
+from bench.http_load import git_commit
+
+ENCODINGS = {
+	'identity': 'identity',
+	'gzip': 'gzip',
+	'br': 'br, gzip'
+}
+
+DYNAMIC_ROUTES = ('/', '/rooms', '/api/v1/rooms', '/api/v1/rooms?format=ndjson')
+
+ASSET_LINK = re.compile(r'(?:href|src)="(/(?:assets|static)/[^"]+)"')
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--requests', type=int, default=200, help='Requests per route and encoding.')
+	parser.add_argument('--rooms', type=int, default=2000)
+	parser.add_argument('--output', help='Write the report to this file instead of stdout.')
+	parser.add_argument('--random-seed', type=int, default=0)
+	return parser.parse_args()
+
+
+def measure(client, url: str, accept_encoding: str, count: int) -> dict:
+	"""Mean bytes, CPU and wall milliseconds of a request, the encoding the response used"""
+	cpu_start, wall_start = time.process_time(), time.perf_counter()
+	for _ in range(count):
+		response = client.get(url, headers={'Accept-Encoding': accept_encoding})
+		body = response.get_data()
+	return {
+		'status': response.status_code,
+		'encoding': response.headers.get('Content-Encoding', 'identity'),
+		'bytes': len(body),
+		'cpu_ms': (time.process_time() - cpu_start) / count * 1000,
+		'wall_ms': (time.perf_counter() - wall_start) / count * 1000
+	}
+
+
+def page_load(client, accept_encoding: str) -> dict:
+	"""Bytes of the rooms page and what it links to, on a first visit and on a repeat visit"""
+	response = client.get('/rooms', headers={'Accept-Encoding': accept_encoding})
+	html = client.get('/rooms').get_data(as_text=True)
+	links = ASSET_LINK.findall(html)
+	first = len(response.get_data())
+	for link in links:
+		first += len(client.get(link, headers={'Accept-Encoding': accept_encoding}).get_data())
+	# Immutable assets are not requested again, plain static files are revalidated
+	repeat = len(response.get_data()) + sum(len(client.get(link).get_data()) for link in links if link.startswith('/static/'))
+	return {'first_visit_bytes': first, 'repeat_visit_bytes': repeat, 'assets': links}
+
+
+def main():
+	args = parse_args()
+	os.environ.setdefault('DATABASE_URL', f'sqlite:///{tempfile.mkdtemp()}/compression.db')
+	os.environ.setdefault('APP_SECRET_KEY', 'bench')
+	os.environ['REAPER_INTERVAL'] = '0'
+	os.environ.pop('RECAPTCHA_SITE_KEY', None)
+	from app import app, db  # pylint: disable=import-outside-toplevel
+	from bench import dataset  # pylint: disable=import-outside-toplevel
+	import assets  # pylint: disable=import-outside-toplevel
+	import startup  # pylint: disable=import-outside-toplevel
+
+	startup.bootstrap()
+	with app.app_context():
+		dataset.generate(db, args.rooms, active_fraction=0.5, rng=random.Random(args.random_seed))
+	client = app.test_client()
+
+	static = {}
+	for name, fingerprinted in sorted(assets.get().names.items()):
+		for label, url in ((f'/static/{name}', f'/static/{name}'), (f'/assets/{name}', f'/assets/{fingerprinted}')):
+			static[label] = {encoding: measure(client, url, header, args.requests) for encoding, header in ENCODINGS.items()}
+	dynamic = {route: {encoding: measure(client, route, header, args.requests) for encoding, header in ENCODINGS.items()}
+		for route in DYNAMIC_ROUTES}
+
+	report = {
+		'benchmark': 'compression',
+		'timestamp': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+		'commit': git_commit(),
+		'parameters': {key: value for key, value in vars(args).items() if key != 'output'},
+		'results': {
+			'static': static,
+			'dynamic': dynamic,
+			'page_load': {encoding: page_load(client, header) for encoding, header in ENCODINGS.items()}
+		}
+	}
+	output = json.dumps(report, indent=2)
+	if args.output:
+		with open(args.output, 'w') as report_file:
+			report_file.write(output)
+	else:
+		print(output)
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,203 @@
+"""Synthetic history of players, rooms, settings and times
+
+Rows are written with COPY on Postgres and with executemany inserts of
+large chunks elsewhere, never through session.add. Every settings
+combination gets its canonical row up front and rooms pick combinations
+with a Zipf-like popularity, room sizes a geometric distribution, finish
+times a log-normal distribution around two hours, and most rooms are
+already expired, like the history the reaper has not removed yet.
+
+Usage: python -m bench.dataset --rooms 100000 [--database-url URL]
+"""
+import argparse
+import csv
+import io
+import itertools
+import math
+import os
+import random
+from collections import namedtuple
+from datetime import datetime, timedelta
+from uuid import UUID
+
+# Chunk of rows per COPY or executemany
+CHUNK_SIZE = 10000
+
+# Keys kept from the generated rows for benchmarks to look up
+SAMPLE_SIZE = 1000
+
+Dataset = namedtuple('Dataset', ['players', 'rooms', 'room_players', 'player_samples', 'room_samples', 'active_rooms'])
+
+
+class Reservoir:
+	"""Uniform sample of a stream of unknown length"""
+
+	def __init__(self, size: int, rng: random.Random):
+		self.size = size
+		self.rng = rng
+		self.seen = 0
+		self.items = []
+
+	def add(self, item):
+		self.seen += 1
+		if len(self.items) < self.size:
+			self.items.append(item)
+		else:
+			index = self.rng.randrange(self.seen)
+			if index < self.size:
+				self.items[index] = item
+
+
+def next_id(db, table) -> int:
+	return (db.session.query(db.func.max(table.c.id)).scalar() or 0) + 1
+
+
+def insert_rows(db, table, columns: list, rows):
+	"""Write rows in chunks with COPY on Postgres, executemany otherwise"""
+	rows = iter(rows)
+	while True:
+		chunk = list(itertools.islice(rows, CHUNK_SIZE))
+		if not chunk:
+			break
+		if db.engine.dialect.name == 'postgresql':
+			buffer = io.StringIO()
+			csv.writer(buffer).writerows(chunk)
+			buffer.seek(0)
+			connection = db.engine.raw_connection()
+			try:
+				connection.cursor().copy_expert(
+					f'COPY {table.name} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv)', buffer)
+				connection.commit()
+			finally:
+				connection.close()
+		else:
+			db.engine.execute(table.insert(), [dict(zip(columns, row)) for row in chunk])
+
+
+def reset_sequences(db, tables):
+	"""Move Postgres id sequences past the explicitly inserted ids"""
+	if db.engine.dialect.name != 'postgresql':
+		return
+	for table in tables:
+		db.engine.execute(f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+			f"(SELECT COALESCE(MAX(id), 1) FROM {table.name}))")
+
+
+def settings_popularity(lookups: dict, rng: random.Random, exponent: float = 1.1):
+	"""Every lookup combination with cumulative Zipf weights over a random popularity order"""
+	combinations = list(itertools.product(*lookups.values()))
+	rng.shuffle(combinations)
+	cumulative = list(itertools.accumulate(1 / (rank + 1) ** exponent for rank in range(len(combinations))))
+	return combinations, cumulative
+
+
+def generate(db, rooms: int, players: int = None, members_per_room: float = 3.0, finish_ratio: float = 0.75,
+		active_fraction: float = 0.02, history_days: int = 90, rng: random.Random = None) -> Dataset:
+	"""Append synthetic history to the database, returns row counts and sampled keys"""
+	from database import Player, Room, RoomPlayer, Settings, Difficulty, Goal, Logic, Mode, Variation, Weapons, SETTINGS_KEY  # pylint: disable=import-outside-toplevel
+
+	rng = rng or random.Random(0)
+	players = players or max(1, rooms // 5)
+	now = datetime.now()
+
+	lookups = {model: [row_id for row_id, in db.session.query(model.id)] for model in (Difficulty, Goal, Logic, Mode, Variation, Weapons)}
+	combinations, cumulative = settings_popularity(lookups, rng)
+	db.session.rollback()
+
+	first_player = next_id(db, Player.__table__)
+	first_room = next_id(db, Room.__table__)
+	first_settings = next_id(db, Settings.__table__)
+	columns = [Settings.__table__.c[name] for name in SETTINGS_KEY]
+	settings_ids = {tuple(key): settings_id for settings_id, *key in db.session.query(Settings.id, *columns)}
+	db.session.rollback()
+
+	player_samples = Reservoir(SAMPLE_SIZE, rng)
+	room_samples = Reservoir(SAMPLE_SIZE, rng)
+	active_rooms = Reservoir(SAMPLE_SIZE, rng)
+
+	def player_rows():
+		for player_id in range(first_player, first_player + players):
+			uuid = str(UUID(int=rng.getrandbits(128), version=4))
+			player_samples.add((player_id, uuid, f'p{player_id}'))
+			yield player_id, uuid, f'p{player_id}', now - timedelta(days=rng.random() * history_days)
+
+	insert_rows(db, Player.__table__, ['id', 'uuid', 'name', 'create_date'], player_rows())
+
+	# Canonical rows of the combinations that do not have one yet
+	missing = [combination + flags for combination in combinations
+		for flags in itertools.product((False, True), repeat=3) if combination + flags not in settings_ids]
+	for settings_id, key in enumerate(missing, first_settings):
+		settings_ids[key] = settings_id
+	insert_rows(db, Settings.__table__, ['id'] + list(SETTINGS_KEY),
+		((settings_id,) + key for settings_id, key in enumerate(missing, first_settings)))
+
+	# Active players create and join rooms far more often than the rest
+	player_ids = range(first_player, first_player + players)
+	player_weights = list(itertools.accumulate(rng.paretovariate(1.5) for _ in player_ids))
+	creators = []
+
+	def room_rows():
+		for offset in range(rooms):
+			room_id = first_room + offset
+			if rng.random() < active_fraction:
+				create_time = now - timedelta(seconds=rng.random() * 6 * 3600)
+			else:
+				create_time = now - timedelta(hours=6, seconds=rng.random() * history_days * 86400)
+			creator = rng.choices(player_ids, cum_weights=player_weights)[0]
+			creators.append(creator)
+			hash_code = f'{room_id:x}{rng.getrandbits(32):08x}'
+			room_samples.add((room_id, hash_code))
+			if create_time + timedelta(hours=6) > now:
+				active_rooms.add((room_id, hash_code))
+			settings = rng.choices(combinations, cum_weights=cumulative)[0] + (rng.random() < 0.1, rng.random() < 0.2, rng.random() < 0.05)
+			yield (room_id, settings_ids[settings], f'https://tlk.io/alttr_{hash_code}', creator, hash_code,
+				create_time, create_time + timedelta(hours=6), 'ready', 0)
+
+	insert_rows(db, Room.__table__, ['id', 'settings_id', 'chat_url', 'creator_id', 'hash_code', 'create_time',
+		'expire_time', 'status', 'version'], room_rows())
+
+	counter = {'room_players': 0}
+	success = 1 / members_per_room
+
+	def room_player_rows():
+		for offset, creator in enumerate(creators):
+			size = min(50, 1 + int(math.log(1 - rng.random()) / math.log(1 - success)) if success < 1 else 1)
+			members = {creator}
+			while len(members) < min(size, players):
+				members.add(rng.choices(player_ids, cum_weights=player_weights)[0])
+			for player_id in members:
+				counter['room_players'] += 1
+				finish = int(rng.lognormvariate(math.log(7200), 0.3)) if rng.random() < finish_ratio else None
+				yield first_room + offset, player_id, finish
+
+	insert_rows(db, RoomPlayer.__table__, ['room_id', 'player_id', 'time'], room_player_rows())
+
+	reset_sequences(db, [Player.__table__, Settings.__table__, Room.__table__])
+	return Dataset(players, rooms, counter['room_players'], player_samples.items, room_samples.items, active_rooms.items)
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--rooms', type=int, required=True)
+	parser.add_argument('--players', type=int, help='Defaults to one player per five rooms.')
+	parser.add_argument('--members-per-room', type=float, default=3.0)
+	parser.add_argument('--active-fraction', type=float, default=0.02, help='Share of rooms that are not expired.')
+	parser.add_argument('--database-url', help='Defaults to DATABASE_URL.')
+	parser.add_argument('--random-seed', type=int, default=0)
+	args = parser.parse_args()
+
+	if args.database_url:
+		os.environ['DATABASE_URL'] = args.database_url
+	os.environ['REAPER_INTERVAL'] = '0'
+	from app import app, db  # pylint: disable=import-outside-toplevel
+	import startup  # pylint: disable=import-outside-toplevel
+
+	startup.bootstrap()
+	with app.app_context():
+		dataset = generate(db, args.rooms, args.players, args.members_per_room,
+			active_fraction=args.active_fraction, rng=random.Random(args.random_seed))
+	print(f'Inserted {dataset.players} players, {dataset.rooms} rooms and {dataset.room_players} room players')
+
+
+if __name__ == '__main__':
+	main()
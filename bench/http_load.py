@@ -0,0 +1,307 @@
+"""HTTP load test of the main routes against a local database and seed stand-in
+
+Boots the app on a local port, fills the database with players, rooms and
+times, drives a weighted mix of routes from concurrent clients and prints a
+JSON report with latency percentiles, throughput and SQL statements per
+request for each route.
+
+Usage: python -m bench.http_load [--duration 20] [--concurrency 8] [--database-url URL] [--output FILE]
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from threading import Lock, Thread
+from uuid import uuid4
+import requests
+from bench import seed_stub
+
+# Relative frequency of each route in the traffic mix
+DEFAULT_MIX = {
+	'rooms': 35,
+	'room': 30,
+	'api_rooms': 10,
+	'time': 15,
+	'create': 10
+}
+
+CSRF_TOKEN = re.compile(r'name=_csrf_token type=hidden value="([^"]+)"')
+
+CREATE_FORM = {
+	'difficulty': 'normal',
+	'goal': 'ganon',
+	'logic': 'NoGlitches',
+	'mode': 'open',
+	'variation': 'none',
+	'weapons': 'uncle'
+}
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--duration', type=float, default=20, help='Seconds of measured traffic.')
+	parser.add_argument('--warmup', type=float, default=3, help='Seconds of unmeasured traffic first.')
+	parser.add_argument('--concurrency', type=int, default=8, help='Concurrent clients.')
+	parser.add_argument('--players', type=int, default=500)
+	parser.add_argument('--rooms', type=int, default=300)
+	parser.add_argument('--times', type=int, default=2000, help='Room players with a posted time.')
+	parser.add_argument('--seed-delay', type=float, default=0.2, help='Latency of the seed stand-in.')
+	parser.add_argument('--mix', type=json.loads, default=DEFAULT_MIX, help='JSON object of route weights.')
+	parser.add_argument('--database-url', help='Defaults to a temporary SQLite database.')
+	parser.add_argument('--output', help='Write the report to this file instead of stdout.')
+	parser.add_argument('--random-seed', type=int, default=0)
+	return parser.parse_args()
+
+
+def configure_environment(args, seed_url: str):
+	"""The app reads its configuration from the environment at import"""
+	if not args.database_url:
+		args.database_url = f'sqlite:///{tempfile.mkdtemp()}/bench.db'
+	os.environ['DATABASE_URL'] = args.database_url
+	os.environ['ALTTPR_SEED_URL'] = seed_url
+	os.environ.setdefault('APP_SECRET_KEY', 'bench')
+	os.environ['REAPER_INTERVAL'] = '0'
+	os.environ.pop('RECAPTCHA_SITE_KEY', None)
+	# A few players drive all the traffic, the rate limits would turn most of it away
+	for name in ('create', 'queue', 'time', 'name'):
+		for scope in ('player', 'ip'):
+			os.environ.setdefault(f'RATE_LIMIT_{name.upper()}_{scope.upper()}', '1000000/1')
+
+
+def populate(args, rng: random.Random) -> list:
+	"""Bulk insert players, rooms and times, returns (id, name) of the players and the rooms' hash codes"""
+	from app import db  # pylint: disable=import-outside-toplevel
+	from database import Player, Room, RoomPlayer, Difficulty, Goal, Logic, Mode, Variation, Weapons  # pylint: disable=import-outside-toplevel
+	import interning  # pylint: disable=import-outside-toplevel
+
+	lookups = {model: [row.id for row in model.query.all()] for model in (Difficulty, Goal, Logic, Mode, Variation, Weapons)}
+	now = datetime.now()
+	# Interned before the bulk inserts, new combinations are inserted on a connection of their own
+	settings_ids = [interning.settings_id(interning.SettingsKey(
+		rng.choice(lookups[Difficulty]), rng.choice(lookups[Goal]), rng.choice(lookups[Logic]), rng.choice(lookups[Mode]),
+		rng.choice(lookups[Variation]), rng.choice(lookups[Weapons]), rng.random() < 0.1, rng.random() < 0.2, rng.random() < 0.1))
+		for _ in range(args.rooms)]
+
+	db.session.bulk_insert_mappings(Player, [
+		{'uuid': str(uuid4()), 'name': f'bench{i}', 'create_date': now} for i in range(args.players)])
+	players = db.session.query(Player.id, Player.name).all()
+	player_ids = [player_id for player_id, _ in players]
+
+	rooms = []
+	for settings_id in settings_ids:
+		create_time = now - timedelta(seconds=rng.randrange(6 * 3600))
+		rooms.append({
+			'settings_id': settings_id, 'creator_id': rng.choice(player_ids), 'chat_url': None,
+			'hash_code': uuid4().hex[:10], 'create_time': create_time, 'expire_time': create_time + timedelta(hours=6),
+			'status': 'ready', 'version': 0
+		})
+	db.session.bulk_insert_mappings(Room, rooms)
+	room_ids = dict(db.session.query(Room.hash_code, Room.id).all())
+
+	members = set()
+	for room in rooms:
+		members.add((room_ids[room['hash_code']], room['creator_id']))
+	while len(members) < len(rooms) + args.times:
+		members.add((rng.choice(list(room_ids.values())), rng.choice(player_ids)))
+	db.session.bulk_insert_mappings(RoomPlayer, [
+		{'room_id': room_id, 'player_id': player_id, 'time': rng.randrange(3600, 4 * 3600) if rng.random() < 0.8 else None}
+		for room_id, player_id in members])
+	db.session.commit()
+	return players, [room['hash_code'] for room in rooms]
+
+
+def instrument(app):
+	"""Report the SQL statements each request executed, as counted by metrics, in a response header"""
+	from flask import g  # pylint: disable=import-outside-toplevel
+
+	@app.after_request
+	def sql_statements_header(response):
+		response.headers['X-SQL-Statements'] = str(g.get('sql_statements', 0))
+		return response
+
+
+def start_server(app) -> str:
+	from werkzeug.serving import make_server  # pylint: disable=import-outside-toplevel
+	logging.getLogger('werkzeug').setLevel(logging.WARNING)
+	server = make_server('127.0.0.1', 0, app, threaded=True)
+	Thread(target=server.serve_forever, name='bench-server', daemon=True).start()
+	return f'http://127.0.0.1:{server.server_port}'
+
+
+class Recorder:
+
+	def __init__(self):
+		self.samples = defaultdict(list)
+		self.errors = defaultdict(int)
+		self.statuses = defaultdict(lambda: defaultdict(int))
+		self.lock = Lock()
+		self.recording = False
+
+	def record(self, route: str, seconds: float, response):
+		if not self.recording:
+			return
+		with self.lock:
+			if response is not None:
+				self.statuses[route][str(response.status_code)] += 1
+			if response is None or response.status_code >= 500:
+				self.errors[route] += 1
+				return
+			self.samples[route].append((seconds, int(response.headers.get('X-SQL-Statements', 0))))
+
+
+class Client:
+	"""A browser of one player following the route mix"""
+
+	def __init__(self, base_url: str, cookie: str, hash_codes: list, mix: dict, recorder: Recorder, rng: random.Random):
+		self.base_url = base_url
+		self.session = requests.Session()
+		self.session.cookies.set('player', cookie)
+		self.session.cookies.set('cookies', 'true')
+		self.hash_codes = hash_codes
+		self.routes, self.weights = zip(*mix.items())
+		self.recorder = recorder
+		self.rng = rng
+		self.etags = {}
+
+	def request(self, route: str, method: str, path: str, record: bool = True, **kwargs):
+		start = time.perf_counter()
+		try:
+			response = self.session.request(method, self.base_url + path, allow_redirects=False, **kwargs)
+		except requests.RequestException:
+			response = None
+		if record:
+			self.recorder.record(route, time.perf_counter() - start, response)
+		return response
+
+	def csrf_token(self, path: str) -> str:
+		response = self.request(None, 'GET', path, record=False)
+		found = CSRF_TOKEN.search(response.text) if response is not None else None
+		return found.group(1) if found else ''
+
+	def rooms(self):
+		self.request('rooms', 'GET', '/rooms')
+
+	def room(self):
+		hash_code = self.rng.choice(self.hash_codes)
+		headers = {'If-None-Match': self.etags[hash_code]} if hash_code in self.etags else {}
+		response = self.request('room', 'GET', f'/room/{hash_code}', headers=headers)
+		if response is not None and response.headers.get('ETag'):
+			self.etags[hash_code] = response.headers['ETag']
+
+	def api_rooms(self):
+		self.request('api_rooms', 'GET', '/api/v1/rooms')
+
+	def time(self):
+		hash_code = self.rng.choice(self.hash_codes)
+		token = self.csrf_token(f'/room/{hash_code}')
+		self.etags.pop(hash_code, None)
+		self.request('time', 'POST', f'/time/{hash_code}', data={
+			'_csrf_token': token, 'hours': '1', 'minutes': str(self.rng.randrange(60)), 'seconds': str(self.rng.randrange(60))})
+
+	def create(self):
+		token = self.csrf_token('/create')
+		self.request('create', 'POST', '/create', data=dict(CREATE_FORM, _csrf_token=token))
+
+	def run(self, deadline: float):
+		while time.monotonic() < deadline:
+			getattr(self, self.rng.choices(self.routes, self.weights)[0])()
+
+
+def percentile(values: list, p: float) -> float:
+	return values[min(len(values) - 1, int(p * len(values)))] if values else 0.0
+
+
+def summarize(recorder: Recorder, duration: float) -> dict:
+	routes = {}
+	for route in sorted(set(recorder.samples) | set(recorder.errors)):
+		samples = recorder.samples[route]
+		latencies = sorted(seconds * 1000 for seconds, _ in samples)
+		statements = [count for _, count in samples]
+		routes[route] = {
+			'requests': len(samples),
+			'errors': recorder.errors[route],
+			'statuses': dict(recorder.statuses[route]),
+			'throughput_rps': len(samples) / duration,
+			'latency_ms': {
+				'p50': percentile(latencies, 0.50),
+				'p95': percentile(latencies, 0.95),
+				'p99': percentile(latencies, 0.99),
+				'mean': sum(latencies) / len(latencies) if latencies else 0.0,
+				'max': latencies[-1] if latencies else 0.0
+			},
+			'sql_statements': {
+				'mean': sum(statements) / len(statements) if statements else 0.0,
+				'max': max(statements) if statements else 0
+			}
+		}
+	total = sum(route['requests'] for route in routes.values())
+	return {'total_requests': total, 'throughput_rps': total / duration, 'routes': routes}
+
+
+def git_commit() -> str:
+	try:
+		return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def main():
+	args = parse_args()
+	rng = random.Random(args.random_seed)
+
+	_, seed_url = seed_stub.start(delay=args.seed_delay)
+	configure_environment(args, seed_url)
+
+	from app import app  # pylint: disable=import-outside-toplevel
+	import identity  # pylint: disable=import-outside-toplevel
+	import startup  # pylint: disable=import-outside-toplevel
+
+	startup.bootstrap()
+	with app.app_context():
+		players, hash_codes = populate(args, rng)
+		cookies = [identity.serializer().dumps([player_id, name]) for player_id, name in players]
+	instrument(app)
+	base_url = start_server(app)
+
+	recorder = Recorder()
+	clients = [Client(base_url, rng.choice(cookies), hash_codes, args.mix, recorder, random.Random(rng.random()))
+		for _ in range(args.concurrency)]
+
+	start = time.monotonic()
+	deadline = start + args.warmup + args.duration
+	threads = [Thread(target=client.run, args=(deadline,), daemon=True) for client in clients]
+	for thread in threads:
+		thread.start()
+	time.sleep(args.warmup)
+	recorder.recording = True
+	measure_start = time.monotonic()
+	for thread in threads:
+		thread.join()
+	recorder.recording = False
+
+	report = {
+		'benchmark': 'http_load',
+		'timestamp': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+		'commit': git_commit(),
+		'database': args.database_url.split('://', 1)[0],
+		'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'database_url')},
+		'results': summarize(recorder, time.monotonic() - measure_start)
+	}
+	output = json.dumps(report, indent=2)
+	if args.output:
+		with open(args.output, 'w') as report_file:
+			report_file.write(output)
+	else:
+		print(output)
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,202 @@
+"""Local stand-in for the Redis server of state.RedisStore
+
+Speaks the subset of the Redis protocol the store uses: GET, SET with
+expiry and NX, DEL, INCR and INCRBY, EXPIRE, PUBLISH, SUBSCRIBE and
+PSUBSCRIBE, and MULTI/EXEC pipelines.
+"""
+from fnmatch import fnmatchcase
+from socket import IPPROTO_TCP, TCP_NODELAY
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+from threading import Lock, Thread
+from time import monotonic
+
+
+class Data:
+	"""Keys with their expiry, and the subscribed connections, of one server"""
+
+	def __init__(self):
+		self.values = {}
+		self.expires = {}
+		self.channels = {}
+		self.patterns = {}
+		self.lock = Lock()
+
+	def get(self, key: bytes):
+		expires = self.expires.get(key)
+		if expires is not None and expires <= monotonic():
+			self.values.pop(key, None)
+			self.expires.pop(key, None)
+		return self.values.get(key)
+
+	def set(self, key: bytes, value: bytes, ttl: float = None):
+		self.values[key] = value
+		if ttl is None:
+			self.expires.pop(key, None)
+		else:
+			self.expires[key] = monotonic() + ttl
+
+	def delete(self, key: bytes) -> int:
+		self.expires.pop(key, None)
+		return 1 if self.values.pop(key, None) is not None else 0
+
+
+class Error(Exception):
+	"""Answered to the client as a Redis error"""
+
+
+class KVHandler(StreamRequestHandler):
+	"""One client connection, in subscriber mode after its first SUBSCRIBE"""
+
+	def setup(self):
+		super().setup()
+		# Replies of a pipeline are written one by one, as Redis does they must not wait for acknowledgements
+		self.connection.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+		self.write_lock = Lock()
+		self.transaction = None
+
+	def read_command(self) -> list:
+		line = self.rfile.readline()
+		if not line:
+			return None
+		if not line.startswith(b'*'):
+			return line.split()
+		command = []
+		for _ in range(int(line[1:])):
+			length = int(self.rfile.readline()[1:])
+			command.append(self.rfile.read(length + 2)[:-2])
+		return command
+
+	def encode(self, reply) -> bytes:
+		if reply is None:
+			return b'$-1\r\n'
+		if isinstance(reply, Error):
+			return b'-ERR ' + str(reply).encode() + b'\r\n'
+		if isinstance(reply, bool):
+			return b'+OK\r\n' if reply else b'$-1\r\n'
+		if isinstance(reply, int):
+			return b':%d\r\n' % reply
+		if isinstance(reply, str):
+			return b'+' + reply.encode() + b'\r\n'
+		if isinstance(reply, list):
+			return b'*%d\r\n' % len(reply) + b''.join(self.encode(item) for item in reply)
+		return b'$%d\r\n' % len(reply) + reply + b'\r\n'
+
+	def send(self, reply):
+		with self.write_lock:
+			self.wfile.write(self.encode(reply))
+			self.wfile.flush()
+
+	def handle(self):
+		while True:
+			command = self.read_command()
+			if command is None:
+				break
+			name = command[0].upper().decode()
+			if self.transaction is not None and name not in ('EXEC', 'DISCARD'):
+				self.transaction.append(command)
+				self.send('QUEUED')
+				continue
+			try:
+				reply = self.execute(name, command[1:])
+			except Error as error:
+				reply = error
+			if reply is not NotImplemented:
+				self.send(reply)
+		self.unsubscribe_all()
+
+	def execute(self, name: str, args: list):
+		data = self.server.data
+		if name == 'MULTI':
+			self.transaction = []
+			return True
+		if name == 'EXEC':
+			commands, self.transaction = self.transaction or [], None
+			with data.lock:
+				return [self.run(data, command[0].upper().decode(), command[1:]) for command in commands]
+		if name == 'DISCARD':
+			self.transaction = None
+			return True
+		if name in ('SUBSCRIBE', 'PSUBSCRIBE'):
+			subscriptions = data.channels if name == 'SUBSCRIBE' else data.patterns
+			with data.lock:
+				for count, channel in enumerate(args, 1):
+					subscriptions.setdefault(channel, set()).add(self)
+					self.send([name.lower().encode(), channel, count])
+			return NotImplemented
+		if name == 'PUBLISH':
+			return self.publish(data, *args)
+		with data.lock:
+			return self.run(data, name, args)
+
+	def run(self, data: Data, name: str, args: list):  # pylint: disable=too-many-return-statements
+		try:
+			if name == 'PING':
+				return 'PONG'
+			if name in ('CLIENT', 'SELECT'):
+				return True
+			if name == 'GET':
+				return data.get(args[0])
+			if name == 'SET':
+				return self.set(data, args)
+			if name == 'DEL':
+				return sum(data.delete(key) for key in args)
+			if name in ('INCR', 'INCRBY'):
+				value = int(data.get(args[0]) or 0) + (int(args[1]) if name == 'INCRBY' else 1)
+				data.values[args[0]] = str(value).encode()
+				return value
+			if name in ('EXPIRE', 'PEXPIRE'):
+				if data.get(args[0]) is None:
+					return 0
+				data.expires[args[0]] = monotonic() + int(args[1]) / (1 if name == 'EXPIRE' else 1000)
+				return 1
+			if name == 'FLUSHALL':
+				data.values.clear()
+				data.expires.clear()
+				return True
+		except (IndexError, ValueError):
+			return Error(f"wrong arguments for '{name.lower()}' command")
+		return Error(f"unknown command '{name.lower()}'")
+
+	@staticmethod
+	def set(data: Data, args: list):
+		key, value, options, ttl = args[0], args[1], [arg.upper() for arg in args[2:]], None
+		if b'EX' in options:
+			ttl = int(options[options.index(b'EX') + 1])
+		if b'PX' in options:
+			ttl = int(options[options.index(b'PX') + 1]) / 1000
+		exists = data.get(key) is not None
+		if (b'NX' in options and exists) or (b'XX' in options and not exists):
+			return None
+		data.set(key, value, ttl)
+		return True
+
+	@staticmethod
+	def publish(data: Data, channel: bytes, message: bytes) -> int:
+		with data.lock:
+			receivers = [(handler, [b'message', channel, message]) for handler in data.channels.get(channel, ())]
+			receivers += [(handler, [b'pmessage', pattern, channel, message])
+				for pattern, handlers in data.patterns.items() if fnmatchcase(channel, pattern) for handler in handlers]
+		for handler, reply in receivers:
+			try:
+				handler.send(reply)
+			except OSError:
+				pass
+		return len(receivers)
+
+	def unsubscribe_all(self):
+		data = self.server.data
+		with data.lock:
+			for subscriptions in (data.channels, data.patterns):
+				for channel in list(subscriptions):
+					subscriptions[channel].discard(self)
+					if not subscriptions[channel]:
+						del subscriptions[channel]
+
+
+def start(port: int = 0) -> (ThreadingTCPServer, str):
+	"""Serve in a daemon thread, returns the server and its redis:// URL"""
+	server = ThreadingTCPServer(('127.0.0.1', port), KVHandler)
+	server.daemon_threads = True
+	server.data = Data()
+	Thread(target=server.serve_forever, name='kv-stub', daemon=True).start()
+	return server, f'redis://127.0.0.1:{server.server_address[1]}/0'
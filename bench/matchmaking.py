@@ -0,0 +1,147 @@
+"""Simulation of the matchmaking queue under a stream of arriving players
+
+Players arrive at a steady rate on a simulated clock with settings drawn
+from a Zipf-like popularity, some of them accepting several values of a
+field, and the queue is widened every simulated second. Prints a JSON
+report with the wait times, the share of players matched and the cost of
+enqueue and widen calls, the latter also measured against queues already
+holding many waiting players to show that it does not grow with them.
+
+Usage: python -m bench.matchmaking [--players 50000] [--rate 20] [--output FILE]
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from datetime import datetime
+from bench.dataset import settings_popularity
+from bench.http_load import git_commit, percentile
+import matchmaking
+
+# Lookup names of the settings catalog, as in database.py
+CATALOG = {
+	'difficulty': ('normal', 'easy', 'hard', 'expert', 'insane', 'crowdControl'),
+	'goal': ('ganon', 'dungeons', 'pedestal', 'triforce-hunt'),
+	'logic': ('NoGlitches', 'OverworldGlitches', 'MajorGlitches', 'None'),
+	'mode': ('standard', 'open', 'inverted'),
+	'variation': ('none', 'timed-race', 'timed-ohko', 'ohko', 'key-sanity', 'retro'),
+	'weapons': ('uncle', 'randomized', 'swordless'),
+	'enemizer': (False, True),
+	'spoilers': (False, True),
+	'tournament': (False, True)
+}
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--players', type=int, default=50000, help='Players arriving during the simulation.')
+	parser.add_argument('--rate', type=float, default=20, help='Players arriving per simulated second.')
+	parser.add_argument('--flexible', type=float, default=0.3, help='Share of players accepting a second value of a field.')
+	parser.add_argument('--room-size', type=int, default=matchmaking.QUEUE_ROOM_SIZE)
+	parser.add_argument('--widen-after', type=float, default=matchmaking.QUEUE_WIDEN_AFTER)
+	parser.add_argument('--backlogs', type=lambda value: [int(size) for size in value.split(',')], default=[1000, 10000, 100000],
+		help='Comma separated numbers of unmatched waiting players to time enqueue against.')
+	parser.add_argument('--output', help='Write the report to this file instead of stdout.')
+	parser.add_argument('--random-seed', type=int, default=0)
+	return parser.parse_args()
+
+
+class Clock:
+
+	def __init__(self):
+		self.now = 0.0
+
+	def __call__(self) -> float:
+		return self.now
+
+
+def preferences(rng: random.Random, combinations: list, cumulative: list, flexible: float) -> dict:
+	accepted = {field: [value] for field, value in zip(matchmaking.FIELDS, rng.choices(combinations, cum_weights=cumulative)[0])}
+	if rng.random() < flexible:
+		field = rng.choice(matchmaking.FIELDS)
+		accepted[field].append(rng.choice(CATALOG[field]))
+	return accepted
+
+
+def simulate(args, rng: random.Random) -> dict:
+	combinations, cumulative = settings_popularity(CATALOG, rng)
+	clock = Clock()
+	queue = matchmaking.MatchQueue(CATALOG, room_size=args.room_size, widen_after=args.widen_after, clock=clock)
+	arrivals = {}
+	waits = []
+	enqueue_seconds = widen_seconds = 0.0
+	widen_calls = 0
+	next_widen = 1.0
+
+	def matched(matches):
+		for match in matches:
+			for player_id in match.player_ids:
+				waits.append(clock.now - arrivals.pop(player_id))
+
+	for player_id in range(args.players):
+		clock.now += rng.expovariate(args.rate)
+		while next_widen <= clock.now:
+			start = time.perf_counter()
+			matches = queue.widen()
+			widen_seconds += time.perf_counter() - start
+			widen_calls += 1
+			matched(matches)
+			next_widen += 1.0
+		arrivals[player_id] = clock.now
+		accepted = preferences(rng, combinations, cumulative, args.flexible)
+		start = time.perf_counter()
+		matches = queue.enqueue(player_id, accepted)
+		enqueue_seconds += time.perf_counter() - start
+		matched(matches)
+
+	waits.sort()
+	return {
+		'simulated_seconds': round(clock.now, 1),
+		'matched_ratio': len(waits) / args.players,
+		'still_waiting': len(queue),
+		'wait_seconds': {
+			'p50': percentile(waits, 0.50),
+			'p95': percentile(waits, 0.95),
+			'p99': percentile(waits, 0.99),
+			'max': waits[-1] if waits else 0.0
+		},
+		'enqueue_us': enqueue_seconds / args.players * 1e6,
+		'widen_us': widen_seconds / widen_calls * 1e6 if widen_calls else 0.0
+	}
+
+
+def backlog_cost(args, rng: random.Random, size: int, samples: int = 2000) -> float:
+	"""Microseconds per enqueue into a queue already holding size players who cannot match each other"""
+	clock = Clock()
+	queue = matchmaking.MatchQueue(CATALOG, room_size=size + samples + 1, widen_after=args.widen_after, clock=clock)
+	combinations, cumulative = settings_popularity(CATALOG, rng)
+	for player_id in range(size):
+		queue.enqueue(player_id, preferences(rng, combinations, cumulative, args.flexible))
+	start = time.perf_counter()
+	for player_id in range(size, size + samples):
+		queue.enqueue(player_id, preferences(rng, combinations, cumulative, args.flexible))
+	return (time.perf_counter() - start) / samples * 1e6
+
+
+def main():
+	args = parse_args()
+	rng = random.Random(args.random_seed)
+	report = {
+		'benchmark': 'matchmaking',
+		'timestamp': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+		'commit': git_commit(),
+		'parameters': {key: value for key, value in vars(args).items() if key != 'output'},
+		'simulation': simulate(args, rng),
+		'enqueue_us_by_backlog': {str(size): backlog_cost(args, rng, size) for size in args.backlogs}
+	}
+	output = json.dumps(report, indent=2)
+	if args.output:
+		with open(args.output, 'w') as report_file:
+			report_file.write(output)
+	else:
+		print(output)
+
+
+if __name__ == '__main__':
+	sys.exit(main())
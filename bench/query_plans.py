@@ -0,0 +1,117 @@
+"""Check that the queries behind each route are served by indexes
+
+tests/test_query_plans.py runs these checks with the test suite, this script
+runs them against any database. It runs EXPLAIN against the database of DATABASE_URL, or a temporary SQLite
+database when it is unset, and exits with status 1 when a query plan
+contains a full table scan or a sort that no index provides.
+
+Usage: python -m bench.query_plans [--database-url URL]
+"""
+import argparse
+import os
+import sys
+import tempfile
+from datetime import datetime
+
+# Queries whose sort covers only the rows of a single room
+BOUNDED_SORTS = {'room page'}
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'),
+		help='Defaults to DATABASE_URL, or a temporary SQLite database when it is unset.')
+	return parser.parse_args()
+
+
+def route_queries() -> dict:
+	"""Representative query of each lookup the routes and background jobs perform"""
+	from app import db  # pylint: disable=import-outside-toplevel
+	from database import Player, QueueEntry, QueueTicket, RateLimitBucket, Room, RoomPlayer  # pylint: disable=import-outside-toplevel
+	from sqlalchemy import func, select  # pylint: disable=import-outside-toplevel
+	import api  # pylint: disable=import-outside-toplevel
+	import leaderboards  # pylint: disable=import-outside-toplevel
+	import queries  # pylint: disable=import-outside-toplevel
+	import seed_jobs  # pylint: disable=import-outside-toplevel
+	now = datetime.now()
+	entries, tickets, buckets = QueueEntry.__table__, QueueTicket.__table__, RateLimitBucket.__table__
+	return {
+		'player by uuid': Player.query.filter_by(uuid='00000000-0000-0000-0000-000000000000'),
+		'room by hash_code': Room.query.filter_by(hash_code='0000000000'),
+		'rooms listing': queries.rooms_page_query(),
+		'rooms listing after cursor': queries.rooms_page_query(f'{now.isoformat()}_1'),
+		'rooms listing keys': queries.rooms_page_keys_query(f'{now.isoformat()}_1'),
+		'rooms listing cards': queries.room_listing_query().filter(Room.id.in_([1, 2, 3])),
+		'api rooms': api.room_rows().order_by(Room.create_time.desc(), Room.id.desc()).limit(31),
+		'api rooms by mode': api.filtered_rooms({'mode': 'open'}).order_by(Room.create_time.desc(), Room.id.desc()).limit(31),
+		'room page': queries.room_view_query('0000000000'),
+		'room membership': RoomPlayer.query.filter(RoomPlayer.room_id == 1, RoomPlayer.player_id == 1),
+		'room times': RoomPlayer.query.join(Room).filter(Room.hash_code == '0000000000'),
+		'player rooms': RoomPlayer.query.filter(RoomPlayer.player_id == 1),
+		'player renamed rooms': Room.query.filter(Room.id.in_(queries.player_rooms_query(1))),
+		'leaderboard top': leaderboards.top_query('NoGlitches/ganon/open', leaderboards.PERIOD_ALL, 20),
+		'best other times': leaderboards.best_other_times_query(1, 1, 'NoGlitches/ganon/open', leaderboards.current_week()),
+		'expired rooms': db.session.query(Room.id).filter(Room.expire_time < now).order_by(Room.expire_time).limit(500),
+		'stale pending rooms': seed_jobs.stale_rooms_query(now),
+		'queue full bucket': select([entries.c.bucket]).where(entries.c.bucket.in_(['[]', '[1]']))
+			.group_by(entries.c.bucket).having(func.count() >= 2).order_by(entries.c.bucket).limit(1),
+		'queue bucket players': select([entries.c.player_id]).where(entries.c.bucket == '[]')
+			.order_by(entries.c.entered_at, entries.c.player_id).limit(2),
+		'queue player entries': entries.delete().where(entries.c.player_id.in_([1, 2])),
+		'queue due tickets': tickets.select().where(tickets.c.widen_at <= 0).order_by(tickets.c.widen_at),
+		'queue expired tickets': tickets.delete().where(tickets.c.matched_at <= 0),
+		'rate limit refill': select([buckets.c.tokens, buckets.c.taken_at]).where(buckets.c.key == 'name:1').with_for_update(),
+		'rate limit eviction': buckets.delete().where(buckets.c.evict_after < 0)
+	}
+
+
+def explain(query) -> list:
+	"""Plan lines of the ORM query or Core statement on the current database"""
+	from app import db  # pylint: disable=import-outside-toplevel
+	compiled = getattr(query, 'statement', query).compile(dialect=db.engine.dialect)
+	params = [compiled.params[name] for name in compiled.positiontup] if compiled.positional else compiled.params
+	connection = db.session.connection()
+	if db.engine.dialect.name == 'sqlite':
+		return [row[-1] for row in connection.execute(f'EXPLAIN QUERY PLAN {compiled}', params)]
+	# Make the planner prefer any usable index so small tables do not hide missing ones
+	connection.execute('SET LOCAL enable_seqscan = off')
+	return [row[0] for row in connection.execute(f'EXPLAIN {compiled}', params)]
+
+
+def problems(plan: list, sort_ok: bool = False) -> list:
+	"""Plan lines showing a full scan or an unindexed sort"""
+	found = []
+	for line in plan:
+		if line.startswith('SCAN') and 'USING' not in line:
+			found.append(line)
+		elif 'Seq Scan on' in line:
+			found.append(line)
+		elif 'TEMP B-TREE' in line and not sort_ok:
+			found.append(line)
+	return found
+
+
+def main() -> int:
+	args = parse_args()
+	# The app reads its configuration from the environment at import
+	os.environ['DATABASE_URL'] = args.database_url or f'sqlite:///{tempfile.mkdtemp()}/query_plans.db'
+	os.environ.setdefault('APP_SECRET_KEY', 'bench')
+	from app import app, db  # pylint: disable=import-outside-toplevel
+	import startup  # pylint: disable=import-outside-toplevel
+
+	failed = False
+	startup.bootstrap()
+	with app.app_context():
+		for name, query in route_queries().items():
+			plan = explain(query)
+			bad = problems(plan, name in BOUNDED_SORTS)
+			failed = failed or bool(bad)
+			print(f'{"FAIL" if bad else "ok  "} {name}')
+			for line in plan:
+				print(f'       {line}')
+		db.session.rollback()
+	return 1 if failed else 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,153 @@
+"""Growth of query latency with the number of rooms
+
+Grows a database through bench.dataset to each scale in turn, times the
+queries behind every route with keys sampled from the generated rows and
+prints a JSON report. Between consecutive scales the growth exponent of
+each query's median latency is computed, a log-log slope where 0 means
+constant time and 1 linear, and exponents above the threshold are flagged
+as super-linear. The exit status is 1 when anything was flagged.
+
+Usage: python -m bench.query_scaling [--scales 10000,100000,1000000] [--database-url URL] [--output FILE]
+"""
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+from bench import dataset
+from bench.http_load import git_commit
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--scales', type=lambda value: sorted(int(scale) for scale in value.split(',')),
+		default=[10000, 100000, 1000000], help='Comma separated room counts.')
+	parser.add_argument('--repeat', type=int, default=50, help='Timed executions of each query per scale.')
+	parser.add_argument('--threshold', type=float, default=1.1, help='Growth exponent flagged as super-linear.')
+	parser.add_argument('--database-url', help='Defaults to a temporary SQLite database. Rows are added, never removed.')
+	parser.add_argument('--output', help='Write the report to this file instead of stdout.')
+	parser.add_argument('--random-seed', type=int, default=0)
+	return parser.parse_args()
+
+
+def query_patterns(samples: dict, rng: random.Random) -> dict:
+	"""Function running each route's query with freshly sampled keys"""
+	from app import db  # pylint: disable=import-outside-toplevel
+	from database import Player, Room, RoomPlayer  # pylint: disable=import-outside-toplevel
+	import api  # pylint: disable=import-outside-toplevel
+	import queries  # pylint: disable=import-outside-toplevel
+
+	def pick(name: str):
+		return rng.choice(samples[name])
+
+	def cursor():
+		room_id, _ = pick('active_rooms')
+		return queries.encode_cursor(db.session.query(Room.id, Room.create_time).filter(Room.id == room_id).one())
+
+	return {
+		'player by uuid': lambda: Player.query.filter_by(uuid=pick('players')[1]).first(),
+		'room by hash_code': lambda: Room.query.filter_by(hash_code=pick('rooms')[1]).first(),
+		'rooms listing': lambda: queries.rooms_page_query().all(),
+		'rooms listing after cursor': lambda: queries.rooms_page_query(cursor()).all(),
+		'rooms listing keys': lambda: queries.rooms_page_keys_query().all(),
+		'rooms listing cards': lambda: queries.load_listings([room_id for room_id, _ in rng.sample(samples['active_rooms'], 10)]),
+		'api rooms by mode': lambda: api.filtered_rooms({'mode': 'open'})
+			.order_by(Room.create_time.desc(), Room.id.desc()).limit(31).all(),
+		'room page': lambda: queries.load_room(pick('rooms')[1]),
+		'room members': lambda: queries.room_members(pick('rooms')[0]),
+		'player rooms': lambda: RoomPlayer.query.filter(RoomPlayer.player_id == pick('players')[0]).all(),
+		'expired rooms': lambda: db.session.query(Room.id)
+			.filter(Room.expire_time < datetime.now()).order_by(Room.expire_time).limit(500).all()
+	}
+
+
+def time_query(run, repeat: int) -> dict:
+	"""Median and p95 milliseconds of repeated executions, each in its own session"""
+	from app import db  # pylint: disable=import-outside-toplevel
+	run()
+	db.session.remove()
+	durations = []
+	for _ in range(repeat):
+		start = time.perf_counter()
+		run()
+		durations.append((time.perf_counter() - start) * 1000)
+		db.session.remove()
+	durations.sort()
+	return {'median_ms': durations[len(durations) // 2], 'p95_ms': durations[min(len(durations) - 1, int(0.95 * len(durations)))]}
+
+
+def growth(results: list, threshold: float) -> dict:
+	"""Growth exponent of each query between consecutive scales, flagged above the threshold"""
+	report = {}
+	for smaller, larger in zip(results, results[1:]):
+		for name, timing in larger['queries'].items():
+			before = smaller['queries'][name]['median_ms']
+			exponent = math.log(timing['median_ms'] / before) / math.log(larger['rooms'] / smaller['rooms']) if before > 0 else 0.0
+			report.setdefault(name, []).append({
+				'from': smaller['rooms'],
+				'to': larger['rooms'],
+				'exponent': round(exponent, 3),
+				'super_linear': exponent > threshold
+			})
+	return report
+
+
+def main() -> int:
+	args = parse_args()
+	rng = random.Random(args.random_seed)
+
+	if not args.database_url:
+		args.database_url = f'sqlite:///{tempfile.mkdtemp()}/scaling.db'
+	os.environ['DATABASE_URL'] = args.database_url
+	os.environ['REAPER_INTERVAL'] = '0'
+	from app import app, db  # pylint: disable=import-outside-toplevel
+	import startup  # pylint: disable=import-outside-toplevel
+
+	startup.bootstrap()
+
+	results = []
+	samples = {'players': [], 'rooms': [], 'active_rooms': []}
+	rooms = 0
+	with app.app_context():
+		for scale in args.scales:
+			start = time.perf_counter()
+			generated = dataset.generate(db, scale - rooms, rng=rng)
+			rooms = scale
+			samples['players'] += generated.player_samples
+			samples['rooms'] += generated.room_samples
+			samples['active_rooms'] += generated.active_rooms
+			# Fresh planner statistics, as the database would have after autovacuum
+			db.engine.execute('ANALYZE')
+			load_seconds = time.perf_counter() - start
+
+			timings = {name: time_query(run, args.repeat) for name, run in query_patterns(samples, rng).items()}
+			results.append({'rooms': scale, 'load_seconds': round(load_seconds, 3), 'queries': timings})
+			print(f'{scale} rooms loaded in {load_seconds:.1f}s', file=sys.stderr)
+
+	report = {
+		'benchmark': 'query_scaling',
+		'timestamp': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+		'commit': git_commit(),
+		'database': args.database_url.split('://', 1)[0],
+		'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'database_url')},
+		'results': results,
+		'growth': growth(results, args.threshold)
+	}
+	flagged = sorted(name for name, steps in report['growth'].items() if any(step['super_linear'] for step in steps))
+	report['super_linear'] = flagged
+
+	output = json.dumps(report, indent=2)
+	if args.output:
+		with open(args.output, 'w') as report_file:
+			report_file.write(output)
+	else:
+		print(output)
+	return 1 if flagged else 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
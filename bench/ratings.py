@@ -0,0 +1,89 @@
+"""Time of a full ratings recompute over synthetic results
+
+Generates results of rooms spread over a history of daily rating periods,
+with room sizes, player activity and finish times distributed as in
+bench.dataset, and times ratings.compute on them. Prints a JSON report.
+
+Usage: python -m bench.ratings [--results 1000000] [--output FILE]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+import numpy as np
+from bench.http_load import git_commit
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--results', type=int, default=1000000)
+	parser.add_argument('--players', type=int, help='Defaults to one player per fifteen results.')
+	parser.add_argument('--members-per-room', type=float, default=3.0)
+	parser.add_argument('--categories', type=int, default=48, help='Distinct settings categories.')
+	parser.add_argument('--days', type=int, default=365, help='Rating periods of history.')
+	parser.add_argument('--repeat', type=int, default=3)
+	parser.add_argument('--output', help='Write the report to this file instead of stdout.')
+	parser.add_argument('--random-seed', type=int, default=0)
+	return parser.parse_args()
+
+
+def synthetic_results(args, rng: np.random.RandomState):
+	"""(room_ids, player_ids, category_ids, periods, times) arrays with one entry per result"""
+	players = args.players or max(2, args.results // 15)
+	sizes = np.minimum(50, 1 + rng.geometric(1 / args.members_per_room, args.results))
+	sizes = sizes[np.cumsum(sizes) <= args.results]
+	room_ids = np.repeat(np.arange(len(sizes)), sizes)
+	# Active players race far more often than the rest, a player may not meet themselves
+	activity = rng.pareto(1.5, players) + 1
+	player_ids = rng.choice(players, len(room_ids), p=activity / activity.sum())
+	keep = np.ones(len(room_ids), dtype=bool)
+	keep[1:] = ~((room_ids[1:] == room_ids[:-1]) & (player_ids[1:] == player_ids[:-1]))
+	room_ids, player_ids = room_ids[keep], player_ids[keep]
+	categories = rng.zipf(1.5, len(sizes)) % args.categories + 1
+	periods = np.sort(rng.randint(0, args.days, len(sizes)))
+	times = rng.lognormal(np.log(7200), 0.3, len(room_ids)).astype(np.int64)
+	return room_ids, player_ids, categories[room_ids], periods[room_ids], times
+
+
+def main():
+	args = parse_args()
+	os.environ.setdefault('DATABASE_URL', f'sqlite:///{tempfile.mkdtemp()}/ratings.db')
+	os.environ['REAPER_INTERVAL'] = '0'
+	import ratings  # pylint: disable=import-outside-toplevel
+
+	results = synthetic_results(args, np.random.RandomState(args.random_seed))
+	durations = []
+	for _ in range(args.repeat):
+		start = time.perf_counter()
+		slot_players, _, rated, _, _, pairs = ratings.compute(*results, overall_id=0)
+		durations.append(time.perf_counter() - start)
+
+	report = {
+		'benchmark': 'ratings',
+		'timestamp': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+		'commit': git_commit(),
+		'parameters': {key: value for key, value in vars(args).items() if key != 'output'},
+		'results': {
+			'results': len(results[0]),
+			'rooms': int(results[0][-1]) + 1,
+			'pairs': pairs,
+			'ratings': len(rated),
+			'players': len(np.unique(slot_players)),
+			'seconds': min(durations),
+			'results_per_second': len(results[0]) / min(durations),
+			'rating_spread': {'min': float(rated.min()), 'max': float(rated.max()), 'std': float(rated.std())}
+		}
+	}
+	output = json.dumps(report, indent=2)
+	if args.output:
+		with open(args.output, 'w') as report_file:
+			report_file.write(output)
+	else:
+		print(output)
+
+
+if __name__ == '__main__':
+	sys.exit(main())
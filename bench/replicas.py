@@ -0,0 +1,177 @@
+"""Read routing between a primary and a replica database
+
+Fills a primary with synthetic rooms and copies it into a second database
+that stands in for a replica, frozen at the time of the copy like a replica
+lagging behind. Then counts the SQL statements each database runs for the
+read-only routes, for a player who just wrote and reads their own writes,
+once their window on the primary ended, and while the replica is down.
+Prints a JSON report.
+
+By default both databases are temporary SQLite files. Two local Postgres
+databases work as well, --no-copy skips the copy for a real replica.
+
+Usage: python -m bench.replicas [--rooms 2000] [--primary-url URL --replica-url URL [--no-copy]] [--output FILE]
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import create_engine, event
+from bench.http_load import git_commit
+
+READ_ROUTES = ('/', '/rooms', '/room/{hash_code}', '/api/v1/rooms', '/api/v1/rooms/{hash_code}/times')
+
+CSRF_TOKEN = re.compile(r'name=_csrf_token type=hidden value="([^"]+)"')
+
+# Databases that refuse connections, standing in for a replica that is down
+UNREACHABLE_URLS = {
+	'sqlite': 'sqlite:////nonexistent/replica.db',
+	'postgresql': 'postgresql://127.0.0.1:1/replica'
+}
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--rooms', type=int, default=2000)
+	parser.add_argument('--primary-url', help='Defaults to a temporary SQLite database.')
+	parser.add_argument('--replica-url', help='Defaults to a temporary SQLite database.')
+	parser.add_argument('--no-copy', action='store_true', help='The replica already replicates the primary.')
+	parser.add_argument('--output', help='Write the report to this file instead of stdout.')
+	parser.add_argument('--random-seed', type=int, default=0)
+	return parser.parse_args()
+
+
+def copy_database(metadata, source, target):
+	"""Replace the tables of the target with those of the source"""
+	metadata.drop_all(target)
+	metadata.create_all(target)
+	for table in metadata.sorted_tables:
+		rows = [dict(row) for row in source.execute(table.select())]
+		if rows:
+			target.execute(table.insert(), rows)
+
+
+class Statements:
+	"""SQL statements run on each engine since the last reset"""
+
+	def __init__(self, engines: dict):
+		self.counts = Counter()
+		for name, engine in engines.items():
+			event.listen(engine, 'before_cursor_execute', lambda *_, name=name: self.counts.update([name]))
+
+	@contextmanager
+	def counting(self, results: dict, label: str):
+		self.counts.clear()
+		outcome = {}
+		yield outcome
+		results[label] = dict(outcome, statements=dict(self.counts))
+
+
+def main():
+	args = parse_args()
+	directory = tempfile.mkdtemp()
+	os.environ['DATABASE_URL'] = args.primary_url or f'sqlite:///{directory}/primary.db'
+	os.environ['DATABASE_REPLICA_URLS'] = args.replica_url or f'sqlite:///{directory}/replica.db'
+	os.environ.setdefault('APP_SECRET_KEY', 'bench')
+	os.environ['REAPER_INTERVAL'] = '0'
+	os.environ['REPLICA_CHECK_INTERVAL'] = '0'
+	os.environ.pop('RECAPTCHA_SITE_KEY', None)
+	for scope in ('PLAYER', 'IP'):
+		os.environ.setdefault(f'RATE_LIMIT_NAME_{scope}', '1000000/1')
+	from app import app, db  # pylint: disable=import-outside-toplevel
+	from bench import dataset  # pylint: disable=import-outside-toplevel
+	import routing  # pylint: disable=import-outside-toplevel
+	import startup  # pylint: disable=import-outside-toplevel
+
+	startup.bootstrap()
+	replica = routing.replicas[0]
+	with app.app_context():
+		generated = dataset.generate(db, args.rooms, active_fraction=0.5, rng=random.Random(args.random_seed))
+		if not args.no_copy:
+			copy_database(db.Model.metadata, db.engine, replica.engine)
+		startup.preload()
+		statements = Statements({'primary': db.engine, 'replica': replica.engine})
+	routing.check_replicas()
+	hash_code = generated.active_rooms[0][1]
+	results = {}
+
+	# Anonymous visitors only read
+	visitor = app.test_client()
+	for route in READ_ROUTES:
+		path = route.format(hash_code=hash_code)
+		with statements.counting(results, f'read {path}') as outcome:
+			outcome['status'] = visitor.get(path).status_code
+
+	# A new player joins the room, then reads their own writes from the primary
+	player = app.test_client()
+	player.set_cookie('localhost', 'cookies', 'true')
+	token = CSRF_TOKEN.search(player.get('/name').get_data(as_text=True)).group(1)
+	with statements.counting(results, 'write /name') as outcome:
+		outcome['status'] = player.post('/name', data={'_csrf_token': token, 'name': 'replica'}).status_code
+	with statements.counting(results, f'join /room/{hash_code}') as outcome:
+		outcome['status'] = player.get(f'/room/{hash_code}').status_code
+	for path in (f'/room/{hash_code}', f'/api/v1/rooms/{hash_code}/times'):
+		with statements.counting(results, f'read own writes {path}') as outcome:
+			response = player.get(path)
+			outcome['status'] = response.status_code
+			outcome['sees_own_writes'] = 'replica' in response.get_data(as_text=True)
+
+	# Others read from the replica, which lags behind the primary until it catches up
+	with statements.counting(results, f'other client /api/v1/rooms/{hash_code}/times') as outcome:
+		response = visitor.get(f'/api/v1/rooms/{hash_code}/times')
+		outcome['status'] = response.status_code
+		outcome['sees_writes'] = 'replica' in response.get_data(as_text=True)
+
+	# Once the window on the primary ends, the player reads from the replica again
+	with player.session_transaction() as session:
+		session['_primary_until'] = 0
+	with statements.counting(results, 'window ended /rooms') as outcome:
+		outcome['status'] = player.get('/rooms').status_code
+
+	# The lagging replica misses the player's join, the room page checks the primary before joining again
+	with statements.counting(results, f'window ended /room/{hash_code}') as outcome:
+		response = player.get(f'/room/{hash_code}')
+		outcome['status'] = response.status_code
+		outcome['sees_own_writes'] = 'replica' in response.get_data(as_text=True)
+
+	# The request that finds a replica down runs again on the primary, later ones leave the replica out
+	engine = replica.engine
+	replica.engine = create_engine(UNREACHABLE_URLS[engine.dialect.name])
+	event.listen(replica.engine, 'handle_error', replica.handle_error)
+	for attempt in ('first', 'second'):
+		with statements.counting(results, f'replica down, {attempt} request /rooms') as outcome:
+			outcome['status'] = visitor.get('/rooms').status_code
+			outcome['replica_healthy'] = replica.healthy
+	routing.check_replicas()
+	with statements.counting(results, 'replica down after check /rooms') as outcome:
+		outcome['status'] = visitor.get('/rooms').status_code
+		outcome['replica_healthy'] = replica.healthy
+	replica.engine = engine
+	routing.check_replicas()
+	with statements.counting(results, 'replica back after check /rooms') as outcome:
+		outcome['status'] = visitor.get('/rooms').status_code
+		outcome['replica_healthy'] = replica.healthy
+
+	report = {
+		'benchmark': 'replicas',
+		'timestamp': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+		'commit': git_commit(),
+		'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'primary_url', 'replica_url')},
+		'results': results
+	}
+	output = json.dumps(report, indent=2)
+	if args.output:
+		with open(args.output, 'w') as report_file:
+			report_file.write(output)
+	else:
+		print(output)
+
+
+if __name__ == '__main__':
+	sys.exit(main())
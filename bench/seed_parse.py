@@ -0,0 +1,81 @@
+"""Peak memory and time per seed response, full json parse vs streaming parse
+
+Usage: python -m bench.seed_parse [--patch-entries N] [--runs N]
+"""
+import argparse
+import json
+import random
+import time
+import tracemalloc
+import alttpr_api
+
+
+def synthetic_response(patch_entries: int) -> str:
+	"""Seed response shaped like alttpr.com's, dominated by the ROM patch"""
+	rng = random.Random(0)
+	seed = {
+		'logic': 'v31',
+		'patch': [{str(rng.randrange(0x200000)): [rng.randrange(256) for _ in range(rng.randrange(1, 64))]}
+			for _ in range(patch_entries)],
+		'spoiler': {
+			'meta': {'logic': 'NoGlitches', 'mode': 'open', 'goal': 'ganon', 'name': None, 'build': '2019-03-01'},
+			'Light World': {f'Location {i}': f'Item {i}' for i in range(200)}
+		},
+		'hash': 'zYxWvUtSr1',
+		'generated': '2019-03-20T12:00:00+00:00',
+		'size': 2,
+		'current_rom_hash': 'd41d8cd98f00b204e9800998ecf8427e'
+	}
+	return json.dumps(seed)
+
+
+def chunked(text: str):
+	for start in range(0, len(text), alttpr_api.STREAM_CHUNK_SIZE):
+		yield text[start:start + alttpr_api.STREAM_CHUNK_SIZE]
+
+
+def full_parse(text: str) -> dict:
+	"""What response.json() did, the whole body and every patch int materialized"""
+	seed = json.loads(''.join(chunked(text)))
+	return {'hash': seed['hash'], 'generated': seed['generated'], 'spoiler': {'meta': seed['spoiler']['meta']}}
+
+
+def stream_parse(text: str) -> dict:
+	return alttpr_api.parse_seed(chunked(text))
+
+
+def measure(parse, text: str, runs: int) -> dict:
+	peak = 0
+	for _ in range(runs):
+		tracemalloc.start()
+		parse(text)
+		peak = max(peak, tracemalloc.get_traced_memory()[1])
+		tracemalloc.stop()
+
+	# Timed separately, tracing slows allocation heavy code down
+	start = time.perf_counter()
+	for _ in range(runs):
+		parse(text)
+	elapsed = time.perf_counter() - start
+	return {'peak_bytes': peak, 'seconds_per_call': elapsed / runs}
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--patch-entries', type=int, default=8000)
+	parser.add_argument('--runs', type=int, default=5)
+	args = parser.parse_args()
+
+	text = synthetic_response(args.patch_entries)
+	assert full_parse(text) == stream_parse(text)
+
+	results = {
+		'response_bytes': len(text),
+		'full': measure(full_parse, text, args.runs),
+		'stream': measure(stream_parse, text, args.runs)
+	}
+	print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,68 @@
+"""Local stand-in for the alttpr.com seed endpoint"""
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+
+class SeedHandler(BaseHTTPRequestHandler):
+	"""Answers each POST with the next reply of the script, a seed shaped like alttpr.com's once it is empty
+
+	A reply is 'ok' for a seed, 'truncated' for half of one before the connection
+	drops, 'reset' to close the connection without answering, or an error status
+	code. The replies given are recorded in requests.
+	"""
+
+	delay = 0.0
+	patch_entries = 2000
+	script = []
+	requests = []
+
+	def do_POST(self):  # pylint: disable=invalid-name
+		self.rfile.read(int(self.headers.get('Content-Length', 0)))
+		reply = self.script.pop(0) if self.script else 'ok'
+		self.requests.append(reply)
+		if reply == 'reset':
+			self.close_connection = True
+			return
+		if self.delay:
+			time.sleep(self.delay)
+		status, body = (200, self.seed()) if reply in ('ok', 'truncated') else (reply, b'{"error": "rejected"}')
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		if reply == 'truncated':
+			self.wfile.write(body[:len(body) // 2])
+			self.close_connection = True
+			return
+		self.wfile.write(body)
+
+	def seed(self) -> bytes:
+		"""Seed with a ROM patch of patch_entries entries"""
+		rng = random.Random()
+		return json.dumps({
+			'logic': 'v31',
+			'patch': [{str(rng.randrange(0x200000)): [rng.randrange(256) for _ in range(16)]}
+				for _ in range(self.patch_entries)],
+			'spoiler': {'meta': {'build': '2019-03-01'}},
+			'hash': ''.join(rng.choice('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789') for _ in range(10)),
+			'generated': time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime())
+		}).encode()
+
+	def log_message(self, *args):  # pylint: disable=arguments-differ
+		pass
+
+
+def start(delay: float = 0.0, patch_entries: int = 2000, port: int = 0) -> (ThreadingHTTPServer, str):
+	"""Serve seeds in a daemon thread, returns the server and the seed URL
+
+	Replies are scripted by extending server.RequestHandlerClass.script.
+	"""
+	handler = type('StubSeedHandler', (SeedHandler,), {'delay': delay, 'patch_entries': patch_entries,
+		'script': [], 'requests': []})
+	server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+	server.daemon_threads = True
+	Thread(target=server.serve_forever, name='seed-stub', daemon=True).start()
+	return server, f'http://127.0.0.1:{server.server_port}/seed'
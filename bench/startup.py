@@ -0,0 +1,122 @@
+"""Cold import and first request latency of the app
+
+Each run starts a fresh interpreter that imports the app, counting the SQL
+statements the import executes, and times the first and second request of
+a few routes. Runs are made with the catalog and templates loaded lazily by
+the first request and with them preloaded the way gunicorn's master does,
+the first run of each starting from an empty template bytecode cache. An
+import against an unreachable database checks that workers boot without
+one. Prints a JSON report.
+
+Usage: python -m bench.startup [--runs 5] [--output FILE]
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from bench.http_load import git_commit
+
+ROUTES = ('/', '/rooms', '/name', '/api/v1/rooms')
+
+# Nothing listens on port 1, connecting fails at once
+UNREACHABLE_DATABASE = 'postgresql://bench@127.0.0.1:1/bench'
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--runs', type=int, default=5, help='Fresh interpreters per mode.')
+	parser.add_argument('--database-url', help='Defaults to a temporary SQLite database.')
+	parser.add_argument('--output', help='Write the report to this file instead of stdout.')
+	parser.add_argument('--child', choices=('bootstrap', 'lazy', 'preload', 'import'), help=argparse.SUPPRESS)
+	return parser.parse_args()
+
+
+def child(mode: str) -> dict:
+	"""Measurements of one fresh interpreter, run with --child"""
+	from sqlalchemy import event  # pylint: disable=import-outside-toplevel
+	from sqlalchemy.engine import Engine  # pylint: disable=import-outside-toplevel
+	statements = []
+	event.listen(Engine, 'before_cursor_execute', lambda *_: statements.append(None))
+
+	start = time.perf_counter()
+	from app import app  # pylint: disable=import-outside-toplevel
+	import startup  # pylint: disable=import-outside-toplevel
+	result = {'import_seconds': time.perf_counter() - start, 'import_statements': len(statements)}
+	if mode == 'import':
+		return result
+	if mode == 'bootstrap':
+		startup.bootstrap()
+		return result
+
+	if mode == 'preload':
+		start = time.perf_counter()
+		startup.preload()
+		result['preload_seconds'] = time.perf_counter() - start
+	client = app.test_client()
+	for route in ROUTES:
+		for request in ('first', 'second'):
+			start = time.perf_counter()
+			response = client.get(route)
+			result[f'{route} {request}_ms'] = (time.perf_counter() - start) * 1000
+			result[f'{route} status'] = response.status_code
+	return result
+
+
+def run_child(mode: str, environment: dict) -> dict:
+	"""Measurements of a fresh interpreter, None when it failed"""
+	process = subprocess.run([sys.executable, '-m', 'bench.startup', '--child', mode], env=environment,
+		stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+	return json.loads(process.stdout.decode().splitlines()[-1]) if process.returncode == 0 else None
+
+
+def summarize(runs: list) -> dict:
+	"""Median of each measurement over the runs, the first run also on its own"""
+	return {
+		'first_run': runs[0],
+		'median': {key: statistics.median(run[key] for run in runs) for key in runs[0] if not key.endswith('status')}
+	}
+
+
+def main():
+	args = parse_args()
+	if args.child:
+		print(json.dumps(child(args.child)))
+		return 0
+
+	directory = tempfile.mkdtemp()
+	environment = dict(os.environ, APP_SECRET_KEY='bench', REAPER_INTERVAL='0',
+		DATABASE_URL=args.database_url or f'sqlite:///{directory}/startup.db', JINJA_CACHE_DIR=f'{directory}/jinja')
+	environment.pop('RECAPTCHA_SITE_KEY', None)
+	if not run_child('bootstrap', environment):
+		raise SystemExit('Bootstrapping the database failed')
+
+	modes = {}
+	for mode in ('lazy', 'preload'):
+		shutil.rmtree(environment['JINJA_CACHE_DIR'], ignore_errors=True)
+		modes[mode] = summarize([run_child(mode, environment) for _ in range(args.runs)])
+	unreachable = run_child('import', dict(environment, DATABASE_URL=UNREACHABLE_DATABASE))
+
+	report = {
+		'benchmark': 'startup',
+		'timestamp': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+		'commit': git_commit(),
+		'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'child')},
+		'results': dict(modes, unreachable_database=dict(unreachable or {}, imported=unreachable is not None))
+	}
+	output = json.dumps(report, indent=2)
+	if args.output:
+		with open(args.output, 'w') as report_file:
+			report_file.write(output)
+	else:
+		print(output)
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
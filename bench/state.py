@@ -0,0 +1,135 @@
+"""Latency of the shared state operations per store
+
+Times get, set, incr and publish, from the publish call until the message
+reaches a subscriber, against the in-process store, the Redis stand-in of
+bench.kv_stub and optionally a real Redis server. Operations run one after
+the other and from several threads at once. Prints a JSON report.
+
+Usage: python -m bench.state [--operations 5000] [--threads 8] [--url redis://...] [--output FILE]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+from threading import Event, Thread
+from bench import kv_stub
+from bench.http_load import git_commit, percentile
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--operations', type=int, default=5000, help='Operations of each kind per store.')
+	parser.add_argument('--threads', type=int, default=8, help='Threads of the concurrent run.')
+	parser.add_argument('--url', help='Also measure the Redis server at this URL.')
+	parser.add_argument('--output', help='Write the report to this file instead of stdout.')
+	return parser.parse_args()
+
+
+def summarize(latencies: list, seconds: float) -> dict:
+	latencies = sorted(latency * 1e6 for latency in latencies)
+	return {
+		'operations': len(latencies),
+		'throughput_ops': len(latencies) / seconds,
+		'latency_us': {
+			'p50': percentile(latencies, 0.50),
+			'p99': percentile(latencies, 0.99),
+			'mean': sum(latencies) / len(latencies),
+			'max': latencies[-1]
+		}
+	}
+
+
+def operations(store, worker: int) -> dict:
+	"""Each operation timed, taking the index of the call"""
+	value = {'url': '/room/abcdefghij', 'error': None}
+	return {
+		'set': lambda index: store.set(f'bench:{worker}:{index % 100}', value, ttl=60),
+		'get': lambda index: store.get(f'bench:{worker}:{index % 100}'),
+		'incr': lambda index: store.incr(f'bench:counter:{index % 100}', ttl=60),
+		'delete': lambda index: store.delete(f'bench:{worker}:{index % 100}')
+	}
+
+
+def run(operation, count: int) -> list:
+	latencies = []
+	for index in range(count):
+		start = time.perf_counter()
+		operation(index)
+		latencies.append(time.perf_counter() - start)
+	return latencies
+
+
+def concurrent(store, name: str, count: int, threads: int) -> dict:
+	results = [None] * threads
+
+	def work(worker):
+		results[worker] = run(operations(store, worker)[name], count // threads)
+
+	start = time.perf_counter()
+	workers = [Thread(target=work, args=(worker,)) for worker in range(threads)]
+	for worker in workers:
+		worker.start()
+	for worker in workers:
+		worker.join()
+	return summarize([latency for latencies in results for latency in latencies], time.perf_counter() - start)
+
+
+def publish(store, count: int) -> dict:
+	"""Seconds from publishing a message until the subscriber receives it"""
+	received = Event()
+	store.subscribe('bench', lambda message: received.set())
+	# The listener of a networked store subscribes in the background
+	while store.publish('bench', 0) == 0 or not received.wait(1):
+		time.sleep(0.1)
+	latencies = []
+	start = time.perf_counter()
+	for index in range(count):
+		received.clear()
+		sent = time.perf_counter()
+		store.publish('bench', index)
+		received.wait(5)
+		latencies.append(time.perf_counter() - sent)
+	return summarize(latencies, time.perf_counter() - start)
+
+
+def measure(store, args) -> dict:
+	results = {}
+	for name, operation in operations(store, 0).items():
+		start = time.perf_counter()
+		results[name] = summarize(run(operation, args.operations), time.perf_counter() - start)
+		results[f'{name}_concurrent'] = concurrent(store, name, args.operations, args.threads)
+	results['publish'] = publish(store, args.operations)
+	return results
+
+
+def main():
+	args = parse_args()
+	os.environ.setdefault('DATABASE_URL', f'sqlite:///{tempfile.mkdtemp()}/state.db')
+	os.environ.setdefault('APP_SECRET_KEY', 'bench')
+	import state  # pylint: disable=import-outside-toplevel
+
+	_, stub_url = kv_stub.start()
+	stores = {'memory': state.MemoryStore(), 'kv_stub': state.RedisStore(stub_url)}
+	if args.url:
+		stores['redis'] = state.RedisStore(args.url)
+
+	report = {
+		'benchmark': 'state',
+		'timestamp': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+		'commit': git_commit(),
+		'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'url')},
+		'results': {name: measure(store, args) for name, store in stores.items()}
+	}
+	output = json.dumps(report, indent=2)
+	if args.output:
+		with open(args.output, 'w') as report_file:
+			report_file.write(output)
+	else:
+		print(output)
+
+
+if __name__ == '__main__':
+	sys.exit(main())
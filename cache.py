@@ -0,0 +1,82 @@
+"""In-process caches"""
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+class LRUCache:
+	"""Thread-safe mapping bounded in size, entries optionally expire after ttl seconds"""
+
+	def __init__(self, maxsize: int, ttl: float = None):
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.entries = OrderedDict()
+		self.lock = Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key, default=None):
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is None or (entry[1] is not None and entry[1] <= monotonic()):
+				if entry is not None:
+					del self.entries[key]
+				self.misses += 1
+				return default
+			self.entries.move_to_end(key)
+			self.hits += 1
+			return entry[0]
+
+	def set(self, key, value, ttl: float = None):
+		ttl = self.ttl if ttl is None else ttl
+		expires = monotonic() + ttl if ttl else None
+		with self.lock:
+			self.entries[key] = (value, expires)
+			self.entries.move_to_end(key)
+			while len(self.entries) > self.maxsize:
+				self.entries.popitem(last=False)
+
+	def incr(self, key, amount: int = 1, ttl: float = None) -> int:
+		"""Add amount to a number keeping its expiry, a missing number starts at 0 and expires after ttl"""
+		now = monotonic()
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is None or (entry[1] is not None and entry[1] <= now):
+				ttl = self.ttl if ttl is None else ttl
+				entry = (0, now + ttl if ttl else None)
+			value = entry[0] + amount
+			self.entries[key] = (value, entry[1])
+			self.entries.move_to_end(key)
+			while len(self.entries) > self.maxsize:
+				self.entries.popitem(last=False)
+			return value
+
+	def delete(self, key):
+		with self.lock:
+			self.entries.pop(key, None)
+
+	def expire(self) -> int:
+		"""Drop every expired entry, returns how many"""
+		now = monotonic()
+		with self.lock:
+			expired = [key for key, (_, expires) in self.entries.items() if expires is not None and expires <= now]
+			for key in expired:
+				del self.entries[key]
+			return len(expired)
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+
+	def __len__(self):
+		return len(self.entries)
+
+	def stats(self) -> dict:
+		with self.lock:
+			lookups = self.hits + self.misses
+			return {
+				'hits': self.hits,
+				'misses': self.misses,
+				'hit_ratio': self.hits / lookups if lookups else 0.0,
+				'size': len(self.entries)
+			}
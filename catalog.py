@@ -0,0 +1,149 @@
+"""Settings catalog, the lookup rows room settings are chosen from
+
+The six lookup tables only change with deploys, so each process loads them
+once into an immutable snapshot. Submitted names resolve to ids with dict
+lookups and are validated in memory, and creating a room runs no catalog
+query. reload() replaces the snapshot after the rows changed.
+
+`flask reload-catalog` bumps a version in the shared state after the rows
+were changed by hand, and every process reloads its snapshot when it sees
+the version change, checking at most every CATALOG_CHECK_INTERVAL seconds.
+Without STATE_URL processes do not share the version and pick up changes
+when they restart.
+"""
+from collections import namedtuple
+from os import environ
+from threading import Lock
+from time import monotonic
+from types import MappingProxyType
+from sqlalchemy import select
+from app import app, db
+from database import Difficulty, Goal, Logic, Mode, Variation, Weapons
+from interning import SettingsKey
+import state
+
+# Seconds between checks of the catalog version in the shared state
+CATALOG_CHECK_INTERVAL = float(environ.get('CATALOG_CHECK_INTERVAL', 10))
+
+VERSION_KEY = 'catalog:version'
+
+# Lookup model of each settings field, in form order
+LOOKUPS = {
+	'difficulty': Difficulty,
+	'goal': Goal,
+	'logic': Logic,
+	'mode': Mode,
+	'variation': Variation,
+	'weapons': Weapons
+}
+
+FLAGS = ('enemizer', 'spoilers', 'tournament')
+
+# Detached copy of a lookup row
+Option = namedtuple('Option', ['id', 'name', 'description'])
+
+
+class Selection(namedtuple('Selection', list(LOOKUPS) + list(FLAGS))):
+	"""Options and flags of one room's settings, unknown names are None until validated"""
+	__slots__ = ()
+
+	def key(self) -> SettingsKey:
+		return SettingsKey(self.difficulty.id, self.goal.id, self.logic.id, self.mode.id, self.variation.id,
+			self.weapons.id, self.enemizer, self.spoilers, self.tournament)
+
+	def to_dict(self) -> dict:
+		"""Seed generation parameters, as Settings.to_dict"""
+		return {
+			"difficulty": self.difficulty.name,
+			"enemizer": self.enemizer,
+			"lang": 'en',
+			"logic": self.logic.name,
+			"mode": self.mode.name,
+			"spoilers": self.spoilers,
+			"tournament": self.tournament,
+			"variation": self.variation.name,
+			"weapons": self.weapons.name
+		}
+
+
+class Catalog:
+	"""Options of every settings field, read-only once built"""
+	__slots__ = ('options', 'by_name')
+
+	def __init__(self, options: dict):
+		self.options = MappingProxyType({field: tuple(field_options) for field, field_options in options.items()})
+		self.by_name = MappingProxyType({field: MappingProxyType({option.name: option for option in field_options})
+			for field, field_options in self.options.items()})
+
+	def __setattr__(self, name, value):
+		if hasattr(self, name):
+			raise AttributeError(f'{type(self).__name__} is immutable')
+		super().__setattr__(name, value)
+
+	def names(self) -> dict:
+		"""Option names of each lookup field and both values of each flag"""
+		names = {field: [option.name for option in field_options] for field, field_options in self.options.items()}
+		names.update((flag, (False, True)) for flag in FLAGS)
+		return names
+
+	def resolve(self, values) -> Selection:
+		"""Selection of submitted names and flags, for validation.validate_settings"""
+		return Selection(*(self.by_name[field].get(values.get(field)) for field in LOOKUPS),
+			*(bool(values.get(flag)) for flag in FLAGS))
+
+
+def load() -> Catalog:
+	"""Read the lookup tables on a connection of its own, leaving the session of a request untouched"""
+	with db.engine.connect() as connection:
+		return Catalog({field: [Option(*row) for row in connection.execute(
+			select([model.id, model.name, model.description]).order_by(model.id))]
+			for field, model in LOOKUPS.items()})
+
+
+current = None
+lock = Lock()
+
+# Version in the shared state the current catalog was loaded at, and when it was last compared
+version = None
+checked_at = 0.0
+
+
+def get() -> Catalog:
+	"""Catalog of this process, loaded on first use and again once its version changed"""
+	if current is None or monotonic() - checked_at >= CATALOG_CHECK_INTERVAL:
+		with lock:
+			if current is None:
+				reload()
+			elif monotonic() - checked_at >= CATALOG_CHECK_INTERVAL:
+				check_version()
+	return current
+
+
+def check_version():
+	global checked_at  # pylint: disable=global-statement
+	checked_at = monotonic()
+	try:
+		changed = state.store.get(VERSION_KEY) != version
+	except Exception:  # pylint: disable=broad-except
+		# Keep serving the catalog at hand while the shared state is unavailable
+		app.logger.exception('Catalog version check failed')
+		return
+	if changed:
+		reload()
+
+
+def reload() -> Catalog:
+	"""Replace the catalog with the rows now in the database"""
+	global current, version, checked_at  # pylint: disable=global-statement
+	# Read first, a version bumped while the rows load is seen by the next check
+	version = state.store.get(VERSION_KEY)
+	checked_at = monotonic()
+	current = load()
+	return current
+
+
+def publish() -> int:
+	"""Have every process sharing the state reload the catalog, returns the new version"""
+	new_version = state.store.incr(VERSION_KEY)
+	reload()
+	return new_version
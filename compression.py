@@ -0,0 +1,56 @@
+"""Compression of dynamic responses
+
+Text responses of at least COMPRESS_MIN_SIZE bytes are gzipped for clients
+that accept it. Streamed responses, whose size is unknown, are compressed
+as they are produced without buffering the whole body. Event streams are
+left alone, their events have to reach the client one by one. Pages that
+render the CSRF token are left alone too: their compressed size would
+reveal the token to anyone who can put text next to it, such as a player
+name, and watch the size (BREACH).
+"""
+import gzip
+import zlib
+from os import environ
+from flask import g, request
+from app import app
+
+COMPRESS_MIN_SIZE = int(environ.get('COMPRESS_MIN_SIZE', 1024))
+
+# Level 6 gets most of the size reduction of 9 for a fraction of the CPU
+COMPRESS_LEVEL = int(environ.get('COMPRESS_LEVEL', 6))
+
+COMPRESSIBLE = {'text/html', 'text/plain', 'application/json', 'application/x-ndjson'}
+
+
+def gzip_stream(chunks):
+	# Window bits of 16 + 15 write a gzip header and trailer
+	compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31)
+	for chunk in chunks:
+		compressed = compressor.compress(chunk)
+		if compressed:
+			yield compressed
+	yield compressor.flush()
+
+
+@app.after_request
+def compress(response):
+	# The debug toolbar rewrites the html after this
+	if app.debug or response.status_code != 200 or response.mimetype not in COMPRESSIBLE \
+			or response.direct_passthrough or 'Content-Encoding' in response.headers \
+			or request.accept_encodings['gzip'] <= 0 or g.get('csrf_token_rendered'):
+		return response
+
+	if response.is_streamed:
+		response.response = gzip_stream(response.iter_encoded())
+	else:
+		data = response.get_data()
+		if len(data) < COMPRESS_MIN_SIZE:
+			return response
+		response.set_data(gzip.compress(data, COMPRESS_LEVEL))
+	response.content_encoding = 'gzip'
+	response.vary.add('Accept-Encoding')
+	# The compressed body is no longer byte for byte the one a strong validator names
+	etag, weak = response.get_etag()
+	if etag and not weak:
+		response.set_etag(etag, weak=True)
+	return response
@@ -1,6 +1,12 @@
 from app import db
 from datetime import datetime, timedelta
 from uuid import uuid4
+from sqlalchemy import inspect
+
+# Room seed generation states
+ROOM_PENDING = 'pending'
+ROOM_READY = 'ready'
+ROOM_FAILED = 'failed'
 
 difficulty = {
 	'normal': "Normal",
@@ -124,7 +130,11 @@ class Weapons(db.Model):
 	def __repr__(self):
 		return f'<id {self.id}>'
 
+# Columns identifying a settings combination, rooms with the same values share one row
+SETTINGS_KEY = ('difficulty_id', 'goal_id', 'logic_id', 'mode_id', 'variation_id', 'weapons_id', 'enemizer', 'spoilers', 'tournament')
+
 class Settings(db.Model):
+	__table_args__ = (db.Index('uq_settings_combination', *SETTINGS_KEY, unique=True),)
 
 	id = db.Column(db.Integer, primary_key=True)
 
@@ -181,7 +191,7 @@ class Settings(db.Model):
 class Player(db.Model):
 
 	id = db.Column(db.Integer, primary_key=True)
-	uuid = db.Column(db.String(40), nullable=False)
+	uuid = db.Column(db.String(40), nullable=False, unique=True, index=True)
 	name = db.Column(db.String(30), nullable=False)
 	create_date = db.Column(db.DateTime(), nullable=False)
 
@@ -194,31 +204,58 @@ class Player(db.Model):
 		return f'<id {self.id}>'
 
 class Room(db.Model):
+	# Listing order and keyset pagination cursor, and pending rooms the reaper fails once their job is lost
+	__table_args__ = (db.Index('ix_room_create_time_id', 'create_time', 'id'), db.Index('ix_room_status_create_time', 'status', 'create_time'))
 
 	id = db.Column(db.Integer, primary_key=True)
 	settings_id = db.Column(db.Integer, db.ForeignKey(Settings.id))
 	settings = db.relationship('Settings', foreign_keys="Room.settings_id")
 	chat_url = db.Column(db.String(40))
-	players = db.relationship('Player', secondary="room_player")
-	creator_id = db.Column(db.Integer, db.ForeignKey(Player.id))
+	players = db.relationship('Player', secondary="room_player", viewonly=True)
+	members = db.relationship('RoomPlayer', back_populates='room', cascade='all, delete-orphan')
+	creator_id = db.Column(db.Integer, db.ForeignKey(Player.id), index=True)
 	creator = db.relationship('Player', foreign_keys="Room.creator_id")
 
-	hash_code = db.Column(db.String(50))
+	hash_code = db.Column(db.String(50), unique=True, index=True)
 	create_time = db.Column(db.DateTime())
-	expire_time = db.Column(db.DateTime())
-
-	def __init__(self, settings, chat_url, creator, hash_code):
-		self.settings = settings
+	expire_time = db.Column(db.DateTime(), index=True)
+	status = db.Column(db.String(10), nullable=False, default=ROOM_READY, server_default=ROOM_READY)
+	# Bumped on every change to the room or its players
+	version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+	update_time = db.Column(db.DateTime())
+
+	def __init__(self, settings_id, chat_url, creator_id, hash_code, status=ROOM_READY):
+		self.settings_id = settings_id
 		self.chat_url = chat_url
-		self.players.append(creator)
-		self.creator = creator
+		self.members.append(RoomPlayer(player_id=creator_id))
+		self.creator_id = creator_id
 		self.hash_code = hash_code
+		self.status = status
 		self.create_time = datetime.now()
 		self.expire_time = datetime.now() + timedelta(hours=6)
 
+	def set_seed(self, hash_code, chat_url):
+		"""Fill in a pending room once its seed has been generated"""
+		self.hash_code = hash_code
+		self.chat_url = chat_url
+		self.status = ROOM_READY
+		self.touch()
+
+	def touch(self):
+		"""Record a change, the version is incremented in SQL so concurrent changes are not lost"""
+		self.version = Room.version + 1
+		self.update_time = datetime.now()
+
+	def get_update_time(self) -> datetime:
+		return self.update_time or self.create_time
+
 	def get_seed_url(self):
 		return f'https://alttpr.com/en/h/{self.hash_code}'
 	
+	def get_expire_iso(self) -> str:
+		"""Expire time with the server's UTC offset, for countdowns in the browser"""
+		return self.expire_time.astimezone().isoformat(timespec='seconds')
+
 	def get_expire_time(self) -> str:
 		expire_time = self.expire_time - datetime.now()
 		total_seconds = max(expire_time.seconds, 0)
@@ -229,20 +266,97 @@ class Room(db.Model):
 
 class RoomPlayer(db.Model):
 	room_id = db.Column(db.Integer, db.ForeignKey(Room.id), primary_key=True)
-	room = db.relationship('Room', foreign_keys="RoomPlayer.room_id")
-	player_id = db.Column(db.Integer, db.ForeignKey(Player.id), primary_key=True)
+	room = db.relationship('Room', foreign_keys="RoomPlayer.room_id", back_populates='members')
+	player_id = db.Column(db.Integer, db.ForeignKey(Player.id), primary_key=True, index=True)
 	player = db.relationship('Player', foreign_keys="RoomPlayer.player_id")
 	time = db.Column(db.Integer, default=None)
 	
 	def get_time_str(self):
-		if self.time:
-			total_seconds = self.time
-			hours = total_seconds // 3600
-			minutes = (total_seconds % 3600) // 60
-			seconds = (total_seconds % 3600) % 60
-			return f'{hours:02d}:{minutes:02d}:{seconds:02d}'
-		else:
-			return '-'
+		return format_time(self.time)
+
+class Result(db.Model):
+	"""Finish time of a player in a room, kept after the room is reaped so ratings can be recomputed"""
+	__table_args__ = (db.Index('ix_result_player_category', 'player_id', 'category'),)
+
+	room_id = db.Column(db.Integer, primary_key=True)
+	player_id = db.Column(db.Integer, db.ForeignKey(Player.id), primary_key=True)
+	category = db.Column(db.String(100), nullable=False)
+	race_time = db.Column(db.DateTime(), nullable=False, index=True)
+	time = db.Column(db.Integer, nullable=False)
+
+class Rating(db.Model):
+	"""Skill rating of a player in one settings category"""
+	player_id = db.Column(db.Integer, db.ForeignKey(Player.id), primary_key=True)
+	category = db.Column(db.String(100), primary_key=True)
+	rating = db.Column(db.Float, nullable=False)
+	deviation = db.Column(db.Float, nullable=False)
+	races = db.Column(db.Integer, nullable=False, default=0)
+	update_time = db.Column(db.DateTime())
+
+class Leaderboard(db.Model):
+	"""Best time and totals of a player in a settings category over a period, maintained by leaderboards.py"""
+	# Top-N of a board is read straight from this index
+	__table_args__ = (db.Index('ix_leaderboard_top', 'category', 'period', 'best_time'),)
+
+	category = db.Column(db.String(100), primary_key=True)
+	period = db.Column(db.String(10), primary_key=True)
+	player_id = db.Column(db.Integer, db.ForeignKey(Player.id), primary_key=True)
+	best_time = db.Column(db.Integer, nullable=False)
+	races = db.Column(db.Integer, nullable=False)
+	total_time = db.Column(db.BigInteger, nullable=False)
+
+class TimeHistogram(db.Model):
+	"""Finish times per bucket of a settings category and period, of everyone as player 0 and of each player"""
+	category = db.Column(db.String(100), primary_key=True)
+	period = db.Column(db.String(10), primary_key=True)
+	player_id = db.Column(db.Integer, primary_key=True)
+	bucket = db.Column(db.Integer, primary_key=True)
+	count = db.Column(db.Integer, nullable=False)
+
+class RateLimitBucket(db.Model):
+	"""Tokens left in a rate limit bucket shared by every worker, see ratelimit.py"""
+	key = db.Column(db.String(100), primary_key=True)
+	tokens = db.Column(db.Float, nullable=False)
+	# Epoch seconds, the bucket is full again and can be dropped after evict_after
+	taken_at = db.Column(db.Float, nullable=False)
+	evict_after = db.Column(db.Float, nullable=False, index=True)
+
+class SeedSlot(db.Model):
+	"""One of the seed generations allowed in flight at once, free when its lease expired"""
+	slot = db.Column(db.Integer, primary_key=True, autoincrement=False)
+	holder = db.Column(db.String(40))
+	expires = db.Column(db.Float, nullable=False)
+
+class QueueTicket(db.Model):
+	"""Player waiting in the matchmaking queue shared by every worker, or matched until the ticket expires"""
+	player_id = db.Column(db.Integer, db.ForeignKey(Player.id), primary_key=True)
+	# Accepted values of each settings field as a JSON object of lists
+	accepted = db.Column(db.Text, nullable=False)
+	# Epoch seconds
+	enqueued_at = db.Column(db.Float, nullable=False)
+	widened = db.Column(db.Integer, nullable=False)
+	widen_at = db.Column(db.Float, index=True)
+	matched_at = db.Column(db.Float, index=True)
+	room_url = db.Column(db.String(100))
+	error = db.Column(db.Text)
+
+class QueueEntry(db.Model):
+	"""A waiting ticket in the bucket of one settings combination it accepts"""
+	# The players of a full bucket are taken in queue order
+	__table_args__ = (db.Index('ix_queue_entry_bucket_order', 'bucket', 'entered_at', 'player_id'),)
+
+	bucket = db.Column(db.String(200), primary_key=True)
+	player_id = db.Column(db.Integer, primary_key=True, index=True)
+	entered_at = db.Column(db.Float, nullable=False)
+
+def format_time(total_seconds) -> str:
+	if total_seconds:
+		hours = total_seconds // 3600
+		minutes = (total_seconds % 3600) // 60
+		seconds = (total_seconds % 3600) % 60
+		return f'{hours:02d}:{minutes:02d}:{seconds:02d}'
+	else:
+		return '-'
 
 def init_db_values():
 	# Create static settings data if it doesnt already exist
@@ -263,3 +377,51 @@ def init_db_values():
 
 		db.create_all()
 		db.session.commit()
+
+	upgrade_schema()
+
+
+def upgrade_schema():
+	"""Add columns and indexes declared on the models that are missing from an existing database"""
+	inspector = inspect(db.engine)
+	existing_tables = inspector.get_table_names()
+	for table in db.metadata.sorted_tables:
+		if table.name not in existing_tables:
+			table.create(db.engine)
+			continue
+		existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+		for column in table.columns:
+			if column.name in existing_columns:
+				continue
+			column_type = column.type.compile(dialect=db.engine.dialect)
+			ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'
+			# Existing rows can only satisfy NOT NULL through a server default
+			if column.server_default is not None:
+				ddl += f" DEFAULT '{column.server_default.arg}'"
+				if not column.nullable:
+					ddl += ' NOT NULL'
+			db.engine.execute(ddl)
+		existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+		for index in table.indexes:
+			if index.name not in existing_indexes:
+				# Rooms created before settings were interned each have their own row
+				if index.name == 'uq_settings_combination':
+					merge_duplicate_settings()
+				index.create(db.engine)
+
+
+def merge_duplicate_settings():
+	"""Point rooms at the lowest id of their settings combination and delete the other rows of it"""
+	def same_combination(alias: str) -> str:
+		return ' AND '.join(f'canonical.{name} = {alias}.{name}' for name in SETTINGS_KEY)
+
+	with db.engine.begin() as connection:
+		connection.execute(f'CREATE INDEX ix_settings_merge ON settings ({", ".join(SETTINGS_KEY)})')
+		connection.execute('UPDATE room SET settings_id = ('
+			f'SELECT MIN(canonical.id) FROM settings duplicate JOIN settings canonical ON {same_combination("duplicate")} '
+			'WHERE duplicate.id = room.settings_id) '
+			f'WHERE EXISTS (SELECT 1 FROM settings duplicate JOIN settings canonical ON {same_combination("duplicate")} '
+			'WHERE duplicate.id = room.settings_id AND canonical.id < duplicate.id)')
+		connection.execute('DELETE FROM settings WHERE EXISTS (SELECT 1 FROM settings canonical '
+			f'WHERE {same_combination("settings")} AND canonical.id < settings.id)')
+		connection.execute('DROP INDEX ix_settings_merge')
@@ -0,0 +1,204 @@
+"""Room update events streamed to browsers
+
+Events are delivered on commit. With Postgres they travel through
+NOTIFY/LISTEN so every worker and dyno receives them, with other databases
+through a channel of the shared state, which only reaches the subscribers
+of the same worker unless STATE_URL is set. A message names the room and
+its version only, a NOTIFY payload must stay below 8000 bytes, and each
+worker with subscribers to the room loads its members once per message.
+
+Each open stream holds a worker thread. A worker serves at most
+SSE_MAX_STREAMS at once and answers further ones 503, the room page then
+polls the API until a stream can be opened again.
+"""
+import json
+from os import environ
+from queue import Empty, Full, Queue
+from select import select
+from threading import BoundedSemaphore, Lock, Thread
+from time import monotonic, sleep
+from flask import Response
+from sqlalchemy import event, text
+from app import app, db
+import metrics
+import queries
+import routing
+import state
+
+# Postgres notification channel, or state channel, shared by all rooms
+CHANNEL = 'room_events'
+
+# Seconds between keepalive comments and before a stream is closed for the client to reconnect
+SSE_KEEPALIVE = float(environ.get('SSE_KEEPALIVE', 15))
+SSE_MAX_DURATION = float(environ.get('SSE_MAX_DURATION', 60))
+
+# Streams open at once in each worker, each holds a worker thread, keep it below the threads of a worker
+SSE_MAX_STREAMS = int(environ.get('SSE_MAX_STREAMS', int(environ.get('GUNICORN_THREADS', 16)) // 2))
+
+# Milliseconds a client turned away by a busy worker polls before it opens a stream again
+SSE_BUSY_RETRY = int(environ.get('SSE_BUSY_RETRY', 15000))
+
+# Events sent with the room's current members
+MEMBER_EVENTS = {'join', 'leave', 'time'}
+
+# Events buffered per subscriber before further events are dropped
+SUBSCRIBER_QUEUE_SIZE = 100
+
+
+class Broker:
+	"""Fan-out of events to the subscribers of each room in this process"""
+
+	def __init__(self):
+		self.subscribers = {}
+		self.lock = Lock()
+
+	def subscribe(self, room: str) -> Queue:
+		subscription = Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+		with self.lock:
+			self.subscribers.setdefault(room, set()).add(subscription)
+		return subscription
+
+	def unsubscribe(self, room: str, subscription: Queue):
+		with self.lock:
+			subscriptions = self.subscribers.get(room)
+			if subscriptions:
+				subscriptions.discard(subscription)
+				if not subscriptions:
+					del self.subscribers[room]
+
+	def subscribed(self, room: str) -> bool:
+		with self.lock:
+			return room in self.subscribers
+
+	def deliver(self, message: dict):
+		with self.lock:
+			subscriptions = list(self.subscribers.get(message['room'], ()))
+		for subscription in subscriptions:
+			try:
+				subscription.put_nowait(message)
+			except Full:
+				pass
+
+
+broker = Broker()
+
+stream_slots = BoundedSemaphore(SSE_MAX_STREAMS)
+
+listener_lock = Lock()
+listening = False
+
+
+def use_notify() -> bool:
+	return db.engine.dialect.name == 'postgresql'
+
+
+def publish(room, event_type: str):
+	"""Send an event to the room's subscribers once the current transaction commits"""
+	# A standby cannot notify
+	routing.use_primary()
+	version = None
+	if event_type in MEMBER_EVENTS:
+		# Room.touch() increments the version in SQL
+		db.session.flush()
+		version = room.version
+	message = {'room': room.hash_code, 'id': room.id, 'version': version, 'type': event_type}
+	if use_notify():
+		db.session.execute(text('SELECT pg_notify(:channel, :payload)'),
+			{'channel': CHANNEL, 'payload': json.dumps(message)})
+	else:
+		db.session().info.setdefault('room_events', []).append(message)
+
+
+@event.listens_for(db.session, 'after_commit')
+def deliver_pending(session):
+	for message in session.info.pop('room_events', ()):
+		state.store.publish(CHANNEL, message)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_pending(session):
+	session.info.pop('room_events', None)
+
+
+def forward(message: dict):
+	"""Deliver a published message to the subscribers of its room in this process, with the room's members"""
+	if not broker.subscribed(message['room']):
+		return
+	data = {'version': message['version']}
+	if message['type'] in MEMBER_EVENTS:
+		# Read outside of any request or session, this may run in a listener thread or within a commit
+		with db.engine.connect() as connection:
+			data['members'] = queries.room_members(message['id'], connection)
+	broker.deliver({'room': message['room'], 'type': message['type'], 'data': data})
+
+
+def listen():
+	"""Forward Postgres notifications to the local broker, reconnecting on errors"""
+	while True:
+		connection = None
+		try:
+			connection = db.engine.raw_connection()
+			connection.detach()
+			connection.connection.autocommit = True
+			cursor = connection.cursor()
+			cursor.execute(f'LISTEN {CHANNEL}')
+			while True:
+				if select([connection.connection], [], [], SSE_KEEPALIVE) == ([], [], []):
+					continue
+				connection.connection.poll()
+				while connection.connection.notifies:
+					notification = connection.connection.notifies.pop(0)
+					forward(json.loads(notification.payload))
+		except Exception:  # pylint: disable=broad-except
+			app.logger.exception('Room event listener failed, reconnecting')
+			if connection is not None:
+				connection.close()
+			sleep(1)
+
+
+def ensure_listener():
+	"""Start forwarding notifications, or messages of the state channel, the first time a stream is opened"""
+	global listening  # pylint: disable=global-statement
+	with listener_lock:
+		if listening:
+			return
+		if use_notify():
+			Thread(target=listen, name='room-events', daemon=True).start()
+		else:
+			state.store.subscribe(CHANNEL, forward)
+		listening = True
+
+
+def open_stream() -> bool:
+	"""Take one of the stream slots of this worker, False when all are taken"""
+	return stream_slots.acquire(blocking=False)
+
+
+def close_stream():
+	stream_slots.release()
+
+
+def busy() -> Response:
+	"""Answer of a worker without a free stream slot, the room page polls instead"""
+	metrics.rate_limited.inc('event_streams')
+	seconds = SSE_BUSY_RETRY // 1000
+	return Response(f'retry: {SSE_BUSY_RETRY}\n\n', 503, {'Retry-After': str(seconds), 'Cache-Control': 'no-cache'},
+		mimetype='text/event-stream')
+
+
+def stream(room: str):
+	"""Server-Sent Events for the room until SSE_MAX_DURATION passes"""
+	ensure_listener()
+	subscription = broker.subscribe(room)
+	try:
+		yield 'retry: 3000\n\n'
+		deadline = monotonic() + SSE_MAX_DURATION
+		while monotonic() < deadline:
+			try:
+				message = subscription.get(timeout=SSE_KEEPALIVE)
+			except Empty:
+				yield ': keepalive\n\n'
+				continue
+			yield f'event: {message["type"]}\ndata: {json.dumps(message["data"])}\n\n'
+	finally:
+		broker.unsubscribe(room, subscription)
@@ -0,0 +1,119 @@
+"""Cache of rendered rooms listing markup
+
+Room cards are cached per room id together with the room version they were
+rendered from, list bodies per page together with the ids and versions of
+their rooms. A stale entry is detected by its version and re-rendered, and
+commits touching a room drop its card right away. Entries are kept in the
+shared state, so with STATE_URL every worker and dyno reuses them.
+"""
+from hashlib import sha1
+from os import environ
+from flask import render_template
+from markupsafe import Markup
+from sqlalchemy import event
+from app import db
+from database import Room, RoomPlayer
+import metrics
+import queries
+import state
+
+FRAGMENT_CACHE_TTL = float(environ.get('FRAGMENT_CACHE_TTL', 3600))
+
+
+class StateBackend:
+	"""Entries in the shared state of state.py, counting the lookups of this process"""
+
+	def __init__(self, store, ttl: float = FRAGMENT_CACHE_TTL):
+		self.store = store
+		self.ttl = ttl
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key: str):
+		value = self.store.get(f'fragment:{key}')
+		if value is None:
+			self.misses += 1
+		else:
+			self.hits += 1
+		return value
+
+	def set(self, key: str, value: str):
+		self.store.set(f'fragment:{key}', value, ttl=self.ttl)
+
+	def delete(self, key: str):
+		self.store.delete(f'fragment:{key}')
+
+	def stats(self) -> dict:
+		lookups = self.hits + self.misses
+		return {'hits': self.hits, 'misses': self.misses, 'hit_ratio': self.hits / lookups if lookups else 0.0}
+
+
+backend = StateBackend(state.store)
+metrics.track_cache('fragments', backend.stats)
+
+
+def get_versioned(key: str, version: str):
+	"""Cached markup if it was stored for this version"""
+	entry = backend.get(key)
+	if entry is None:
+		return None
+	stored_version, _, html = entry.partition('\n')
+	return html if stored_version == version else None
+
+
+def set_versioned(key: str, version: str, html: str):
+	backend.set(key, f'{version}\n{html}')
+
+
+def card_key(room_id: int) -> str:
+	return f'room-card:{room_id}'
+
+
+def render_rooms_page(cursor: str = None) -> (Markup, str):
+	"""List body markup and next cursor of a rooms listing page"""
+	rows = queries.rooms_page_keys_query(cursor).all()
+	page, more = rows[:queries.ROOMS_PER_PAGE], len(rows) > queries.ROOMS_PER_PAGE
+	next_cursor = queries.encode_cursor(page[-1]) if more else None
+
+	body_key = f'rooms-body:{cursor or ""}'
+	body_version = sha1(','.join(f'{row.id}.{row.version}' for row in page).encode()).hexdigest()
+	body = get_versioned(body_key, body_version)
+	if body is not None:
+		return Markup(body), next_cursor
+
+	cards = {row.id: get_versioned(card_key(row.id), str(row.version)) for row in page}
+	missing = [room_id for room_id, card in cards.items() if card is None]
+	if missing:
+		for room_id, listing in queries.load_listings(missing).items():
+			card = render_template('room_card.html', room=listing.room, player_count=listing.player_count)
+			set_versioned(card_key(room_id), str(listing.room.version), card)
+			cards[room_id] = card
+
+	body = ''.join(cards[row.id] or '' for row in page)
+	set_versioned(body_key, body_version, body)
+	return Markup(body), next_cursor
+
+
+def invalidate_room(room_id: int):
+	backend.delete(card_key(room_id))
+
+
+@event.listens_for(db.session, 'after_flush')
+def collect_changed_rooms(session, _flush_context):
+	changed = session.info.setdefault('changed_rooms', set())
+	for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+		if isinstance(instance, Room):
+			changed.add(instance.id)
+		elif isinstance(instance, RoomPlayer):
+			changed.add(instance.room_id)
+
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_changed_rooms(session):
+	for room_id in session.info.pop('changed_rooms', ()):
+		invalidate_room(room_id)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_changed_rooms(session):
+	session.info.pop('changed_rooms', None)
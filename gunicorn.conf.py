@@ -0,0 +1,9 @@
+"""Gunicorn settings, see startup.py"""
+
+# Import the app once in the master, workers are forked with its catalog and compiled templates
+preload_app = True
+
+
+def when_ready(server):  # pylint: disable=unused-argument
+	import startup  # pylint: disable=import-outside-toplevel
+	startup.preload()
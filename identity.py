@@ -0,0 +1,80 @@
+"""Current player resolution from a signed cookie"""
+from collections import namedtuple
+from os import environ
+from flask import g, request
+from itsdangerous import BadSignature, URLSafeSerializer
+from app import app
+from cache import LRUCache
+from database import Player
+import metrics
+
+# Signed cookie carrying [player id, player name]
+PLAYER_COOKIE = 'player'
+
+# Cookie of older versions carrying only the player uuid
+LEGACY_COOKIE = 'uuid'
+
+PLAYER_CACHE_SIZE = int(environ.get('PLAYER_CACHE_SIZE', 10000))
+PLAYER_CACHE_TTL = float(environ.get('PLAYER_CACHE_TTL', 300))
+
+# Detached snapshot of a Player row, safe to share between requests
+CachedPlayer = namedtuple('CachedPlayer', ['id', 'uuid', 'name'])
+
+players = LRUCache(PLAYER_CACHE_SIZE, PLAYER_CACHE_TTL)
+metrics.track_cache('players', players.stats)
+
+
+def serializer() -> URLSafeSerializer:
+	return URLSafeSerializer(app.secret_key, salt='player-identity')
+
+
+def current_player() -> CachedPlayer:
+	"""Player making the request or None, resolved once per request"""
+	if 'player' not in g:
+		g.player = load_player()
+	return g.player
+
+
+def load_player() -> CachedPlayer:
+	try:
+		player_id, name = serializer().loads(request.cookies.get(PLAYER_COOKIE, ''))
+	except (BadSignature, TypeError, ValueError):
+		player_id = name = None
+
+	if player_id is not None:
+		cached = players.get(player_id)
+		# A different name in the cookie means the name changed in another worker
+		if cached and cached.name == name:
+			return cached
+		player = Player.query.get(player_id)
+	else:
+		uuid = request.cookies.get(LEGACY_COOKIE)
+		player = Player.query.filter_by(uuid=uuid).first() if uuid else None
+
+	if not player:
+		return None
+	if player.name != name:
+		g.reissue_player_cookie = True
+	return remember(player)
+
+
+def remember(player: Player) -> CachedPlayer:
+	cached = CachedPlayer(player.id, player.uuid, player.name)
+	players.set(cached.id, cached)
+	return cached
+
+
+def forget(player_id: int):
+	players.delete(player_id)
+
+
+def set_cookie(response, player):
+	response.set_cookie(PLAYER_COOKIE, serializer().dumps([player.id, player.name]), httponly=True)
+
+
+@app.after_request
+def reissue_cookie(response):
+	"""Replace legacy or outdated cookies with a current signed one"""
+	if g.get('reissue_player_cookie') and g.get('player'):
+		set_cookie(response, g.player)
+	return response
@@ -0,0 +1,40 @@
+"""Canonical Settings rows, one per combination of lookups and flags
+
+Rooms with the same settings share a row, so grouping or filtering rooms by
+configuration compares settings_id alone. Ids of combinations already seen
+are kept in process. The first room of a new combination inserts its row in
+a transaction of its own, and when another worker inserts the same
+combination at the same time the unique index makes one of them read the
+other's row instead.
+"""
+from collections import namedtuple
+from sqlalchemy import and_, select
+from sqlalchemy.exc import IntegrityError
+from app import db
+from database import Settings, SETTINGS_KEY
+
+SettingsKey = namedtuple('SettingsKey', SETTINGS_KEY)
+
+# Rows are never deleted, so ids stay valid for the life of the process
+settings_ids = {}
+
+
+def settings_id(key: SettingsKey) -> int:
+	"""Id of the canonical row of a combination, inserted the first time the combination is used"""
+	cached = settings_ids.get(key)
+	if cached is not None:
+		return cached
+
+	table = Settings.__table__
+	query = select([table.c.id]).where(and_(*(table.c[name] == value for name, value in key._asdict().items())))
+	# Committed on its own so a rolled back room cannot take the row with it
+	with db.engine.connect() as connection:
+		row_id = connection.execute(query).scalar()
+		if row_id is None:
+			try:
+				with connection.begin():
+					row_id = connection.execute(table.insert().values(**key._asdict())).inserted_primary_key[0]
+			except IntegrityError:
+				row_id = connection.execute(query).scalar()
+	settings_ids[key] = row_id
+	return row_id
@@ -0,0 +1,254 @@
+"""Leaderboards of finish times per settings category, all time and per week
+
+Boards are pre-aggregated rows updated in the same transaction as the
+posted time: a player's best time, race count and total per board, and a
+histogram of times per board for medians. A posted time updates all rows of
+a table in one INSERT ... ON CONFLICT DO UPDATE statement.
+
+A board is a category of ratings.py, logic, goal and mode, rather than a
+settings combination: its players are ranked in the same category as their
+ratings, and the other settings of a room do not split it into boards too
+small to compare. Reading the top of a board is an
+index range scan. The reaper drops weekly boards once they are older than
+LEADERBOARD_WEEKS, and check() rebuilds every board from the result history
+to report or repair differences.
+"""
+from collections import namedtuple
+from datetime import datetime, timedelta
+from os import environ
+import click
+from sqlalchemy import and_, case, func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.dialects.postgresql.dml import OnConflictDoUpdate
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.elements import _literal_as_binds
+from app import app, db
+from database import Leaderboard, Player, Result, TimeHistogram
+import ratings
+
+# Seconds covered by each histogram bucket, medians are accurate to half of it
+LEADERBOARD_BUCKET = int(environ.get('LEADERBOARD_BUCKET', 10))
+
+# Weekly boards kept before the reaper drops them
+LEADERBOARD_WEEKS = int(environ.get('LEADERBOARD_WEEKS', 12))
+
+PERIOD_ALL = 'all'
+
+# Histogram rows of the whole board rather than of one player
+EVERYONE = 0
+
+Standing = namedtuple('Standing', ['player_id', 'name', 'best_time', 'races', 'mean_time', 'median_time'])
+
+CheckResult = namedtuple('CheckResult', ['missing', 'extra', 'different'])
+
+
+def week_period(race_time: datetime) -> str:
+	"""Monday the race's week starts on"""
+	return (race_time.date() - timedelta(days=race_time.weekday())).isoformat()
+
+
+def current_week() -> str:
+	return week_period(datetime.now())
+
+
+def bucket(time: int) -> int:
+	return time // LEADERBOARD_BUCKET
+
+
+@compiles(OnConflictDoUpdate, 'sqlite')
+def sqlite_on_conflict_do_update(clause, compiler, **kw):  # pylint: disable=unused-argument
+	"""SQLite 3.24 and later take the upsert clause of PostgreSQL, SQLAlchemy only renders it for PostgreSQL"""
+	target = ', '.join(compiler.preparer.quote(column) for column in clause.inferred_target_elements)
+	values = ', '.join(f'{compiler.preparer.quote(name)} = {compiler.process(_literal_as_binds(value).self_group(), use_schema=False)}'
+		for name, value in clause.update_values_to_set)
+	return f'ON CONFLICT ({target}) DO UPDATE SET {values}'
+
+
+def upsert(model, rows: list, update):
+	"""Insert the rows in one statement, updating those whose key exists with update(excluded) instead"""
+	table = model.__table__
+	statement = insert(table).values(rows)
+	db.session.execute(statement.on_conflict_do_update(index_elements=[column.name for column in table.primary_key],
+		set_=update(statement.excluded)))
+
+
+def count_times(category: str, periods: list, player_id: int, changes: list):
+	"""Add (time, amount) changes to the histograms of the boards and of the player on them"""
+	counts = {}
+	for time, amount in changes:
+		for period in periods:
+			for histogram_player in (EVERYONE, player_id):
+				key = (period, histogram_player, bucket(time))
+				counts[key] = counts.get(key, 0) + amount
+	# A statement may not update the same row twice, changes of a bucket are summed first
+	rows = [{'category': category, 'period': period, 'player_id': histogram_player, 'bucket': time_bucket, 'count': count}
+		for (period, histogram_player, time_bucket), count in counts.items() if count]
+	if rows:
+		upsert(TimeHistogram, rows, lambda excluded: {'count': TimeHistogram.count + excluded.count})
+
+
+def best_other_times_query(room_id: int, player_id: int, category: str, week: str):
+	start = datetime.fromisoformat(week)
+	in_week = and_(Result.race_time >= start, Result.race_time < start + timedelta(days=7))
+	return db.session.query(func.min(Result.time), func.min(case([(in_week, Result.time)]))) \
+		.filter(Result.player_id == player_id, Result.category == category, Result.room_id != room_id, Result.time > 0)
+
+
+def best_other_times(room_id: int, player_id: int, category: str, week: str) -> tuple:
+	"""Player's best time of all time and of the week without the given room"""
+	return tuple(best_other_times_query(room_id, player_id, category, week).one())
+
+
+def record_time(room, player_id: int, time: int):
+	"""Add a posted time to the room's boards, or replace the time the player posted before"""
+	result = Result.query.get((room.id, player_id))
+	previous = result.time if result and result.time > 0 else None
+	if time <= 0 or previous == time:
+		return
+	category = ratings.room_category(room.id)
+	periods = [PERIOD_ALL, week_period(room.create_time)]
+	if previous is None:
+		upsert(Leaderboard, [{'category': category, 'period': period, 'player_id': player_id,
+			'best_time': time, 'races': 1, 'total_time': time} for period in periods], lambda excluded: {
+				'races': Leaderboard.races + excluded.races,
+				'total_time': Leaderboard.total_time + excluded.total_time,
+				'best_time': case([(Leaderboard.best_time <= excluded.best_time, Leaderboard.best_time)], else_=excluded.best_time)
+			})
+		count_times(category, periods, player_id, [(time, 1)])
+	else:
+		# The corrected time may have been the best one
+		best_times = [min(time, other) if other else time for other in best_other_times(room.id, player_id, category, periods[1])]
+		Leaderboard.query.filter(Leaderboard.category == category, Leaderboard.period.in_(periods), Leaderboard.player_id == player_id) \
+			.update({
+				'total_time': Leaderboard.total_time + (time - previous),
+				'best_time': case([(Leaderboard.period == period, best) for period, best in zip(periods, best_times)])
+			}, synchronize_session=False)
+		count_times(category, periods, player_id, [(previous, -1), (time, 1)])
+
+
+def top_query(category: str, period: str, limit: int):
+	return db.session.query(Leaderboard.player_id, Player.name, Leaderboard.best_time, Leaderboard.races, Leaderboard.total_time) \
+		.join(Player, Player.id == Leaderboard.player_id) \
+		.filter(Leaderboard.category == category, Leaderboard.period == period) \
+		.order_by(Leaderboard.best_time) \
+		.limit(limit)
+
+
+def top(category: str, period: str = PERIOD_ALL, limit: int = 20) -> list:
+	"""Fastest players of a board"""
+	rows = top_query(category, period, limit).all()
+	medians = player_medians(category, period, [row.player_id for row in rows])
+	return [Standing(player_id, name, best_time, races, total_time // races, medians.get(player_id))
+		for player_id, name, best_time, races, total_time in rows]
+
+
+def histogram_median(counts: list):
+	"""Median of (bucket, count) pairs in bucket order, the mean of both middle times for an even count"""
+	total = sum(count for _, count in counts)
+	if not total:
+		return None
+	# Positions of the middle times from 0, the same one for an odd count
+	positions = [(total - 1) // 2, total // 2]
+	middle = []
+	seen = 0
+	for time_bucket, count in counts:
+		seen += count
+		while positions and positions[0] < seen:
+			positions.pop(0)
+			middle.append(time_bucket * LEADERBOARD_BUCKET + LEADERBOARD_BUCKET // 2)
+	return sum(middle) / 2
+
+
+def histogram_query(category: str, period: str):
+	return db.session.query(TimeHistogram.player_id, TimeHistogram.bucket, TimeHistogram.count) \
+		.filter_by(category=category, period=period) \
+		.filter(TimeHistogram.count > 0) \
+		.order_by(TimeHistogram.player_id, TimeHistogram.bucket)
+
+
+def median_time(category: str, period: str = PERIOD_ALL, player_id: int = EVERYONE):
+	"""Median time of a board, or of one player on it, to the middle of its histogram buckets"""
+	return histogram_median([(time_bucket, count)
+		for _, time_bucket, count in histogram_query(category, period).filter(TimeHistogram.player_id == player_id)])
+
+
+def player_medians(category: str, period: str, player_ids: list) -> dict:
+	"""Median time of each of the players on a board, in one query"""
+	if not player_ids:
+		return {}
+	counts = {}
+	for player_id, time_bucket, count in histogram_query(category, period).filter(TimeHistogram.player_id.in_(player_ids)):
+		counts.setdefault(player_id, []).append((time_bucket, count))
+	return {player_id: histogram_median(player_counts) for player_id, player_counts in counts.items()}
+
+
+def prune(now: datetime) -> int:
+	"""Drop weekly boards older than LEADERBOARD_WEEKS"""
+	oldest = week_period(now - timedelta(weeks=LEADERBOARD_WEEKS))
+	boards = Leaderboard.query.filter(Leaderboard.period != PERIOD_ALL, Leaderboard.period < oldest) \
+		.delete(synchronize_session=False)
+	TimeHistogram.query.filter(TimeHistogram.period != PERIOD_ALL, TimeHistogram.period < oldest) \
+		.delete(synchronize_session=False)
+	return boards
+
+
+def rebuild(oldest: str) -> (dict, dict):
+	"""Board rows and histogram counts aggregated from the results, keyed like their tables"""
+	boards, histograms = {}, {}
+	rows = db.session.query(Result.category, Result.race_time, Result.player_id, Result.time) \
+		.filter(Result.time > 0) \
+		.yield_per(10000)
+	for category, race_time, player_id, time in rows:
+		week = week_period(race_time)
+		for period in (PERIOD_ALL, week) if week >= oldest else (PERIOD_ALL,):
+			best, races, total = boards.get((category, period, player_id), (time, 0, 0))
+			boards[category, period, player_id] = (min(best, time), races + 1, total + time)
+			for histogram_player in (EVERYONE, player_id):
+				key = (category, period, histogram_player, bucket(time))
+				histograms[key] = histograms.get(key, 0) + 1
+	return boards, histograms
+
+
+def diff(expected: dict, actual: dict) -> CheckResult:
+	return CheckResult(
+		missing=sorted(key for key in expected if key not in actual),
+		extra=sorted(key for key in actual if key not in expected),
+		different=sorted(key for key in expected if key in actual and actual[key] != expected[key]))
+
+
+def check(repair: bool = False) -> (CheckResult, CheckResult):
+	"""Compare the boards and histograms with a rebuild from scratch, replacing them with it on repair"""
+	ratings.backfill_results()
+	expected_boards, expected_histograms = rebuild(week_period(datetime.now() - timedelta(weeks=LEADERBOARD_WEEKS)))
+	actual_boards = {(row.category, row.period, row.player_id): (row.best_time, row.races, row.total_time)
+		for row in db.session.query(Leaderboard.category, Leaderboard.period, Leaderboard.player_id,
+			Leaderboard.best_time, Leaderboard.races, Leaderboard.total_time)}
+	actual_histograms = {(row.category, row.period, row.player_id, row.bucket): row.count
+		for row in db.session.query(TimeHistogram.category, TimeHistogram.period, TimeHistogram.player_id,
+			TimeHistogram.bucket, TimeHistogram.count).filter(TimeHistogram.count != 0)}
+	results = diff(expected_boards, actual_boards), diff(expected_histograms, actual_histograms)
+
+	if repair:
+		Leaderboard.query.delete(synchronize_session=False)
+		TimeHistogram.query.delete(synchronize_session=False)
+		db.session.bulk_insert_mappings(Leaderboard, [
+			{'category': category, 'period': period, 'player_id': player_id, 'best_time': best, 'races': races, 'total_time': total}
+			for (category, period, player_id), (best, races, total) in expected_boards.items()])
+		db.session.bulk_insert_mappings(TimeHistogram, [
+			{'category': category, 'period': period, 'player_id': player_id, 'bucket': time_bucket, 'count': count}
+			for (category, period, player_id, time_bucket), count in expected_histograms.items()])
+	db.session.commit()
+	return results
+
+
+@app.cli.command('check-leaderboards')
+@click.option('--repair', is_flag=True, help='Replace the boards with the rebuild.')
+def check_command(repair):
+	"""Rebuild the leaderboards from the results and report differences"""
+	for name, result in zip(('boards', 'histograms'), check(repair)):
+		click.echo(f'{name}: {len(result.missing)} missing, {len(result.extra)} extra, {len(result.different)} different')
+		for label, keys in zip(('missing', 'extra', 'different'), result):
+			for key in keys[:10]:
+				click.echo(f'  {label} {key}')
+	if repair:
+		click.echo('Leaderboards replaced with the rebuild')
@@ -0,0 +1,335 @@
+"""Matchmaking queue of players waiting for a room with compatible settings
+
+Every waiting player holds a ticket with the values they accept for each
+settings field. A ticket is placed in one bucket per complete settings
+combination it accepts, so a bucket holds exactly the players who would
+play that combination together and is full as soon as it reaches the room
+size. Enqueueing, cancelling and matching touch only the ticket's own
+buckets, independent of how many other players are waiting. Tickets that
+wait too long accept any value of one more field at a time, in WIDEN_ORDER.
+
+MatchQueue keeps the queue in the memory of one process, DatabaseQueue
+keeps the tickets and buckets in tables so that players polling different
+workers and dynos are matched with each other.
+"""
+import heapq
+import itertools
+import json
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from os import environ
+from threading import Lock
+from time import monotonic, time
+from sqlalchemy import and_, false, func, select, text
+
+# Settings fields in the order of a bucket key
+FIELDS = ('difficulty', 'goal', 'logic', 'mode', 'variation', 'weapons', 'enemizer', 'spoilers', 'tournament')
+
+# Players put into each matched room
+QUEUE_ROOM_SIZE = int(environ.get('QUEUE_ROOM_SIZE', 2))
+
+# Seconds a ticket waits before it accepts any value of the next field of WIDEN_ORDER
+QUEUE_WIDEN_AFTER = float(environ.get('QUEUE_WIDEN_AFTER', 60))
+
+# Fields relaxed for waiting tickets, least significant to a race first
+WIDEN_ORDER = tuple(environ.get('QUEUE_WIDEN_ORDER', 'spoilers,enemizer,weapons,variation').split(','))
+
+# Settings combinations a single ticket may accept
+QUEUE_MAX_COMBINATIONS = int(environ.get('QUEUE_MAX_COMBINATIONS', 256))
+
+# Key of the Postgres advisory lock serializing changes to the shared queue
+QUEUE_LOCK_KEY = 0x616c7474
+
+# Players of a full bucket and the settings they were matched on, as a dict of FIELDS
+Match = namedtuple('Match', ['settings', 'player_ids'])
+
+
+class Ticket:
+
+	def __init__(self, player_id, accepted: dict, enqueued_at: float):
+		self.player_id = player_id
+		self.accepted = accepted
+		self.enqueued_at = enqueued_at
+		self.keys = []
+		self.widened = 0
+		# Set on the tickets of a DatabaseQueue once they are matched
+		self.matched = False
+		self.url = None
+		self.error = None
+
+
+class MatchQueue:
+
+	def __init__(self, catalog: dict, room_size: int = QUEUE_ROOM_SIZE, widen_after: float = QUEUE_WIDEN_AFTER,
+			widen_order: tuple = WIDEN_ORDER, max_combinations: int = QUEUE_MAX_COMBINATIONS, clock=monotonic):
+		self.catalog = {field: tuple(catalog[field]) for field in FIELDS}
+		self.room_size = room_size
+		self.widen_after = widen_after
+		self.widen_order = [field for field in widen_order if field in FIELDS]
+		self.max_combinations = max_combinations
+		self.clock = clock
+		self.lock = Lock()
+		self.tickets = {}
+		self.buckets = {}
+		# (deadline, sequence, player_id, step) of the next widening of each ticket, stale entries are skipped
+		self.deadlines = []
+		self.sequence = itertools.count()
+
+	def accepted_values(self, accepted: dict) -> dict:
+		"""Accepted values of every field, an empty or missing field accepts anything"""
+		values = {}
+		for field in FIELDS:
+			wanted = accepted.get(field)
+			if wanted is None or (not isinstance(wanted, (str, bool)) and not wanted):
+				values[field] = frozenset(self.catalog[field])
+				continue
+			wanted = frozenset([wanted] if isinstance(wanted, (str, bool)) else wanted)
+			if not wanted <= set(self.catalog[field]):
+				raise ValueError(f'Unknown {field} {sorted(map(str, wanted - set(self.catalog[field])))}')
+			values[field] = wanted
+		return values
+
+	def combinations(self, values: dict) -> int:
+		count = 1
+		for field in FIELDS:
+			count *= len(values[field])
+		return count
+
+	def enqueue(self, player_id, accepted: dict) -> list:
+		"""Queue the player, replacing an earlier ticket, returns the matches this completes"""
+		values = self.accepted_values(accepted)
+		if self.combinations(values) > self.max_combinations:
+			raise ValueError('Too many settings combinations are accepted, choose more specific settings')
+		now = self.clock()
+		with self.lock:
+			self.remove(player_id)
+			ticket = Ticket(player_id, values, now)
+			self.tickets[player_id] = ticket
+			self.schedule(ticket, now)
+			return self.place(ticket, itertools.product(*(sorted(values[field], key=str) for field in FIELDS)))
+
+	def cancel(self, player_id) -> bool:
+		with self.lock:
+			return self.remove(player_id) is not None
+
+	def waiting(self, player_id):
+		"""Ticket of a waiting player or None"""
+		return self.tickets.get(player_id)
+
+	def __len__(self):
+		return len(self.tickets)
+
+	def widen(self) -> list:
+		"""Relax the tickets whose widening deadline passed, returns the matches this completes"""
+		now = self.clock()
+		matches = []
+		with self.lock:
+			while self.deadlines and self.deadlines[0][0] <= now:
+				_, _, player_id, step = heapq.heappop(self.deadlines)
+				ticket = self.tickets.get(player_id)
+				if ticket is None or ticket.widened != step:
+					continue
+				matches += self.widen_ticket(ticket, now)
+		return matches
+
+	def widen_ticket(self, ticket: Ticket, now: float) -> list:
+		"""Accept any value of the next field that keeps the ticket within max_combinations"""
+		ticket.widened, ticket.accepted, keys = self.next_widening(ticket.accepted, ticket.widened)
+		if not keys:
+			return []
+		self.schedule(ticket, now)
+		return self.place(ticket, keys)
+
+	def next_widening(self, accepted: dict, widened: int) -> (int, dict, list):
+		"""Widening step, accepted values and new bucket keys after the next field that can be relaxed"""
+		while widened < len(self.widen_order):
+			field = self.widen_order[widened]
+			widened += 1
+			added = frozenset(self.catalog[field]) - accepted[field]
+			if not added:
+				continue
+			relaxed = dict(accepted, **{field: accepted[field] | added})
+			if self.combinations(relaxed) > self.max_combinations:
+				continue
+			# Only the combinations with one of the newly accepted values are new buckets
+			ranges = [sorted(added, key=str) if name == field else sorted(accepted[name], key=str) for name in FIELDS]
+			return widened, relaxed, list(itertools.product(*ranges))
+		return widened, accepted, []
+
+	def schedule(self, ticket: Ticket, now: float):
+		if ticket.widened < len(self.widen_order):
+			heapq.heappush(self.deadlines, (now + self.widen_after, next(self.sequence), ticket.player_id, ticket.widened))
+
+	def place(self, ticket: Ticket, keys) -> list:
+		"""Add the ticket to the buckets of the keys, matching the first bucket that fills up"""
+		full = None
+		for key in keys:
+			bucket = self.buckets.setdefault(key, OrderedDict())
+			bucket[ticket.player_id] = ticket
+			ticket.keys.append(key)
+			if full is None and len(bucket) >= self.room_size:
+				full = key
+		if full is None:
+			return []
+		# Players enter a bucket one at a time, so a full bucket holds exactly room_size of them
+		players = list(itertools.islice(self.buckets[full], self.room_size))
+		for player_id in players:
+			self.remove(player_id)
+		return [Match(dict(zip(FIELDS, full)), players)]
+
+	def remove(self, player_id) -> Ticket:
+		ticket = self.tickets.pop(player_id, None)
+		if ticket is None:
+			return None
+		for key in ticket.keys:
+			bucket = self.buckets[key]
+			del bucket[player_id]
+			if not bucket:
+				del self.buckets[key]
+		return ticket
+
+
+class DatabaseQueue(MatchQueue):
+	"""Queue in the ticket and bucket tables, shared by every worker
+
+	Changes run in one transaction each, serialized by a lock on the queue,
+	and a ticket outlives its match until expire_after so whichever worker
+	a player polls finds where their room is.
+	"""
+
+	def __init__(self, catalog: dict, database, tickets, entries, expire_after: float = 600, **options):
+		super().__init__(catalog, clock=options.pop('clock', time), **options)
+		self.database = database
+		self.ticket_table = tickets
+		self.entry_table = entries
+		self.expire_after = expire_after
+
+	@contextmanager
+	def locked(self):
+		"""Connection in a transaction holding the queue lock"""
+		with self.database.engine.begin() as connection:
+			if connection.dialect.name == 'postgresql':
+				connection.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': QUEUE_LOCK_KEY})
+			else:
+				# SQLite serializes transactions from their first write on
+				connection.execute(self.ticket_table.update().where(false()).values(widened=0))
+			yield connection
+
+	def enqueue(self, player_id, accepted: dict) -> list:
+		values = self.accepted_values(accepted)
+		if self.combinations(values) > self.max_combinations:
+			raise ValueError('Too many settings combinations are accepted, choose more specific settings')
+		now = self.clock()
+		keys = list(itertools.product(*(sorted(values[field], key=str) for field in FIELDS)))
+		with self.locked() as connection:
+			self.expire(connection, now)
+			self.remove_players(connection, [player_id])
+			connection.execute(self.ticket_table.insert().values(player_id=player_id, accepted=encode_accepted(values),
+				enqueued_at=now, widened=0, widen_at=self.widen_at(0, now)))
+			return self.place_rows(connection, player_id, keys, now)
+
+	def cancel(self, player_id) -> bool:
+		with self.locked() as connection:
+			return self.remove_players(connection, [player_id]) > 0
+
+	def waiting(self, player_id):
+		"""Ticket of a waiting or matched player or None, matched tickets carry the room or error"""
+		with self.database.engine.connect() as connection:
+			row = connection.execute(self.ticket_table.select().where(self.ticket_table.c.player_id == player_id)).first()
+		if row is None or (row.matched_at is not None and row.matched_at + self.expire_after <= self.clock()):
+			return None
+		ticket = Ticket(player_id, decode_accepted(row.accepted), row.enqueued_at)
+		ticket.widened = row.widened
+		ticket.matched = row.matched_at is not None
+		ticket.url = row.room_url
+		ticket.error = row.error
+		return ticket
+
+	def __len__(self):
+		with self.database.engine.connect() as connection:
+			return connection.scalar(select([func.count()]).select_from(self.ticket_table)
+				.where(self.ticket_table.c.matched_at.is_(None)))
+
+	def widen(self) -> list:
+		now = self.clock()
+		with self.database.engine.connect() as connection:
+			due = connection.scalar(select([func.count()]).select_from(self.ticket_table).where(self.ticket_table.c.widen_at <= now))
+		# Polled by every waiting player, most calls find nothing due and take no lock
+		if not due:
+			return []
+		matches = []
+		with self.locked() as connection:
+			rows = connection.execute(self.ticket_table.select().where(self.ticket_table.c.widen_at <= now)
+				.order_by(self.ticket_table.c.widen_at)).fetchall()
+			matched = set()
+			for row in rows:
+				if row.player_id in matched:
+					continue
+				widened, accepted, keys = self.next_widening(decode_accepted(row.accepted), row.widened)
+				connection.execute(self.ticket_table.update().where(self.ticket_table.c.player_id == row.player_id)
+					.values(accepted=encode_accepted(accepted), widened=widened, widen_at=self.widen_at(widened, now) if keys else None))
+				for match in self.place_rows(connection, row.player_id, keys, now):
+					matched.update(match.player_ids)
+					matches.append(match)
+		return matches
+
+	def matched(self, player_ids: list, url: str, error: str):
+		"""Record the room opened for a match, or why it failed"""
+		with self.database.engine.begin() as connection:
+			connection.execute(self.ticket_table.update().where(self.ticket_table.c.player_id.in_(player_ids))
+				.values(room_url=url, error=error))
+
+	def consume(self, player_id) -> bool:
+		"""Drop a matched ticket once the player was sent to its room or told why it failed"""
+		tickets = self.ticket_table
+		with self.database.engine.begin() as connection:
+			return connection.execute(tickets.delete().where(and_(tickets.c.player_id == player_id,
+				tickets.c.matched_at.isnot(None)))).rowcount > 0
+
+	def widen_at(self, widened: int, now: float) -> float:
+		"""When the next widening is due, None once every field of widen_order was relaxed"""
+		return now + self.widen_after if widened < len(self.widen_order) else None
+
+	def place_rows(self, connection, player_id, keys: list, now: float) -> list:
+		"""Add the ticket to the buckets of the keys, matching a bucket that fills up"""
+		if not keys:
+			return []
+		buckets = [encode_key(key) for key in keys]
+		connection.execute(self.entry_table.insert(), [{'bucket': bucket, 'player_id': player_id, 'entered_at': now}
+			for bucket in buckets])
+		# Every bucket was short of room_size before, a full one holds exactly room_size players, this one among them
+		full = connection.execute(select([self.entry_table.c.bucket]).where(self.entry_table.c.bucket.in_(buckets))
+			.group_by(self.entry_table.c.bucket).having(func.count() >= self.room_size)
+			.order_by(self.entry_table.c.bucket).limit(1)).scalar()
+		if full is None:
+			return []
+		players = [player for player, in connection.execute(select([self.entry_table.c.player_id])
+			.where(self.entry_table.c.bucket == full)
+			.order_by(self.entry_table.c.entered_at, self.entry_table.c.player_id).limit(self.room_size))]
+		connection.execute(self.entry_table.delete().where(self.entry_table.c.player_id.in_(players)))
+		connection.execute(self.ticket_table.update().where(self.ticket_table.c.player_id.in_(players))
+			.values(matched_at=now, widen_at=None))
+		return [Match(dict(zip(FIELDS, json.loads(full))), players)]
+
+	def remove_players(self, connection, player_ids: list) -> int:
+		"""Drop the tickets of the players, returns how many were waiting"""
+		connection.execute(self.entry_table.delete().where(self.entry_table.c.player_id.in_(player_ids)))
+		waiting = self.ticket_table.c.player_id.in_(player_ids)
+		removed = connection.execute(self.ticket_table.delete().where(and_(waiting, self.ticket_table.c.matched_at.is_(None)))).rowcount
+		connection.execute(self.ticket_table.delete().where(waiting))
+		return removed
+
+	def expire(self, connection, now: float):
+		connection.execute(self.ticket_table.delete().where(self.ticket_table.c.matched_at <= now - self.expire_after))
+
+
+def encode_key(key: tuple) -> str:
+	return json.dumps(list(key))
+
+
+def encode_accepted(values: dict) -> str:
+	return json.dumps({field: sorted(values[field], key=str) for field in FIELDS})
+
+
+def decode_accepted(accepted: str) -> dict:
+	return {field: frozenset(values) for field, values in json.loads(accepted).items()}
@@ -0,0 +1,271 @@
+"""Request, SQL, seed generation and cache metrics in the Prometheus text format
+
+Each process aggregates its own counters and histograms under a lock. When
+METRICS_DIR is set, every gunicorn worker periodically writes a snapshot to
+a file of that directory and /metrics merges the files of all workers, so
+any worker answers the scrape with the totals of the whole dyno.
+
+/metrics requires METRICS_TOKEN as a bearer token. Without a token it is
+only served outside of Heroku, and answers 404 on a dyno.
+"""
+import atexit
+import json
+import os
+from hmac import compare_digest
+from bisect import bisect_left
+from threading import Lock
+from time import monotonic, perf_counter
+
+# Directory shared by the workers of a dyno, metrics stay per process when unset
+METRICS_DIR = os.environ.get('METRICS_DIR')
+
+# Seconds between snapshots written by each worker
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+
+# Bearer token required to scrape /metrics, open outside of Heroku when unset
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SEED_BUCKETS = (0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Metric:
+	"""Values of one metric keyed by their label values"""
+
+	kind = None
+
+	def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+		self.name = name
+		self.documentation = documentation
+		self.labelnames = labelnames
+		self.values = {}
+		self.lock = Lock()
+
+	def snapshot(self) -> dict:
+		with self.lock:
+			values = [[list(labels), value if self.kind == 'counter' else list(value)] for labels, value in self.values.items()]
+		return {'kind': self.kind, 'documentation': self.documentation, 'labelnames': list(self.labelnames), 'values': values}
+
+
+class Counter(Metric):
+
+	kind = 'counter'
+
+	def inc(self, *labels, amount: float = 1):
+		with self.lock:
+			self.values[labels] = self.values.get(labels, 0) + amount
+
+	def set(self, *labels, value: float):
+		"""Overwrite with a total counted elsewhere, such as a cache's hit count"""
+		with self.lock:
+			self.values[labels] = value
+
+
+class Histogram(Metric):
+	"""Observation counts per bucket followed by their sum and count"""
+
+	kind = 'histogram'
+
+	def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+		super().__init__(name, documentation, labelnames)
+		self.buckets = buckets
+
+	def observe(self, value: float, *labels):
+		index = bisect_left(self.buckets, value)
+		with self.lock:
+			counts = self.values.get(labels)
+			if counts is None:
+				counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+			counts[index] += 1
+			counts[-2] += value
+			counts[-1] += 1
+
+	def snapshot(self) -> dict:
+		snapshot = super().snapshot()
+		snapshot['buckets'] = list(self.buckets)
+		return snapshot
+
+
+class Registry:
+
+	def __init__(self):
+		self.metrics = {}
+		self.caches = {}
+		self.last_flush = monotonic()
+
+	def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+		return self.metrics.setdefault(name, Counter(name, documentation, labelnames))
+
+	def histogram(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+		return self.metrics.setdefault(name, Histogram(name, documentation, labelnames, buckets))
+
+	def track_cache(self, name: str, stats):
+		"""Report the hits and misses of a stats() callable returning them"""
+		self.caches[name] = stats
+
+	def snapshot(self) -> dict:
+		for name, stats in self.caches.items():
+			values = stats()
+			cache_hits.set(name, value=values['hits'])
+			cache_misses.set(name, value=values['misses'])
+		return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+	def flush(self, force: bool = False):
+		"""Write this worker's snapshot to METRICS_DIR at most every METRICS_FLUSH_INTERVAL"""
+		if not METRICS_DIR or (not force and monotonic() - self.last_flush < METRICS_FLUSH_INTERVAL):
+			return
+		self.last_flush = monotonic()
+		path = os.path.join(METRICS_DIR, f'{os.getpid()}.json')
+		with open(f'{path}.tmp', 'w') as snapshot_file:
+			json.dump(self.snapshot(), snapshot_file)
+		os.replace(f'{path}.tmp', path)
+
+	def collect(self) -> dict:
+		"""Snapshot of every worker merged, or of this process alone without METRICS_DIR"""
+		if not METRICS_DIR:
+			return self.snapshot()
+		self.flush(force=True)
+		snapshots = []
+		for filename in os.listdir(METRICS_DIR):
+			if filename.endswith('.json'):
+				try:
+					with open(os.path.join(METRICS_DIR, filename)) as snapshot_file:
+						snapshots.append(json.load(snapshot_file))
+				except (OSError, ValueError):
+					continue
+		return merge(snapshots)
+
+
+def merge(snapshots: list) -> dict:
+	"""Sum counters and histogram buckets with the same labels across snapshots"""
+	merged = {}
+	for snapshot in snapshots:
+		for name, metric in snapshot.items():
+			target = merged.setdefault(name, dict(metric, values={}))
+			for labels, value in metric['values']:
+				key = tuple(labels)
+				if metric['kind'] == 'counter':
+					target['values'][key] = target['values'].get(key, 0) + value
+				else:
+					current = target['values'].get(key, [0] * len(value))
+					target['values'][key] = [a + b for a, b in zip(current, value)]
+	for metric in merged.values():
+		metric['values'] = [[list(labels), value] for labels, value in metric['values'].items()]
+	return merged
+
+
+def escape(value) -> str:
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def label_text(names, values, extra: str = None) -> str:
+	pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+	if extra:
+		pairs.append(extra)
+	return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def render(snapshot: dict) -> str:
+	"""Prometheus text exposition of a snapshot, with hit ratios derived from the cache counters"""
+	lines = []
+	for name, metric in sorted(snapshot.items()):
+		lines.append(f'# HELP {name} {metric["documentation"]}')
+		lines.append(f'# TYPE {name} {metric["kind"]}')
+		names = metric['labelnames']
+		for labels, value in sorted(metric['values']):
+			if metric['kind'] == 'counter':
+				lines.append(f'{name}{label_text(names, labels)} {value}')
+				continue
+			cumulative = 0
+			for bound, count in zip(metric['buckets'] + ['+Inf'], value):
+				cumulative += count
+				bucket = f'le="{bound}"'
+				lines.append(f'{name}_bucket{label_text(names, labels, bucket)} {cumulative}')
+			lines.append(f'{name}_sum{label_text(names, labels)} {value[-2]}')
+			lines.append(f'{name}_count{label_text(names, labels)} {value[-1]}')
+
+	hits = {tuple(labels): value for labels, value in snapshot.get('cache_hits_total', {}).get('values', [])}
+	misses = {tuple(labels): value for labels, value in snapshot.get('cache_misses_total', {}).get('values', [])}
+	if hits:
+		lines.append('# HELP cache_hit_ratio Share of cache lookups that were hits')
+		lines.append('# TYPE cache_hit_ratio gauge')
+		for labels in sorted(hits):
+			lookups = hits[labels] + misses.get(labels, 0)
+			lines.append(f'cache_hit_ratio{label_text(["cache"], labels)} {hits[labels] / lookups if lookups else 0.0}')
+	return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+request_duration = registry.histogram('http_request_duration_seconds', 'Time to produce the response', ('endpoint', 'method'))
+requests_total = registry.counter('http_requests_total', 'Responses sent', ('endpoint', 'method', 'status'))
+request_statements = registry.histogram('http_request_sql_statements', 'SQL statements executed per request', ('endpoint',), STATEMENT_BUCKETS)
+request_sql_duration = registry.histogram('http_request_sql_duration_seconds', 'Time spent in SQL statements per request', ('endpoint',))
+seed_duration = registry.histogram('seed_generation_duration_seconds', 'Duration of alttpr.com seed generation including retries', ('outcome',), SEED_BUCKETS)
+rate_limited = registry.counter('rate_limited_total', 'Requests and seed generations turned away by a limit', ('limit',))
+replica_routing = registry.counter('replica_routing_total', 'Read-only requests by where their reads went and why', ('route',))
+cache_hits = registry.counter('cache_hits_total', 'Cache lookups that found an entry', ('cache',))
+cache_misses = registry.counter('cache_misses_total', 'Cache lookups that found nothing', ('cache',))
+
+track_cache = registry.track_cache
+
+if METRICS_DIR:
+	atexit.register(registry.flush, force=True)
+
+
+def authorized(authorization: str, production: bool) -> bool:
+	"""Whether a scrape sending this Authorization header is answered"""
+	if METRICS_TOKEN:
+		return compare_digest(authorization.encode(), f'Bearer {METRICS_TOKEN}'.encode())
+	return not production
+
+
+def install(app):
+	"""Time every request and count its SQL statements, on the primary and the replicas, through engine events"""
+	from flask import Response, abort, g, has_request_context, request  # pylint: disable=import-outside-toplevel
+	from sqlalchemy import event  # pylint: disable=import-outside-toplevel
+	from sqlalchemy.engine import Engine  # pylint: disable=import-outside-toplevel
+
+	def before_cursor_execute(conn, *_):
+		conn.info.setdefault('query_start', []).append(perf_counter())
+
+	def after_cursor_execute(conn, *_):
+		elapsed = perf_counter() - conn.info['query_start'].pop()
+		if has_request_context():
+			g.sql_statements = g.get('sql_statements', 0) + 1
+			g.sql_seconds = g.get('sql_seconds', 0.0) + elapsed
+
+	event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+	event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+
+	@app.before_request
+	def start_timer():
+		g.request_start = perf_counter()
+
+	@app.after_request
+	def note_status(response):
+		g.response_status = response.status_code
+		return response
+
+	# Also runs after an unhandled exception, whose 500 response may skip the after_request functions
+	@app.teardown_request
+	def record_request(exception):  # pylint: disable=unused-argument
+		if 'request_start' in g:
+			endpoint = request.endpoint or 'unmatched'
+			request_duration.observe(perf_counter() - g.request_start, endpoint, request.method)
+			requests_total.inc(endpoint, request.method, str(g.get('response_status', 500)))
+			request_statements.observe(g.get('sql_statements', 0), endpoint)
+			request_sql_duration.observe(g.get('sql_seconds', 0.0), endpoint)
+			registry.flush()
+
+	# Production runs on Heroku, where the metrics must not be public
+	production = 'DYNO' in os.environ
+	if production and not METRICS_TOKEN:
+		app.logger.warning('METRICS_TOKEN is not set, /metrics is disabled')
+
+	@app.route('/metrics')
+	def metrics():
+		if not authorized(request.headers.get('Authorization', ''), production):
+			abort(404)
+		return Response(render(registry.collect()), mimetype='text/plain; version=0.0.4')
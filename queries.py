@@ -0,0 +1,134 @@
+"""Room listing queries"""
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import and_, func, or_, select, union_all
+from sqlalchemy.orm import contains_eager, joinedload
+from app import db
+from database import Player, Room, RoomPlayer, Settings, ROOM_READY, format_time
+
+ROOMS_PER_PAGE = 30
+
+# A room together with the number of players currently in it
+RoomListing = namedtuple('RoomListing', ['room', 'player_count'])
+
+# One page of the rooms listing, next_cursor is None on the last page
+RoomPage = namedtuple('RoomPage', ['rooms', 'next_cursor'])
+
+
+def encode_cursor(room) -> str:
+	"""Keyset cursor pointing just after the given room or room row"""
+	return f'{room.create_time.isoformat()}_{room.id}'
+
+
+def decode_cursor(cursor: str):
+	"""Returns (create_time, id) or None if the cursor is malformed"""
+	try:
+		create_time, room_id = cursor.rsplit('_', 1)
+		return datetime.fromisoformat(create_time), int(room_id)
+	except (AttributeError, ValueError):
+		return None
+
+
+def load_settings(path):
+	"""Eager loading of a room's settings and their six lookup rows"""
+	return [path.joinedload(Settings.difficulty), path.joinedload(Settings.goal), path.joinedload(Settings.logic),
+		path.joinedload(Settings.mode), path.joinedload(Settings.variation), path.joinedload(Settings.weapons)]
+
+
+def player_count():
+	"""Correlated COUNT of the players in each room, resolved through the room_player primary key"""
+	return db.session.query(func.count(RoomPlayer.player_id)) \
+		.filter(RoomPlayer.room_id == Room.id) \
+		.correlate(Room) \
+		.as_scalar()
+
+
+def room_listing_query():
+	"""Rooms with their settings, lookup rows, creator and player count in one statement"""
+	return db.session.query(Room, player_count()) \
+		.filter(Room.status == ROOM_READY, Room.expire_time > datetime.now()) \
+		.options(joinedload(Room.creator), *load_settings(joinedload(Room.settings)))
+
+
+def after_cursor(query, cursor: str):
+	"""Restrict a listing query to rooms older than the cursor"""
+	after = decode_cursor(cursor) if cursor else None
+	if not after:
+		return query
+	create_time, room_id = after
+	return query.filter(or_(
+		Room.create_time < create_time,
+		and_(Room.create_time == create_time, Room.id < room_id)
+	))
+
+
+def rooms_page_query(cursor: str = None, limit: int = ROOMS_PER_PAGE):
+	"""Newest rooms first after the cursor, one row more than the page size"""
+	query = after_cursor(room_listing_query(), cursor)
+	# The extra row tells whether another page exists
+	return query.order_by(Room.create_time.desc(), Room.id.desc()).limit(limit + 1)
+
+
+def rooms_page_keys_query(cursor: str = None, limit: int = ROOMS_PER_PAGE):
+	"""Only (id, version, create_time) of the rooms on a page, served from the listing index"""
+	query = db.session.query(Room.id, Room.version, Room.create_time) \
+		.filter(Room.status == ROOM_READY, Room.expire_time > datetime.now())
+	query = after_cursor(query, cursor)
+	return query.order_by(Room.create_time.desc(), Room.id.desc()).limit(limit + 1)
+
+
+def list_rooms(cursor: str = None, limit: int = ROOMS_PER_PAGE) -> RoomPage:
+	"""Newest rooms first, paginated by keyset on (create_time, id)"""
+	rows = rooms_page_query(cursor, limit).all()
+
+	rooms = [RoomListing(room, player_count) for room, player_count in rows[:limit]]
+	next_cursor = encode_cursor(rooms[-1].room) if len(rows) > limit else None
+	return RoomPage(rooms, next_cursor)
+
+
+def load_listings(room_ids: list) -> dict:
+	"""RoomListing of each given room by id, in one statement"""
+	rows = room_listing_query().filter(Room.id.in_(room_ids)).all()
+	return {room.id: RoomListing(room, player_count) for room, player_count in rows}
+
+
+def room_view_query(hash_code: str):
+	"""Room with settings, creator and members in one query, members sorted by finish time"""
+	return db.session.query(Room) \
+		.filter(Room.hash_code == hash_code) \
+		.outerjoin(Room.members) \
+		.outerjoin(RoomPlayer.player) \
+		.options(
+			joinedload(Room.creator),
+			contains_eager(Room.members).contains_eager(RoomPlayer.player),
+			*load_settings(joinedload(Room.settings))
+		) \
+		.order_by(RoomPlayer.time.is_(None), RoomPlayer.time, RoomPlayer.player_id)
+
+
+def load_room(hash_code: str) -> Room:
+	# LIMIT would cut off members, the joined rows collapse into a single room
+	rooms = room_view_query(hash_code).all()
+	return rooms[0] if rooms else None
+
+
+def room_members(room_id: int, connection=None) -> list:
+	"""Names and finish times of a room's players, fastest first, read through the session unless a connection is given"""
+	statement = select([Player.name, RoomPlayer.time]) \
+		.select_from(RoomPlayer.__table__.join(Player.__table__, Player.id == RoomPlayer.player_id)) \
+		.where(RoomPlayer.room_id == room_id) \
+		.order_by(RoomPlayer.time.is_(None), RoomPlayer.time, RoomPlayer.player_id)
+	rows = (connection or db.session).execute(statement)
+	return [{'name': name, 'time': format_time(time)} for name, time in rows]
+
+
+def player_rooms_query(player_id: int):
+	"""Ids of the rooms the player created or joined, each side read from its own index"""
+	return union_all(select([Room.id]).where(Room.creator_id == player_id),
+		select([RoomPlayer.room_id]).where(RoomPlayer.player_id == player_id))
+
+
+def touch_player_rooms(player_id: int) -> int:
+	"""Record a change in the rooms the player created or joined, their pages and cards show the player's name"""
+	return Room.query.filter(Room.id.in_(player_rooms_query(player_id))) \
+		.update({'version': Room.version + 1, 'update_time': datetime.now()}, synchronize_session=False)
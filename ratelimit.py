@@ -0,0 +1,235 @@
+"""Rate limits per player and per client IP, and the cap on seed generations in flight
+
+Requests that write are limited by token buckets, one per player and one
+per client IP: a bucket holds up to burst tokens, refills at burst tokens
+per period and each request takes one. A request finding a bucket empty is
+answered 429 with Retry-After. A bucket left alone for a period is full
+again, which is the same as having no bucket, so it is evicted then and
+only keys active within the last period take memory.
+
+Seed generations hold one of SEED_CONCURRENCY slots while they call
+alttpr.com, room creations wait up to SEED_SLOT_WAIT seconds for one and
+pool refills do not wait at all.
+
+RATE_LIMIT_BACKEND chooses where buckets and slots live: 'memory' keeps
+them in the process, so each worker enforces the limits on its own, and
+'database' keeps them in tables so the limits hold across workers.
+"""
+from collections import namedtuple
+from contextlib import contextmanager
+from functools import wraps
+from math import ceil
+from os import environ
+from threading import BoundedSemaphore, Lock
+from time import monotonic, sleep, time
+from uuid import uuid4
+from flask import Response, request
+from sqlalchemy import and_, select
+from sqlalchemy.exc import IntegrityError
+from app import db
+from cache import LRUCache
+from database import RateLimitBucket, SeedSlot
+import alttpr_api
+import identity
+import metrics
+
+RATE_LIMIT_BACKEND = environ.get('RATE_LIMIT_BACKEND', 'memory')
+
+# Buckets kept by the memory backend, the least recently used go first beyond it
+RATE_LIMIT_MAX_KEYS = int(environ.get('RATE_LIMIT_MAX_KEYS', 100000))
+
+# Proxies in front of the app that append the client address to X-Forwarded-For, Heroku's router is one
+RATE_LIMIT_TRUSTED_PROXIES = int(environ.get('RATE_LIMIT_TRUSTED_PROXIES', 1 if 'DYNO' in environ else 0))
+
+# Seed generations in flight at once, across workers with the database backend
+SEED_CONCURRENCY = int(environ.get('SEED_CONCURRENCY', 4))
+
+# Seconds a room creation waits for a slot before its room fails
+SEED_SLOT_WAIT = float(environ.get('SEED_SLOT_WAIT', 30))
+
+# Seconds after which a slot whose holder never released it is free again
+SEED_SLOT_LEASE = float(environ.get('SEED_SLOT_LEASE', 300))
+
+SEED_SLOT_POLL = 0.25
+
+# Requests allowed in a burst and the seconds it takes to earn them all back
+Limit = namedtuple('Limit', ['name', 'burst', 'period'])
+
+
+class SeedCapacityError(Exception):
+	"""No seed generation slot became free in time"""
+
+
+def parse_limit(name: str, default: str) -> Limit:
+	"""Limit from RATE_LIMIT_<NAME> or the default, both written as burst/seconds"""
+	burst, period = environ.get(f'RATE_LIMIT_{name.upper()}', default).split('/')
+	return Limit(name, int(burst), float(period))
+
+
+def refill(tokens: float, taken_at: float, now: float, limit: Limit) -> float:
+	return min(limit.burst, tokens + (now - taken_at) * limit.burst / limit.period)
+
+
+def take_token(tokens: float, limit: Limit) -> (float, float):
+	"""Tokens left after taking one and the seconds to wait when there was none"""
+	if tokens >= 1:
+		return tokens - 1, 0.0
+	return tokens, (1 - tokens) * limit.period / limit.burst
+
+
+class MemoryBackend:
+	"""Buckets and seed slots of this process"""
+
+	def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS, seed_concurrency: int = SEED_CONCURRENCY):
+		self.buckets = LRUCache(max_keys)
+		self.lock = Lock()
+		self.seed_slots = BoundedSemaphore(seed_concurrency)
+
+	def take(self, limit: Limit, key: str, now: float) -> float:
+		with self.lock:
+			tokens, taken_at = self.buckets.get(key, (limit.burst, now))
+			tokens, retry_after = take_token(refill(tokens, taken_at, now, limit), limit)
+			self.buckets.set(key, (tokens, now), ttl=limit.period)
+		return retry_after
+
+	def evict(self, now: float) -> int:  # pylint: disable=unused-argument
+		return self.buckets.expire()
+
+	def acquire_seed_slot(self, wait: float):
+		return True if self.seed_slots.acquire(timeout=wait) else None
+
+	def release_seed_slot(self, token):  # pylint: disable=unused-argument
+		self.seed_slots.release()
+
+
+class DatabaseBackend:
+	"""Buckets and seed slots in tables shared by every worker, each change committed on its own"""
+
+	def __init__(self, seed_concurrency: int = SEED_CONCURRENCY):
+		self.seed_concurrency = seed_concurrency
+		self.slots_created = False
+
+	def take(self, limit: Limit, key: str, now: float) -> float:
+		table = RateLimitBucket.__table__
+		try:
+			with db.engine.begin() as connection:
+				row = connection.execute(select([table.c.tokens, table.c.taken_at])
+					.where(table.c.key == key).with_for_update()).first()
+				tokens = refill(row.tokens, row.taken_at, now, limit) if row else limit.burst
+				tokens, retry_after = take_token(tokens, limit)
+				values = {'tokens': tokens, 'taken_at': now, 'evict_after': now + limit.period}
+				if row:
+					connection.execute(table.update().where(table.c.key == key).values(**values))
+				else:
+					connection.execute(table.insert().values(key=key, **values))
+		except IntegrityError:
+			# Another worker created the bucket first
+			return self.take(limit, key, now)
+		return retry_after
+
+	def evict(self, now: float) -> int:
+		table = RateLimitBucket.__table__
+		return db.engine.execute(table.delete().where(table.c.evict_after < now)).rowcount
+
+	def create_slots(self):
+		table = SeedSlot.__table__
+		existing = {slot for slot, in db.engine.execute(select([table.c.slot]))}
+		for slot in range(self.seed_concurrency):
+			if slot not in existing:
+				try:
+					db.engine.execute(table.insert().values(slot=slot, holder=None, expires=0))
+				except IntegrityError:
+					pass
+		self.slots_created = True
+
+	def acquire_seed_slot(self, wait: float):
+		if not self.slots_created:
+			self.create_slots()
+		table = SeedSlot.__table__
+		holder = uuid4().hex
+		deadline = monotonic() + wait
+		while True:
+			now = time()
+			for slot in range(self.seed_concurrency):
+				claim = table.update().where(and_(table.c.slot == slot, table.c.expires < now)) \
+					.values(holder=holder, expires=now + SEED_SLOT_LEASE)
+				if db.engine.execute(claim).rowcount:
+					return slot, holder
+			if monotonic() >= deadline:
+				return None
+			sleep(SEED_SLOT_POLL)
+
+	def release_seed_slot(self, token):
+		slot, holder = token
+		table = SeedSlot.__table__
+		db.engine.execute(table.update().where(and_(table.c.slot == slot, table.c.holder == holder))
+			.values(holder=None, expires=0))
+
+
+BACKENDS = {
+	'memory': MemoryBackend,
+	'database': DatabaseBackend
+}
+
+backend = BACKENDS[RATE_LIMIT_BACKEND]()
+
+
+def client_ip() -> str:
+	"""Address of the client, as appended to X-Forwarded-For by the trusted proxies"""
+	route = request.access_route
+	if RATE_LIMIT_TRUSTED_PROXIES and len(route) >= RATE_LIMIT_TRUSTED_PROXIES:
+		return route[-RATE_LIMIT_TRUSTED_PROXIES]
+	return request.remote_addr
+
+
+def too_many_requests(retry_after: float) -> Response:
+	seconds = max(1, ceil(retry_after))
+	return Response(f'Too many requests, please try again in {seconds} seconds.', 429,
+		{'Retry-After': str(seconds)}, mimetype='text/plain')
+
+
+def limited(name: str, player: str, ip: str, methods: tuple = ('POST',)):
+	"""Limit a view per player and per client IP, limits are written as burst/seconds"""
+	player_limit = parse_limit(f'{name}_player', player)
+	ip_limit = parse_limit(f'{name}_ip', ip)
+
+	def decorator(view):
+		@wraps(view)
+		def limited_view(*args, **kwargs):
+			if request.method in methods:
+				now = time()
+				buckets = [(ip_limit, f'{name}:ip:{client_ip()}')]
+				current = identity.current_player()
+				if current:
+					buckets.append((player_limit, f'{name}:player:{current.uuid}'))
+				for limit, key in buckets:
+					retry_after = backend.take(limit, key, now)
+					if retry_after:
+						metrics.rate_limited.inc(limit.name)
+						return too_many_requests(retry_after)
+			return view(*args, **kwargs)
+		return limited_view
+	return decorator
+
+
+@contextmanager
+def seed_slot(wait: float = SEED_SLOT_WAIT):
+	token = backend.acquire_seed_slot(wait)
+	if token is None:
+		metrics.rate_limited.inc('seed_concurrency')
+		raise SeedCapacityError(f'No seed generation slot became free within {wait:g} seconds')
+	try:
+		yield
+	finally:
+		backend.release_seed_slot(token)
+
+
+def generate_seed(params: dict, wait: float = SEED_SLOT_WAIT) -> dict:
+	"""alttpr_api.generate_seed holding a seed slot"""
+	with seed_slot(wait):
+		return alttpr_api.generate_seed(params)
+
+
+def evict() -> int:
+	"""Drop the buckets that are full again"""
+	return backend.evict(time())
@@ -0,0 +1,243 @@
+"""Skill ratings of players derived from race results
+
+Every pair of players who finished the same room is a game between them.
+The faster player scores more than half of it, by how much depends on the
+ratio of their times, and a rating moves by the difference between the
+score and the score expected from both ratings, Glicko-style: the
+opponent's deviation dampens the expectation and a player's own deviation,
+which shrinks with each race, sets how far their rating moves.
+
+Each result counts in its settings category and in the overall category.
+Posting a time updates the ratings of the room right away, a recompute
+replays every result in daily rating periods with NumPy, updating all
+players of a period at once.
+"""
+from collections import namedtuple
+from datetime import datetime
+from os import environ
+from time import perf_counter
+import click
+import numpy as np
+from sqlalchemy import and_, exists
+from app import app, db
+from database import Rating, Result, Room, RoomPlayer, Settings, Goal, Logic, Mode
+
+RATING_INITIAL = 1500.0
+DEVIATION_INITIAL = 350.0
+DEVIATION_MIN = 60.0
+
+# Deviation kept after each race
+DEVIATION_DECAY = float(environ.get('RATING_DEVIATION_DECAY', 0.9))
+
+# Rating change per unit of surprise for the most and the least certain ratings
+K_MAX = float(environ.get('RATING_K_MAX', 64))
+K_MIN = float(environ.get('RATING_K_MIN', 12))
+
+# How strongly the ratio of two finish times decides their game, higher approaches win or lose
+GAP_EXPONENT = float(environ.get('RATING_GAP_EXPONENT', 8))
+
+# Seconds of history replayed at once by a recompute
+RATING_PERIOD = int(environ.get('RATING_PERIOD', 86400))
+
+# Category every result also counts in
+OVERALL = 'all'
+
+Q = np.log(10) / 400
+
+RecomputeResult = namedtuple('RecomputeResult', ['results', 'pairs', 'ratings', 'seconds'])
+
+
+def category_name(logic: str, goal: str, mode: str) -> str:
+	return f'{logic}/{goal}/{mode}'
+
+
+def room_category(room_id: int) -> str:
+	logic, goal, mode = db.session.query(Logic.name, Goal.name, Mode.name) \
+		.select_from(Room) \
+		.join(Settings, Settings.id == Room.settings_id) \
+		.join(Logic, Logic.id == Settings.logic_id) \
+		.join(Goal, Goal.id == Settings.goal_id) \
+		.join(Mode, Mode.id == Settings.mode_id) \
+		.filter(Room.id == room_id) \
+		.one()
+	return category_name(logic, goal, mode)
+
+
+def dampening(deviation):
+	"""Glicko g(), the less certain a rating the less a game against it is expected to go its way"""
+	return 1 / np.sqrt(1 + 3 * Q ** 2 * deviation ** 2 / np.pi ** 2)
+
+
+def finish_scores(first_times, second_times):
+	"""Share of each game won by the first player, one half for equal times"""
+	return 1 / (1 + (first_times / second_times) ** GAP_EXPONENT)
+
+
+def k_factor(deviation):
+	return K_MIN + (K_MAX - K_MIN) * (deviation - DEVIATION_MIN) / (DEVIATION_INITIAL - DEVIATION_MIN)
+
+
+def pair_changes(first_ratings, first_deviations, second_ratings, second_deviations, scores, weights):
+	"""Surprise of each game for both of its players, before scaling by their k factor"""
+	first_expected = 1 / (1 + 10 ** (-dampening(second_deviations) * (first_ratings - second_ratings) / 400))
+	second_expected = 1 / (1 + 10 ** (-dampening(first_deviations) * (second_ratings - first_ratings) / 400))
+	return (weights * dampening(second_deviations) * (scores - first_expected),
+		weights * dampening(first_deviations) * ((1 - scores) - second_expected))
+
+
+def compute(room_ids, player_ids, category_ids, periods, times, overall_id: int):
+	"""Ratings from result arrays, returns player_ids, category_ids, ratings, deviations and races per rated slot and the pair count
+
+	All arrays have one entry per result. Results of a room are compared with
+	each other, rooms of earlier periods are replayed first.
+	"""
+	category_count = int(max(category_ids.max(), overall_id)) + 1
+	# Each result counts once in its category and once overall, as separate rooms
+	rooms = np.concatenate([room_ids.astype(np.int64) * 2, room_ids.astype(np.int64) * 2 + 1])
+	slot_keys = np.concatenate([player_ids.astype(np.int64) * category_count + category_ids,
+		player_ids.astype(np.int64) * category_count + overall_id])
+	periods = np.tile(periods, 2)
+	times = np.tile(times, 2).astype(np.float64)
+	keys, slots = np.unique(slot_keys, return_inverse=True)
+
+	order = np.argsort(rooms, kind='mergesort')
+	rooms, slots, periods, times = rooms[order], slots[order], periods[order], times[order]
+	_, counts = np.unique(rooms, return_counts=True)
+	finishers = np.repeat(counts, counts)
+
+	# Every pair of results in a room, rows of a room are adjacent
+	firsts, seconds = [], []
+	for offset in range(1, int(counts.max())):
+		same = np.nonzero(rooms[offset:] == rooms[:-offset])[0]
+		firsts.append(same)
+		seconds.append(same + offset)
+	first = np.concatenate(firsts) if firsts else np.zeros(0, dtype=np.int64)
+	second = np.concatenate(seconds) if seconds else np.zeros(0, dtype=np.int64)
+	scores = finish_scores(times[first], times[second])
+	# A room counts as one game per player however many others finished it
+	weights = 1 / (finishers[first] - 1)
+
+	pair_order = np.argsort(periods[first], kind='mergesort')
+	first, second, scores, weights = first[pair_order], second[pair_order], scores[pair_order], weights[pair_order]
+	pair_periods = periods[first]
+	row_order = np.argsort(periods, kind='mergesort')
+	row_periods = periods[row_order]
+
+	ratings = np.full(len(keys), RATING_INITIAL)
+	deviations = np.full(len(keys), DEVIATION_INITIAL)
+	for period in np.unique(periods):
+		# Only the slots racing in the period are touched
+		start, end = np.searchsorted(row_periods, [period, period + 1])
+		touched, racing = np.unique(slots[row_order[start:end]], return_inverse=True)
+		start, end = np.searchsorted(pair_periods, [period, period + 1])
+		if end > start:
+			a, b = slots[first[start:end]], slots[second[start:end]]
+			first_changes, second_changes = pair_changes(ratings[a], deviations[a], ratings[b], deviations[b],
+				scores[start:end], weights[start:end])
+			surprise = np.bincount(np.searchsorted(touched, a), first_changes, len(touched)) \
+				+ np.bincount(np.searchsorted(touched, b), second_changes, len(touched))
+			ratings[touched] += k_factor(deviations[touched]) * surprise
+		races = np.bincount(racing, minlength=len(touched))
+		deviations[touched] = np.maximum(DEVIATION_MIN, deviations[touched] * DEVIATION_DECAY ** races)
+
+	races = np.bincount(slots, minlength=len(keys))
+	return keys // category_count, keys % category_count, ratings, deviations, races, len(first)
+
+
+def record_result(room: Room, player_id: int, time: int):
+	"""Store a posted time and rate it against the room's other finishers, corrections wait for a recompute"""
+	result = Result.query.get((room.id, player_id))
+	if result:
+		result.time = time
+		return
+
+	category = room_category(room.id)
+	opponents = db.session.query(Result.player_id, Result.time).filter(Result.room_id == room.id).all()
+	db.session.add(Result(room_id=room.id, player_id=player_id, category=category, race_time=room.create_time, time=time))
+	if time <= 0:
+		return
+	opponents = [(opponent_id, opponent_time) for opponent_id, opponent_time in opponents if opponent_time > 0]
+
+	player_ids = [player_id] + [opponent_id for opponent_id, _ in opponents]
+	rows = {(row.player_id, row.category): row for row in Rating.query
+		.filter(Rating.player_id.in_(player_ids), Rating.category.in_([category, OVERALL]))
+		.with_for_update()}
+	now = datetime.now()
+	scores = finish_scores(float(time), np.array([opponent_time for _, opponent_time in opponents], dtype=np.float64))
+	weights = np.full(len(opponents), 1 / max(1, len(opponents)))
+
+	for name in (category, OVERALL):
+		slots = []
+		for slot_player in player_ids:
+			row = rows.get((slot_player, name))
+			if row is None:
+				row = Rating(player_id=slot_player, category=name, rating=RATING_INITIAL, deviation=DEVIATION_INITIAL, races=0)
+				db.session.add(row)
+			slots.append(row)
+		player, others = slots[0], slots[1:]
+		if others:
+			other_ratings = np.array([row.rating for row in others])
+			other_deviations = np.array([row.deviation for row in others])
+			player_changes, other_changes = pair_changes(player.rating, player.deviation, other_ratings, other_deviations, scores, weights)
+			player.rating = float(player.rating + k_factor(player.deviation) * player_changes.sum())
+			for row, change in zip(others, other_changes):
+				row.rating = float(row.rating + k_factor(row.deviation) * change)
+				row.update_time = now
+		player.deviation = max(DEVIATION_MIN, player.deviation * DEVIATION_DECAY)
+		player.races += 1
+		player.update_time = now
+
+
+def backfill_results() -> int:
+	"""Copy finish times of rooms still in the database that have no result yet"""
+	missing = db.session.query(RoomPlayer.room_id, RoomPlayer.player_id, RoomPlayer.time, Room.create_time,
+		Logic.name, Goal.name, Mode.name) \
+		.join(Room, Room.id == RoomPlayer.room_id) \
+		.join(Settings, Settings.id == Room.settings_id) \
+		.join(Logic, Logic.id == Settings.logic_id) \
+		.join(Goal, Goal.id == Settings.goal_id) \
+		.join(Mode, Mode.id == Settings.mode_id) \
+		.filter(RoomPlayer.time.isnot(None)) \
+		.filter(~exists().where(and_(Result.room_id == RoomPlayer.room_id, Result.player_id == RoomPlayer.player_id))) \
+		.all()
+	db.session.bulk_insert_mappings(Result, [{
+		'room_id': room_id, 'player_id': player_id, 'time': time, 'race_time': race_time,
+		'category': category_name(logic, goal, mode)
+	} for room_id, player_id, time, race_time, logic, goal, mode in missing])
+	return len(missing)
+
+
+def recompute() -> RecomputeResult:
+	"""Replace every rating with one replayed from the complete result history"""
+	start = perf_counter()
+	backfill_results()
+	rows = db.session.query(Result.room_id, Result.player_id, Result.category, Result.race_time, Result.time) \
+		.filter(Result.time > 0) \
+		.all()
+	Rating.query.delete(synchronize_session=False)
+	if not rows:
+		db.session.commit()
+		return RecomputeResult(0, 0, 0, perf_counter() - start)
+
+	room_ids, player_ids, category_names, race_times, times = zip(*rows)
+	names, category_ids = np.unique(np.array((OVERALL,) + category_names), return_inverse=True)
+	overall_id, category_ids = category_ids[0], category_ids[1:]
+	epoch = datetime(1970, 1, 1)
+	periods = np.array([int((race_time - epoch).total_seconds()) // RATING_PERIOD for race_time in race_times])
+
+	slot_players, slot_categories, ratings, deviations, races, pairs = compute(
+		np.array(room_ids), np.array(player_ids), category_ids, periods, np.array(times), overall_id)
+	now = datetime.now()
+	db.session.execute(Rating.__table__.insert(), [{
+		'player_id': int(player_id), 'category': names[category_id], 'rating': float(rating),
+		'deviation': float(deviation), 'races': int(count), 'update_time': now
+	} for player_id, category_id, rating, deviation, count in zip(slot_players, slot_categories, ratings, deviations, races)])
+	db.session.commit()
+	return RecomputeResult(len(rows), pairs, len(ratings), perf_counter() - start)
+
+
+@app.cli.command('recompute-ratings')
+def recompute_command():
+	"""Replay every result and replace all ratings"""
+	result = recompute()
+	click.echo(f'Rated {result.results} results in {result.pairs} pairs into {result.ratings} ratings ({result.seconds:.3f}s)')
@@ -0,0 +1,121 @@
+"""Removal of expired rooms, and of pending rooms whose seed job was lost
+
+Every worker runs the reaper thread, on PostgreSQL a session advisory lock
+lets one of them sweep at a time and the others skip their turn.
+"""
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+from os import environ
+from threading import Event, Thread
+from time import perf_counter
+import click
+from sqlalchemy import func, select
+from app import app, db
+from database import Room, RoomPlayer
+import leaderboards
+import ratelimit
+import seed_jobs
+
+# Rooms deleted per transaction
+REAPER_BATCH_SIZE = int(environ.get('REAPER_BATCH_SIZE', 500))
+
+# Seconds between sweeps of the in-process reaper, 0 disables it
+REAPER_INTERVAL = float(environ.get('REAPER_INTERVAL', 600))
+
+# Advisory lock held while a process sweeps
+REAPER_LOCK_KEY = 0x72656170
+
+SweepResult = namedtuple('SweepResult', ['rooms', 'room_players', 'batches', 'seconds'])
+
+stop_event = Event()
+
+
+def reap_batch(now: datetime, batch_size: int) -> (int, int):
+	"""Delete one batch of expired rooms with their players, settings rows are shared and stay"""
+	expired = db.session.query(Room.id) \
+		.filter(Room.expire_time < now) \
+		.order_by(Room.expire_time) \
+		.limit(batch_size).all()
+	if not expired:
+		return 0, 0
+
+	room_ids = [room_id for room_id, in expired]
+
+	room_players = RoomPlayer.query.filter(RoomPlayer.room_id.in_(room_ids)).delete(synchronize_session=False)
+	rooms = Room.query.filter(Room.id.in_(room_ids)).delete(synchronize_session=False)
+	db.session.commit()
+	return rooms, room_players
+
+
+def sweep(batch_size: int = REAPER_BATCH_SIZE) -> SweepResult:
+	"""Delete every room expired at the start of the sweep, batch by batch"""
+	start = perf_counter()
+	now = datetime.now()
+	rooms = room_players = batches = 0
+	while True:
+		batch_rooms, batch_room_players = reap_batch(now, batch_size)
+		if not batch_rooms:
+			break
+		rooms += batch_rooms
+		room_players += batch_room_players
+		batches += 1
+	# Weekly leaderboards age out with the rooms
+	leaderboards.prune(now)
+	stale = seed_jobs.fail_stale(now)
+	db.session.commit()
+	if stale:
+		app.logger.warning('Reaper failed %d rooms whose seed job was lost', stale)
+	ratelimit.evict()
+	result = SweepResult(rooms, room_players, batches, perf_counter() - start)
+	app.logger.info('Reaper removed %d rooms and %d room players in %d batches (%.3fs)', *result)
+	return result
+
+
+@contextmanager
+def sweep_lock():
+	"""Yield whether this process may sweep now, False while another one sweeps"""
+	if db.engine.dialect.name != 'postgresql':
+		yield True
+		return
+	# Held by a connection of its own, the sweep commits batch by batch
+	with db.engine.connect() as connection:
+		locked = connection.scalar(select([func.pg_try_advisory_lock(REAPER_LOCK_KEY)]))
+		try:
+			yield locked
+		finally:
+			if locked:
+				connection.scalar(select([func.pg_advisory_unlock(REAPER_LOCK_KEY)]))
+
+
+def sweep_unless_busy() -> SweepResult:
+	"""Sweep unless another process is sweeping, None when it is"""
+	with sweep_lock() as locked:
+		return sweep() if locked else None
+
+
+def run(interval: float):
+	while not stop_event.wait(interval):
+		try:
+			with app.app_context():
+				sweep_unless_busy()
+		except Exception:  # pylint: disable=broad-except
+			app.logger.exception('Reaper sweep failed')
+
+
+def start(interval: float = REAPER_INTERVAL):
+	"""Run sweeps in a daemon thread every interval seconds"""
+	if interval <= 0:
+		return None
+	thread = Thread(target=run, args=(interval,), name='reaper', daemon=True)
+	thread.start()
+	return thread
+
+
+@app.cli.command('reap')
+@click.option('--batch-size', default=REAPER_BATCH_SIZE, help='Rooms deleted per transaction.')
+def reap_command(batch_size):
+	"""Delete expired rooms once"""
+	result = sweep(batch_size)
+	click.echo(f'Removed {result.rooms} rooms and {result.room_players} room players '
+		f'in {result.batches} batches ({result.seconds:.3f}s)')
@@ -0,0 +1,186 @@
+"""Reads of read-only views served by database replicas
+
+DATABASE_REPLICA_URLS lists replicas of the primary, separated by commas.
+Views decorated with replica_reads run their queries on one healthy
+replica. Other views, flushes and INSERT/UPDATE/DELETE statements always
+use the primary. A request that writes reads from the primary from
+then on, and a client that wrote is sent to the primary for
+REPLICA_STICKY_SECONDS, longer than a healthy replica lags behind, so it
+reads its own writes. Views looking up a room read it again from the
+primary when the replica does not have it, rooms are also created by
+other clients and by background jobs. Replicas are checked every REPLICA_CHECK_INTERVAL
+seconds, one that fails or lags more than REPLICA_MAX_LAG seconds is left
+out until a check passes again, and without any the primary serves all.
+A view whose replica fails is left out the same way and runs again on the
+primary.
+
+This module is imported before the app is created, it must not import it.
+"""
+import random
+from functools import wraps
+from os import environ
+from threading import Event, Thread
+from time import time
+from flask import current_app, g, has_request_context, session as client_session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, event, orm, text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import DBAPIError, SQLAlchemyError
+from sqlalchemy.sql.dml import UpdateBase
+import metrics
+
+REPLICA_URLS = [url.strip() for url in environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+
+# Connections kept open per worker to each replica, and opened beyond them at peak
+REPLICA_POOL_SIZE = int(environ.get('DATABASE_REPLICA_POOL_SIZE', 5))
+REPLICA_MAX_OVERFLOW = int(environ.get('DATABASE_REPLICA_MAX_OVERFLOW', 10))
+
+REPLICA_CHECK_INTERVAL = float(environ.get('REPLICA_CHECK_INTERVAL', 5))
+REPLICA_MAX_LAG = float(environ.get('REPLICA_MAX_LAG', 10))
+
+# A replica lags at most REPLICA_MAX_LAG seconds as of its last check
+REPLICA_STICKY_SECONDS = float(environ.get('REPLICA_STICKY_SECONDS', REPLICA_MAX_LAG + REPLICA_CHECK_INTERVAL))
+
+# Seconds behind the primary, 0 when the replica replayed everything it received or is not a standby
+POSTGRES_LAG = text(
+	'SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+	'ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END'
+)
+
+stop_event = Event()
+
+
+def engine_options(url: str, pool_size: int, max_overflow: int) -> dict:
+	# SQLite opens a connection per use, pools do not apply
+	if make_url(url).drivername.startswith('sqlite'):
+		return {}
+	return {'pool_size': pool_size, 'max_overflow': max_overflow, 'pool_pre_ping': True}
+
+
+class Replica:
+	"""Engine of one replica and the outcome of its last check"""
+
+	def __init__(self, name: str, url: str):
+		self.name = name
+		self.engine = create_engine(url, **engine_options(url, REPLICA_POOL_SIZE, REPLICA_MAX_OVERFLOW))
+		self.healthy = True
+		self.lag = None
+		event.listen(self.engine, 'handle_error', self.handle_error)
+
+	def check(self) -> bool:
+		try:
+			with self.engine.connect() as connection:
+				lag = connection.scalar(POSTGRES_LAG) if self.engine.dialect.name == 'postgresql' else 0
+			self.lag = float(lag or 0)
+			self.healthy = self.lag <= REPLICA_MAX_LAG
+		except SQLAlchemyError:
+			self.lag = None
+			self.healthy = False
+		return self.healthy
+
+	def handle_error(self, context):
+		# A lost or refused connection takes the replica out of rotation until the next check passes
+		if context.is_disconnect or context.connection is None:
+			self.healthy = False
+
+
+replicas = [Replica(f'replica{index}', url) for index, url in enumerate(REPLICA_URLS)]
+
+
+class RoutingSession(SignallingSession):
+	"""Session running the reads of replica_reads views on the replica chosen for the request"""
+
+	def get_bind(self, mapper=None, clause=None):
+		if self._flushing or isinstance(clause, UpdateBase):
+			self.info['wrote'] = True
+			use_primary()
+		elif has_request_context() and g.get('replica'):
+			return g.replica.engine
+		return super().get_bind(mapper, clause)
+
+
+def stick_to_primary(session):
+	if session.info.pop('wrote', False) and replicas and has_request_context():
+		client_session['_primary_until'] = time() + REPLICA_STICKY_SECONDS
+
+
+def forget_writes(session):
+	session.info.pop('wrote', None)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+	def create_session(self, options):
+		factory = orm.sessionmaker(class_=RoutingSession, db=self, **options)
+		event.listen(factory, 'after_commit', stick_to_primary)
+		event.listen(factory, 'after_rollback', forget_writes)
+		return factory
+
+
+def choose_replica() -> Replica:
+	"""Replica for the reads of the current request, or None for the primary"""
+	if not replicas:
+		return None
+	if client_session.get('_primary_until', 0) > time():
+		metrics.replica_routing.inc('sticky')
+		return None
+	healthy = [replica for replica in replicas if replica.healthy]
+	if not healthy:
+		metrics.replica_routing.inc('unavailable')
+		return None
+	metrics.replica_routing.inc('replica')
+	return random.choice(healthy)
+
+
+def read_from_replica():
+	"""Run the rest of the request's reads on a replica when one can serve them"""
+	g.replica = choose_replica()
+
+
+def replica_reads(view):
+	"""Run the queries of a view that does not write on a replica, again on the primary should the replica fail"""
+	@wraps(view)
+	def replica_view(*args, **kwargs):
+		read_from_replica()
+		try:
+			return view(*args, **kwargs)
+		except DBAPIError:
+			replica = g.get('replica')
+			# Once the view switched to the primary, errors are its own
+			if replica is None:
+				raise
+			current_app.logger.warning('Replica %s failed, reading from the primary', replica.name, exc_info=True)
+			replica.healthy = False
+			metrics.replica_routing.inc('failover')
+			current_app.extensions['sqlalchemy'].db.session.rollback()
+			use_primary()
+			return view(*args, **kwargs)
+	return replica_view
+
+
+def use_primary() -> bool:
+	"""Run the rest of the request's queries on the primary, True when they ran on a replica so far"""
+	if not has_request_context() or not g.get('replica'):
+		return False
+	g.replica = None
+	return True
+
+
+def check_replicas():
+	for replica in replicas:
+		replica.check()
+
+
+def run(interval: float):
+	check_replicas()
+	while not stop_event.wait(interval):
+		check_replicas()
+
+
+def start(interval: float = REPLICA_CHECK_INTERVAL):
+	"""Check the replicas in a daemon thread every interval seconds"""
+	if not replicas or interval <= 0:
+		return None
+	thread = Thread(target=run, args=(interval,), name='replica-checks', daemon=True)
+	thread.start()
+	return thread
@@ -0,0 +1,68 @@
+"""Background seed generation
+
+Jobs run in a thread pool of the process that created the room. A room
+left pending by a process that stopped, such as on a restart or deploy,
+is failed by the reaper once SEED_JOB_TIMEOUT has passed, the pending page
+then tells its players to try again.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from os import environ
+from threading import BoundedSemaphore
+from app import app, db
+from database import Room, ROOM_FAILED, ROOM_PENDING
+import chat
+import ratelimit
+
+# Number of seeds generated concurrently
+SEED_WORKERS = int(environ.get('SEED_WORKERS', 4))
+
+# Maximum number of seed jobs running or waiting for a worker
+SEED_QUEUE_LIMIT = int(environ.get('SEED_QUEUE_LIMIT', 32))
+
+# Seconds after which a pending room's job is considered lost, longer than a job waits and retries
+SEED_JOB_TIMEOUT = float(environ.get('SEED_JOB_TIMEOUT', 900))
+
+executor = ThreadPoolExecutor(max_workers=SEED_WORKERS, thread_name_prefix='seed')
+slots = BoundedSemaphore(SEED_QUEUE_LIMIT)
+
+
+def submit(room: Room, params: dict) -> bool:
+	"""Queue seed generation for a pending room, False if the queue is full"""
+	if not slots.acquire(blocking=False):
+		return False
+	try:
+		executor.submit(run_job, room.id, params)
+	except RuntimeError:
+		slots.release()
+		return False
+	return True
+
+
+def run_job(room_id: int, params: dict):
+	"""Generate the seed and fill in the room, marking it failed on error"""
+	try:
+		with app.app_context():
+			room = Room.query.get(room_id)
+			if not room:
+				return
+			try:
+				seed = ratelimit.generate_seed(params)
+				hash_code = seed['hash']
+			except Exception:  # pylint: disable=broad-except
+				app.logger.exception('Seed generation failed for room %s', room_id)
+				room.status = ROOM_FAILED
+			else:
+				room.set_seed(hash_code, chat.get_chat_room(hash_code))
+			db.session.commit()
+	finally:
+		slots.release()
+
+
+def stale_rooms_query(now: datetime):
+	return Room.query.filter(Room.status == ROOM_PENDING, Room.create_time < now - timedelta(seconds=SEED_JOB_TIMEOUT))
+
+
+def fail_stale(now: datetime) -> int:
+	"""Mark rooms pending for longer than SEED_JOB_TIMEOUT failed, their job went away with its process"""
+	return stale_rooms_query(now).update({'status': ROOM_FAILED}, synchronize_session=False)
@@ -0,0 +1,128 @@
+"""Pre-generated seeds for popular settings combinations"""
+from collections import deque
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil, exp, log
+from os import environ
+from threading import Lock
+from time import monotonic
+import alttpr_api
+import metrics
+import ratelimit
+
+# Decayed demand a combination needs before seeds are kept ready for it
+POOL_HOT_THRESHOLD = float(environ.get('SEED_POOL_HOT_THRESHOLD', 3))
+
+# Ready seeds kept per unit of decayed demand, capped at POOL_MAX_SIZE
+POOL_SIZE_FACTOR = float(environ.get('SEED_POOL_SIZE_FACTOR', 0.5))
+POOL_MAX_SIZE = int(environ.get('SEED_POOL_MAX_SIZE', 5))
+
+# Demand halves every POOL_DEMAND_HALF_LIFE seconds
+POOL_DEMAND_HALF_LIFE = float(environ.get('SEED_POOL_DEMAND_HALF_LIFE', 3600))
+
+# Number of seeds generated concurrently to refill the pool
+POOL_REFILL_WORKERS = int(environ.get('SEED_POOL_REFILL_WORKERS', 1))
+
+
+def settings_key(params: dict) -> tuple:
+	"""Canonical hashable key of Settings.to_dict() parameters"""
+	return tuple(sorted(params.items()))
+
+
+class SeedPool:
+
+	def __init__(self, generate=alttpr_api.generate_seed, hot_threshold=POOL_HOT_THRESHOLD,
+			size_factor=POOL_SIZE_FACTOR, max_size=POOL_MAX_SIZE,
+			half_life=POOL_DEMAND_HALF_LIFE, refill_workers=POOL_REFILL_WORKERS):
+		self.generate = generate
+		self.hot_threshold = hot_threshold
+		self.size_factor = size_factor
+		self.max_size = max_size
+		self.decay_rate = log(2) / half_life
+		self.executor = ThreadPoolExecutor(max_workers=refill_workers, thread_name_prefix='seed-pool')
+		self.lock = Lock()
+		self.seeds = {}
+		self.demand = {}
+		self.refilling = set()
+		self.hits = 0
+		self.misses = 0
+		self.refill_errors = 0
+
+	def take(self, params: dict):
+		"""Ready seed for the settings or None, recording demand and refilling in the background"""
+		key = settings_key(params)
+		with self.lock:
+			self.record_demand(key)
+			ready = self.seeds.get(key)
+			seed = ready.popleft() if ready else None
+			if seed:
+				self.hits += 1
+			else:
+				self.misses += 1
+			refill = self.needs_refill(key)
+			if refill:
+				self.refilling.add(key)
+		if refill:
+			self.executor.submit(self.refill, key, dict(params))
+		return seed
+
+	def record_demand(self, key: tuple):
+		"""Exponentially decayed request count per combination"""
+		now = monotonic()
+		score, last = self.demand.get(key, (0.0, now))
+		self.demand[key] = (score * exp(-self.decay_rate * (now - last)) + 1, now)
+
+	def demand_score(self, key: tuple) -> float:
+		score, last = self.demand.get(key, (0.0, monotonic()))
+		return score * exp(-self.decay_rate * (monotonic() - last))
+
+	def target_size(self, key: tuple) -> int:
+		"""Number of ready seeds the combination should have"""
+		score = self.demand_score(key)
+		if score < self.hot_threshold:
+			return 0
+		return min(self.max_size, max(1, ceil(score * self.size_factor)))
+
+	def needs_refill(self, key: tuple) -> bool:
+		"""True if the combination is below its low-water mark and no refill is running"""
+		if key in self.refilling:
+			return False
+		target = self.target_size(key)
+		low_water = max(1, target // 2)
+		return target > 0 and len(self.seeds.get(key, ())) < low_water
+
+	def refill(self, key: tuple, params: dict):
+		"""Generate seeds until the combination reaches its target size"""
+		try:
+			while True:
+				with self.lock:
+					if len(self.seeds.get(key, ())) >= self.target_size(key):
+						return
+				try:
+					seed = self.generate(params)
+				except Exception:  # pylint: disable=broad-except
+					with self.lock:
+						self.refill_errors += 1
+					return
+				with self.lock:
+					self.seeds.setdefault(key, deque()).append(seed)
+		finally:
+			with self.lock:
+				self.refilling.discard(key)
+
+	def stats(self) -> dict:
+		with self.lock:
+			lookups = self.hits + self.misses
+			return {
+				'hits': self.hits,
+				'misses': self.misses,
+				'hit_ratio': self.hits / lookups if lookups else 0.0,
+				'refill_errors': self.refill_errors,
+				'ready': sum(len(ready) for ready in self.seeds.values()),
+				'hot_combinations': sum(1 for key in self.demand if self.target_size(key) > 0)
+			}
+
+
+# Refills only use seed slots that are free right away, rooms being created come first
+pool = SeedPool(generate=partial(ratelimit.generate_seed, wait=0))
+metrics.track_cache('seed_pool', pool.stats)
@@ -0,0 +1,76 @@
+"""Process startup
+
+Importing the app does no database work, so workers start while the
+database is briefly unavailable and tests import it for free. The schema
+and the catalog rows are created once per deploy by `flask init-db`, the
+release step in the Procfile. A process loads the catalog and the static
+assets and compiles templates on first use, or under gunicorn's
+preload_app in the master before the fork so every worker shares them
+(gunicorn.conf.py), and starts its threads on its first request. Compiled templates are also kept in a
+bytecode cache on disk, which `flask compile-templates` fills ahead.
+"""
+from os import environ, makedirs, path
+from tempfile import gettempdir
+import click
+from jinja2 import FileSystemBytecodeCache
+from app import app, db
+from database import init_db_values
+import assets
+import catalog
+import reaper
+import routing
+
+JINJA_CACHE_DIR = environ.get('JINJA_CACHE_DIR', path.join(gettempdir(), 'alttpr-jinja'))
+
+makedirs(JINJA_CACHE_DIR, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+
+
+def bootstrap():
+	"""Create the schema and the catalog rows, or upgrade an existing database"""
+	with app.app_context():
+		init_db_values()
+
+
+def compile_templates() -> int:
+	"""Compile every template into the environment's cache and the bytecode cache"""
+	names = app.jinja_env.list_templates()
+	for name in names:
+		app.jinja_env.get_template(name)
+	return len(names)
+
+
+def preload():
+	"""Load what workers share before they are forked, closing the connections it used"""
+	with app.app_context():
+		catalog.get()
+	assets.get()
+	compile_templates()
+	# A pooled connection must not be shared by the forked workers
+	db.engine.dispose()
+
+
+@app.before_first_request
+def start_threads():
+	reaper.start()
+	routing.start()
+
+
+@app.cli.command('init-db')
+def init_db_command():
+	"""Create or upgrade the schema and the settings catalog"""
+	bootstrap()
+	click.echo('Database initialized')
+
+
+@app.cli.command('reload-catalog')
+def reload_catalog_command():
+	"""Have running processes reload the settings catalog after its rows changed"""
+	version = catalog.publish()
+	click.echo(f'Catalog version {version}, processes reload it within {catalog.CATALOG_CHECK_INTERVAL:g} seconds')
+
+
+@app.cli.command('compile-templates')
+def compile_templates_command():
+	"""Fill the template bytecode cache"""
+	click.echo(f'Compiled {compile_templates()} templates into {JINJA_CACHE_DIR}')
@@ -0,0 +1,164 @@
+"""State shared by the workers
+
+A small key-value store with expiring keys, atomic counters and pub/sub
+channels. STATE_URL, or REDIS_URL as set by the Heroku Redis add-on, points
+at a Redis server that every worker and dyno shares. Without one the state
+is kept in the process, which is only shared with the requests of the same
+worker. Values are anything json can encode.
+"""
+import json
+from os import environ
+from threading import Lock, Thread
+from time import sleep
+from app import app
+from cache import LRUCache
+
+try:
+	import redis
+except ImportError:
+	redis = None
+
+STATE_URL = environ.get('STATE_URL', environ.get('REDIS_URL'))
+
+# Prefix of every key and channel, so several apps can share a server
+STATE_PREFIX = environ.get('STATE_PREFIX', 'alttpr:')
+
+# Keys kept in memory, the least recently used go first beyond it
+STATE_MAX_KEYS = int(environ.get('STATE_MAX_KEYS', 100000))
+
+# Seconds a command waits for the server before failing
+STATE_TIMEOUT = float(environ.get('STATE_TIMEOUT', 1))
+
+
+class Subscribers:
+	"""Callbacks of this process subscribed to each channel"""
+
+	def __init__(self):
+		self.callbacks = {}
+		self.lock = Lock()
+
+	def add(self, channel: str, callback):
+		with self.lock:
+			self.callbacks.setdefault(channel, set()).add(callback)
+
+	def remove(self, channel: str, callback):
+		with self.lock:
+			callbacks = self.callbacks.get(channel)
+			if callbacks:
+				callbacks.discard(callback)
+				if not callbacks:
+					del self.callbacks[channel]
+
+	def deliver(self, channel: str, message) -> int:
+		with self.lock:
+			callbacks = list(self.callbacks.get(channel, ()))
+		for callback in callbacks:
+			try:
+				callback(message)
+			except Exception:  # pylint: disable=broad-except
+				app.logger.exception('Subscriber of %s failed', channel)
+		return len(callbacks)
+
+
+class MemoryStore:
+	"""State of this process, messages are delivered to the subscribers while publishing"""
+
+	def __init__(self, max_keys: int = STATE_MAX_KEYS):
+		self.entries = LRUCache(max_keys)
+		self.subscribers = Subscribers()
+
+	def get(self, key: str, default=None):
+		return self.entries.get(key, default)
+
+	def set(self, key: str, value, ttl: float = None):
+		self.entries.set(key, value, ttl=ttl)
+
+	def delete(self, key: str):
+		self.entries.delete(key)
+
+	def incr(self, key: str, amount: int = 1, ttl: float = None) -> int:
+		return self.entries.incr(key, amount, ttl=ttl)
+
+	def publish(self, channel: str, message) -> int:
+		return self.subscribers.deliver(channel, message)
+
+	def subscribe(self, channel: str, callback):
+		self.subscribers.add(channel, callback)
+
+	def unsubscribe(self, channel: str, callback):
+		self.subscribers.remove(channel, callback)
+
+
+class RedisStore:
+	"""State on a Redis server, messages reach the subscribers of every process through a listener thread"""
+
+	def __init__(self, url: str, prefix: str = STATE_PREFIX, timeout: float = STATE_TIMEOUT):
+		if redis is None:
+			raise RuntimeError('The redis package is required for STATE_URL')
+		self.url = url
+		self.prefix = prefix
+		self.client = redis.Redis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout)
+		self.subscribers = Subscribers()
+		self.listener = None
+		self.listener_lock = Lock()
+
+	def get(self, key: str, default=None):
+		value = self.client.get(self.prefix + key)
+		return default if value is None else json.loads(value)
+
+	def set(self, key: str, value, ttl: float = None):
+		self.client.set(self.prefix + key, json.dumps(value), px=int(ttl * 1000) if ttl else None)
+
+	def delete(self, key: str):
+		self.client.delete(self.prefix + key)
+
+	def incr(self, key: str, amount: int = 1, ttl: float = None) -> int:
+		if not ttl:
+			return self.client.incrby(self.prefix + key, amount)
+		# Creating the key with its expiry first keeps the expiry of an existing key, as incrby does
+		pipeline = self.client.pipeline()
+		pipeline.set(self.prefix + key, 0, px=int(ttl * 1000), nx=True)
+		pipeline.incrby(self.prefix + key, amount)
+		return pipeline.execute()[1]
+
+	def publish(self, channel: str, message) -> int:
+		"""Send a message to the subscribers of every process, returns the processes listening"""
+		return self.client.publish(self.prefix + channel, json.dumps(message))
+
+	def subscribe(self, channel: str, callback):
+		self.ensure_listener()
+		self.subscribers.add(channel, callback)
+
+	def unsubscribe(self, channel: str, callback):
+		self.subscribers.remove(channel, callback)
+
+	def listen(self):
+		"""Deliver the messages of every channel to the local subscribers, reconnecting on errors"""
+		while True:
+			pubsub = None
+			try:
+				# Without a socket timeout, the connection waits for messages as long as it takes
+				pubsub = redis.Redis.from_url(self.url, socket_keepalive=True).pubsub(ignore_subscribe_messages=True)
+				pubsub.psubscribe(self.prefix + '*')
+				for message in pubsub.listen():
+					channel = message['channel'].decode()[len(self.prefix):]
+					self.subscribers.deliver(channel, json.loads(message['data']))
+			except Exception:  # pylint: disable=broad-except
+				app.logger.exception('State listener failed, reconnecting')
+				if pubsub is not None:
+					pubsub.close()
+				sleep(1)
+
+	def ensure_listener(self):
+		with self.listener_lock:
+			if self.listener is None:
+				self.listener = Thread(target=self.listen, name='state-listener', daemon=True)
+				self.listener.start()
+
+
+def connect(url: str = STATE_URL):
+	"""Store of the url, or of this process when there is none"""
+	return RedisStore(url) if url else MemoryStore()
+
+
+store = connect()
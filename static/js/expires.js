@@ -0,0 +1,15 @@
+// Counts down every element with a data-expires timestamp, so pages can be cached
+(function () {
+    function update() {
+        var elements = document.querySelectorAll('[data-expires]');
+        for (var i = 0; i < elements.length; i++) {
+            var total = Math.max(0, Math.floor((new Date(elements[i].getAttribute('data-expires')) - new Date()) / 1000));
+            var hours = Math.floor(total / 3600);
+            var minutes = Math.floor((total % 3600) / 60);
+            var seconds = total % 60;
+            elements[i].textContent = hours + ' hours, ' + minutes + ' minutes, ' + seconds + ' seconds';
+        }
+    }
+    update();
+    setInterval(update, 1000);
+})();
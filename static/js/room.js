@@ -0,0 +1,73 @@
+// Keeps the player count and times table of a room up to date from its event stream
+(function () {
+    var room = document.getElementById('roomScript').getAttribute('data-room');
+    // A busy server turns the stream away, the page then polls this often, see SSE_BUSY_RETRY
+    var pollInterval = 15000;
+
+    function render(members) {
+        var body = document.getElementById('roomTimes');
+        while (body.firstChild) {
+            body.removeChild(body.firstChild);
+        }
+        members.forEach(function (member) {
+            var row = document.createElement('tr');
+            [member.name, member.time].forEach(function (value) {
+                var cell = document.createElement('td');
+                cell.textContent = value;
+                row.appendChild(cell);
+            });
+            body.appendChild(row);
+        });
+        document.getElementById('playerCount').textContent = members.length;
+    }
+
+    function formatTime(total) {
+        if (!total) {
+            return '-';
+        }
+        return [Math.floor(total / 3600), Math.floor((total % 3600) / 60), total % 60].map(function (part) {
+            return (part < 10 ? '0' : '') + part;
+        }).join(':');
+    }
+
+    function poll() {
+        fetch('/api/v1/rooms/' + encodeURIComponent(room) + '/times', {credentials: 'same-origin'})
+            .then(function (response) {
+                if (response.status === 404) {
+                    window.location = '/rooms';
+                }
+                return response.json();
+            })
+            .then(function (room) {
+                render(room.times.map(function (time) {
+                    return {name: time.player, time: formatTime(time.time)};
+                }));
+            })
+            .catch(function () {})
+            .then(function () { setTimeout(connect, pollInterval); });
+    }
+
+    function connect() {
+        var source = new EventSource('/room/' + encodeURIComponent(room) + '/events');
+
+        ['join', 'leave', 'time'].forEach(function (type) {
+            source.addEventListener(type, function (event) {
+                render(JSON.parse(event.data).members);
+            });
+        });
+
+        source.addEventListener('removed', function () {
+            source.close();
+            window.location = '/rooms';
+        });
+
+        // EventSource reconnects by itself after a stream ends, but gives up once a request is refused
+        source.addEventListener('error', function () {
+            if (source.readyState === EventSource.CLOSED) {
+                poll();
+            }
+        });
+    }
+
+    connect();
+})();
@@ -0,0 +1,57 @@
+"""The app on a temporary SQLite database, with a few synthetic rooms"""
+import os
+import random
+import re
+import tempfile
+import pytest
+
+# TEST_DATABASE_URL runs the tests against another database, one that may be emptied
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', f'sqlite:///{tempfile.mkdtemp()}/tests.db')
+os.environ.setdefault('APP_SECRET_KEY', 'tests')
+os.environ['REAPER_INTERVAL'] = '0'
+os.environ.pop('RECAPTCHA_SITE_KEY', None)
+os.environ.pop('DATABASE_REPLICA_URLS', None)
+for scope in ('NAME_PLAYER', 'NAME_IP', 'QUEUE_PLAYER', 'QUEUE_IP'):
+	os.environ.setdefault(f'RATE_LIMIT_{scope}', '1000000/1')
+
+CSRF_TOKEN = re.compile(r'name=_csrf_token type=hidden value="([^"]+)"')
+
+
+@pytest.fixture(scope='session')
+def app():
+	from app import app as flask_app, db  # pylint: disable=import-outside-toplevel
+	from bench import dataset  # pylint: disable=import-outside-toplevel
+	import startup  # pylint: disable=import-outside-toplevel
+
+	with flask_app.app_context():
+		db.drop_all()
+	startup.bootstrap()
+	with flask_app.app_context():
+		flask_app.rooms = dataset.generate(db, 20, active_fraction=1, rng=random.Random(0))
+	return flask_app
+
+
+@pytest.fixture
+def client(app):
+	return app.test_client()
+
+
+@pytest.fixture
+def room(app):
+	"""Hash code of an open room"""
+	return app.rooms.active_rooms[0][1]
+
+
+@pytest.fixture
+def csrf_token():
+	"""CSRF token of a client's session"""
+	return lambda client: CSRF_TOKEN.search(client.get('/name').get_data(as_text=True)).group(1)
+
+
+@pytest.fixture
+def player(app, csrf_token):  # pylint: disable=redefined-outer-name
+	"""Client of a player who accepted cookies and chose a name"""
+	client = app.test_client()
+	client.set_cookie('localhost', 'cookies', 'true')
+	client.post('/name', data={'_csrf_token': csrf_token(client), 'name': 'tester'})
+	return client
@@ -0,0 +1,158 @@
+"""alttpr.com client against a local stand-in: retries, backoff and the circuit breaker"""
+import random
+import time
+import pytest
+import alttpr_api
+from bench import seed_stub
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+	"""Scripted stand-in for alttpr.com, a fresh breaker and recorded backoff delays"""
+	server, url = seed_stub.start(patch_entries=1)
+	handler = server.RequestHandlerClass
+	delays = []
+	monkeypatch.setattr(alttpr_api, 'seed_url', url)
+	monkeypatch.setattr(alttpr_api, 'MAX_RETRIES', 2)
+	monkeypatch.setattr(alttpr_api, 'breaker', alttpr_api.CircuitBreaker(threshold=2, reset_after=30))
+	monkeypatch.setattr(alttpr_api.time, 'sleep', delays.append)
+	handler.delays = delays
+	yield handler
+	server.shutdown()
+	server.server_close()
+
+
+def is_seed(seed: dict) -> bool:
+	return len(seed['hash']) == 10
+
+
+def expire_reset_period(breaker):
+	breaker.opened_at -= breaker.reset_after
+
+
+def half_open(breaker):
+	breaker.failures = breaker.threshold
+	breaker.opened_at = time.monotonic() - breaker.reset_after
+
+
+def test_success(upstream):
+	assert is_seed(alttpr_api.request_seed({}))
+	assert upstream.requests == ['ok']
+	assert upstream.delays == []
+	assert alttpr_api.breaker.state == 'closed'
+
+
+@pytest.mark.parametrize('failure', [503, 429, 'truncated', 'reset'])
+def test_retried_failures(upstream, failure):
+	upstream.script.extend([failure, failure])
+	assert is_seed(alttpr_api.request_seed({}))
+	assert upstream.requests == [failure, failure, 'ok']
+	assert len(upstream.delays) == 2
+	assert alttpr_api.breaker.failures == 0
+
+
+def test_backoff_between_retries(upstream):
+	upstream.script.extend([500, 500])
+	alttpr_api.request_seed({})
+	for attempt, delay in enumerate(upstream.delays):
+		assert 0 <= delay <= min(alttpr_api.BACKOFF_MAX, alttpr_api.BACKOFF_BASE * 2 ** attempt)
+
+
+def test_backoff_is_capped():
+	random.seed(0)
+	delays = [alttpr_api.backoff(attempt) for attempt in range(20) for _ in range(50)]
+	assert max(delays) <= alttpr_api.BACKOFF_MAX
+	assert min(delays) >= 0
+
+
+@pytest.mark.parametrize('status', [400, 404, 422])
+def test_client_errors_are_not_retried(upstream, status):
+	upstream.script.append(status)
+	with pytest.raises(alttpr_api.UpstreamError, match='rejected'):
+		alttpr_api.request_seed({})
+	assert upstream.requests == [status]
+	# alttpr.com answered, it is up
+	assert alttpr_api.breaker.failures == 0
+
+
+@pytest.mark.parametrize('failure', [502, 'truncated', 'reset'])
+def test_exhausted_retries(upstream, failure):
+	upstream.script.extend([failure] * 3)
+	with pytest.raises(alttpr_api.UpstreamError, match='after 3 attempts'):
+		alttpr_api.request_seed({})
+	assert len(upstream.requests) == 3
+	assert alttpr_api.breaker.failures == 1
+
+
+def test_open_half_open_closed(upstream):
+	breaker = alttpr_api.breaker
+	upstream.script.extend([500] * 6)
+	for _ in range(2):
+		with pytest.raises(alttpr_api.UpstreamError):
+			alttpr_api.request_seed({})
+	assert breaker.state == 'open'
+	assert not breaker.accepting()
+
+	# Open, calls fail without reaching alttpr.com
+	with pytest.raises(alttpr_api.CircuitOpenError):
+		alttpr_api.request_seed({})
+	assert len(upstream.requests) == 6
+
+	# Half open, a single trial goes through and closes the circuit
+	expire_reset_period(breaker)
+	assert breaker.state == 'half-open'
+	assert breaker.accepting()
+	assert is_seed(alttpr_api.request_seed({}))
+	assert breaker.state == 'closed'
+	assert breaker.accepting()
+
+
+def test_failed_trial_reopens(upstream):
+	breaker = alttpr_api.breaker
+	upstream.script.extend([500] * 9)
+	for _ in range(3):
+		with pytest.raises(alttpr_api.UpstreamError):
+			if breaker.opened_at is not None:
+				expire_reset_period(breaker)
+			alttpr_api.request_seed({})
+	assert breaker.state == 'open'
+	assert not breaker.trial_running
+
+
+def test_one_trial_at_a_time(upstream, monkeypatch):
+	breaker = alttpr_api.breaker
+	half_open(breaker)
+	seen = []
+
+	def post_seed(payload):
+		# A second call while the trial runs is turned away
+		seen.append(breaker.accepting())
+		with pytest.raises(alttpr_api.CircuitOpenError):
+			breaker.before_call()
+		return {'hash': 'abc'}
+
+	monkeypatch.setattr(alttpr_api, 'post_seed', post_seed)
+	assert alttpr_api.request_seed({}) == {'hash': 'abc'}
+	assert seen == [False]
+	assert breaker.state == 'closed'
+
+
+def test_unexpected_error_ends_the_trial(upstream, monkeypatch):
+	breaker = alttpr_api.breaker
+	half_open(breaker)
+
+	def post_seed(payload):
+		raise RuntimeError('bug')
+
+	real_post_seed = alttpr_api.post_seed
+	monkeypatch.setattr(alttpr_api, 'post_seed', post_seed)
+	with pytest.raises(RuntimeError):
+		alttpr_api.request_seed({})
+	assert not breaker.trial_running
+	assert breaker.state == 'open'
+
+	# Once alttpr.com recovers the next trial closes the circuit
+	monkeypatch.setattr(alttpr_api, 'post_seed', real_post_seed)
+	expire_reset_period(breaker)
+	assert is_seed(alttpr_api.request_seed({}))
+	assert breaker.state == 'closed'
@@ -0,0 +1,50 @@
+"""Settings catalog reloaded by every process once its version changes"""
+import pytest
+# Loads the app, which catalog cannot be imported ahead of
+import startup
+import catalog
+
+
+@pytest.fixture
+def difficulty(app):
+	"""A difficulty added to the lookup table, removed again afterwards"""
+	from app import db  # pylint: disable=import-outside-toplevel
+	from database import Difficulty  # pylint: disable=import-outside-toplevel
+	with app.app_context():
+		db.session.add(Difficulty('tutorial', 'Tutorial'))
+		db.session.commit()
+	yield 'tutorial'
+	with app.app_context():
+		Difficulty.query.filter_by(name='tutorial').delete()
+		db.session.commit()
+		catalog.reload()
+
+
+def test_reload_command(app, difficulty):
+	result = app.test_cli_runner().invoke(startup.reload_catalog_command)
+	assert result.exit_code == 0
+	assert 'Catalog version' in result.output
+	assert difficulty in catalog.get().by_name['difficulty']
+
+
+def test_other_processes_reload_on_the_next_check(app, difficulty, monkeypatch):
+	with app.app_context():
+		stale = catalog.get()
+		assert difficulty not in stale.by_name['difficulty']
+		catalog.publish()
+
+		# A process still holding the catalog of the previous version
+		monkeypatch.setattr(catalog, 'current', stale)
+		monkeypatch.setattr(catalog, 'version', catalog.version - 1)
+		assert catalog.get() is stale
+		monkeypatch.setattr(catalog, 'checked_at', catalog.checked_at - catalog.CATALOG_CHECK_INTERVAL)
+		assert difficulty in catalog.get().by_name['difficulty']
+
+
+def test_queue_follows_the_catalog(app, difficulty):
+	import app as views  # pylint: disable=import-outside-toplevel
+	with app.app_context():
+		before = views.get_match_queue()
+		assert views.get_match_queue() is before
+		catalog.publish()
+		assert difficulty in views.get_match_queue().catalog['difficulty']
@@ -0,0 +1,16 @@
+"""Compression of dynamic responses"""
+import pytest
+
+
+def test_listing_is_compressed(client):
+	response = client.get('/rooms', headers={'Accept-Encoding': 'gzip'})
+	assert response.status_code == 200
+	assert response.headers.get('Content-Encoding') == 'gzip'
+
+
+@pytest.mark.parametrize('path', ['/room/{}', '/name', '/queue'])
+def test_pages_with_the_csrf_token_are_not_compressed(player, room, path):
+	response = player.get(path.format(room), headers={'Accept-Encoding': 'gzip'})
+	assert response.status_code == 200
+	assert b'_csrf_token' in response.data
+	assert 'Content-Encoding' not in response.headers
@@ -0,0 +1,58 @@
+"""Room event streams and the per-worker limit of open streams"""
+import events
+
+
+def test_stream_opens(client, room):
+	response = client.get(f'/room/{room}/events')
+	assert response.status_code == 200
+	assert next(response.response) == b'retry: 3000\n\n'
+	response.close()
+
+
+def test_streams_past_the_limit_are_refused(client, room, monkeypatch):
+	monkeypatch.setattr(events, 'stream_slots', events.BoundedSemaphore(2))
+	streams = [client.get(f'/room/{room}/events') for _ in range(2)]
+	assert [response.status_code for response in streams] == [200, 200]
+
+	refused = client.get(f'/room/{room}/events')
+	assert refused.status_code == 503
+	assert refused.headers['Retry-After'] == str(events.SSE_BUSY_RETRY // 1000)
+	assert refused.get_data(as_text=True) == f'retry: {events.SSE_BUSY_RETRY}\n\n'
+
+	# A closed stream frees its slot
+	streams.pop().close()
+	assert client.get(f'/room/{room}/events').status_code == 200
+
+
+def test_unknown_room_takes_no_slot(client, monkeypatch):
+	monkeypatch.setattr(events, 'stream_slots', events.BoundedSemaphore(1))
+	assert client.get('/room/nonexistent/events').status_code == 404
+	assert events.open_stream()
+
+
+def test_subscribers_receive_the_members(app, player, room):
+	events.ensure_listener()
+	subscription = events.broker.subscribe(room)
+	try:
+		assert player.get(f'/room/{room}').status_code == 200
+		message = subscription.get(timeout=5)
+	finally:
+		events.broker.unsubscribe(room, subscription)
+	assert message['type'] == 'join'
+	assert isinstance(message['data']['version'], int)
+	assert 'tester' in [member['name'] for member in message['data']['members']]
+
+
+def test_published_message_leaves_out_the_members(app, room, monkeypatch):
+	from app import db  # pylint: disable=import-outside-toplevel
+	from database import Room  # pylint: disable=import-outside-toplevel
+	published = []
+	monkeypatch.setattr(events, 'use_notify', lambda: False)
+	monkeypatch.setattr(events.state.store, 'publish', lambda channel, message: published.append(message))
+	with app.app_context():
+		record = Room.query.filter_by(hash_code=room).one()
+		record.touch()
+		events.publish(record, 'time')
+		db.session.commit()
+		version = record.version
+	assert published == [{'room': room, 'id': record.id, 'version': version, 'type': 'time'}]
@@ -0,0 +1,68 @@
+"""Rooms listing markup cached in the shared state"""
+import pytest
+import fragments
+import state
+from bench import kv_stub
+
+
+@pytest.fixture(params=['memory', 'kv_stub'])
+def store(request, monkeypatch):
+	if request.param == 'memory':
+		shared = state.MemoryStore()
+	else:
+		server, url = kv_stub.start()
+		request.addfinalizer(server.shutdown)
+		shared = state.RedisStore(url)
+	monkeypatch.setattr(fragments, 'backend', fragments.StateBackend(shared))
+	return shared
+
+
+def test_listing_is_cached_in_the_store(client, store):
+	first = client.get('/rooms').get_data(as_text=True)
+	assert fragments.backend.stats()['hits'] == 0
+	assert store.get('fragment:rooms-body:')
+
+	# Another worker on the same store renders nothing again
+	fragments.backend = fragments.StateBackend(store)
+	assert client.get('/rooms').get_data(as_text=True) == first
+	assert fragments.backend.stats() == {'hits': 1, 'misses': 0, 'hit_ratio': 1.0}
+
+
+def test_commit_drops_the_card(app, client, store):
+	from app import db  # pylint: disable=import-outside-toplevel
+	from database import Room  # pylint: disable=import-outside-toplevel
+	client.get('/rooms')
+	with app.app_context():
+		room = Room.query.filter_by(hash_code=app.rooms.active_rooms[0][1]).first()
+		assert store.get(f'fragment:room-card:{room.id}')
+		room.touch()
+		db.session.commit()
+		assert store.get(f'fragment:room-card:{room.id}') is None
+
+
+def test_rename_changes_the_rooms_of_the_player(app, player, room, csrf_token):
+	from database import Room  # pylint: disable=import-outside-toplevel
+	assert player.get(f'/room/{room}').status_code == 200
+	with app.app_context():
+		version = Room.query.filter_by(hash_code=room).one().version
+	player.post('/name', data={'_csrf_token': csrf_token(player), 'name': 'renamed'})
+	with app.app_context():
+		assert Room.query.filter_by(hash_code=room).one().version == version + 1
+	assert 'renamed' in player.get(f'/room/{room}').get_data(as_text=True)
+
+
+def test_rename_refreshes_the_card_of_the_creator(app, client, store):  # pylint: disable=unused-argument
+	from app import db  # pylint: disable=import-outside-toplevel
+	from database import Player, Room  # pylint: disable=import-outside-toplevel
+	import queries  # pylint: disable=import-outside-toplevel
+	client.get('/rooms')
+	with app.app_context():
+		creator = Player.query.get(Room.query.filter_by(hash_code=app.rooms.active_rooms[0][1]).one().creator_id)
+		name, creator.name = creator.name, 'Renamed Creator'
+		queries.touch_player_rooms(creator.id)
+		db.session.commit()
+		try:
+			assert 'by Renamed Creator' in client.get('/rooms').get_data(as_text=True)
+		finally:
+			creator.name = name
+			db.session.commit()
@@ -0,0 +1,127 @@
+"""Medians of the leaderboard histograms"""
+import pytest
+from sqlalchemy import event
+import leaderboards
+import ratings
+
+BUCKET = leaderboards.LEADERBOARD_BUCKET
+
+
+def middle(time_bucket: int) -> int:
+	return time_bucket * BUCKET + BUCKET // 2
+
+
+@pytest.mark.parametrize('counts, median', [
+	([], None),
+	([(3, 1)], middle(3)),
+	([(3, 1), (5, 1), (9, 1)], middle(5)),
+	# An even count takes the mean of both middle times, not the lower one
+	([(3, 1), (5, 1)], (middle(3) + middle(5)) / 2),
+	([(3, 2), (5, 1), (9, 1)], (middle(3) + middle(5)) / 2),
+	([(3, 1), (5, 2), (9, 1)], middle(5)),
+	([(3, 2), (5, 2)], (middle(3) + middle(5)) / 2),
+])
+def test_histogram_median(counts, median):
+	assert leaderboards.histogram_median(counts) == median
+
+
+@pytest.fixture
+def board(app):
+	"""A board of two players, times in seconds of each"""
+	from app import db  # pylint: disable=import-outside-toplevel
+	from database import Leaderboard, Player, TimeHistogram  # pylint: disable=import-outside-toplevel
+	category = ratings.category_name('NoGlitches', 'ganon', 'open')
+	with app.app_context():
+		players = Player.query.order_by(Player.id).limit(2).all()
+		times = {players[0].id: [3000, 3600], players[1].id: [3300, 4000, 4200]}
+		for player_id, player_times in times.items():
+			db.session.add(Leaderboard(category=category, period=leaderboards.PERIOD_ALL, player_id=player_id,
+				best_time=min(player_times), races=len(player_times), total_time=sum(player_times)))
+			leaderboards.count_times(category, [leaderboards.PERIOD_ALL], player_id, [(time, 1) for time in player_times])
+		db.session.commit()
+	yield times
+	with app.app_context():
+		Leaderboard.query.filter_by(category=category).delete()
+		TimeHistogram.query.filter_by(category=category).delete()
+		db.session.commit()
+
+
+def test_api_returns_the_medians(client, board):
+	body = client.get('/api/v1/leaderboards?logic=NoGlitches&goal=ganon&mode=open').get_json()
+	first, second = board
+	assert body['median_time'] == middle(3600 // BUCKET)
+	assert [standing['median_time'] for standing in body['standings']] == [
+		(middle(3000 // BUCKET) + middle(3600 // BUCKET)) / 2, middle(4000 // BUCKET)]
+	assert [standing['best_time'] for standing in body['standings']] == [min(board[first]), min(board[second])]
+
+
+@pytest.fixture
+def board_writes(app):
+	"""Statements writing to the leaderboard tables"""
+	from app import db  # pylint: disable=import-outside-toplevel
+	writes = []
+	with app.app_context():
+		engine = db.engine
+
+	def listener(_connection, _cursor, statement, *_):
+		if statement.startswith(('INSERT', 'UPDATE')) and ('leaderboard' in statement or 'time_histogram' in statement):
+			writes.append(statement)
+
+	event.listen(engine, 'before_cursor_execute', listener)
+	yield writes
+	event.remove(engine, 'before_cursor_execute', listener)
+
+
+def post_time(client, room, token, time):
+	response = client.post(f'/time/{room}', data={'_csrf_token': token,
+		'hours': str(time // 3600), 'minutes': str(time % 3600 // 60), 'seconds': str(time % 60)})
+	assert response.status_code == 302
+
+
+@pytest.fixture
+def racer(app, player, room):
+	"""Id of a player who joined the room, and the room's category"""
+	from database import Player, Room  # pylint: disable=import-outside-toplevel
+	assert player.get(f'/room/{room}').status_code == 200
+	with app.app_context():
+		player_id = Player.query.filter_by(name='tester').order_by(Player.id.desc()).first().id
+		return player_id, ratings.room_category(Room.query.filter_by(hash_code=room).one().id)
+
+
+def test_posted_time_replaces_the_previous_one(app, player, room, csrf_token, racer, board_writes):
+	from database import Leaderboard, TimeHistogram  # pylint: disable=import-outside-toplevel
+	player_id, category = racer
+	token = csrf_token(player)
+	post_time(player, room, token, 3000)
+	# One statement per table
+	assert len(board_writes) == 2
+	post_time(player, room, token, 3100)
+	assert len(board_writes) == 4
+
+	with app.app_context():
+		boards = [(board.best_time, board.races, board.total_time)
+			for board in Leaderboard.query.filter_by(category=category, player_id=player_id)]
+		histograms = [(histogram.bucket, histogram.count)
+			for histogram in TimeHistogram.query.filter_by(category=category, player_id=player_id).filter(TimeHistogram.count != 0)]
+		result = leaderboards.check()
+	assert boards == [(3100, 1, 3100)] * 2
+	assert histograms == [(leaderboards.bucket(3100), 1)] * 2
+	for found in result[0] + result[1]:
+		assert not any(key[2] == player_id for key in found)
+
+
+def test_check_finds_drift(app, player, room, csrf_token, racer):
+	from app import db  # pylint: disable=import-outside-toplevel
+	from database import Leaderboard, TimeHistogram  # pylint: disable=import-outside-toplevel
+	player_id, category = racer
+	post_time(player, room, csrf_token(player), 3000)
+	all_time = {'category': category, 'period': leaderboards.PERIOD_ALL, 'player_id': player_id}
+	with app.app_context():
+		boards, histograms = leaderboards.check()
+		Leaderboard.query.filter_by(**all_time).update({'best_time': 2000})
+		TimeHistogram.query.filter_by(**all_time).delete()
+		db.session.commit()
+		drifted_boards, drifted_histograms = leaderboards.check()
+	assert set(drifted_boards.different) - set(boards.different) == {(category, leaderboards.PERIOD_ALL, player_id)}
+	assert set(drifted_histograms.missing) - set(histograms.missing) == {
+		(category, leaderboards.PERIOD_ALL, player_id, leaderboards.bucket(3000))}
@@ -0,0 +1,187 @@
+"""Matchmaking queue shared by every worker through the database"""
+import pytest
+import matchmaking
+
+CATALOG = {
+	'difficulty': ('normal', 'hard'),
+	'goal': ('ganon', 'dungeons'),
+	'logic': ('NoGlitches',),
+	'mode': ('standard', 'open'),
+	'variation': ('none',),
+	'weapons': ('randomized',),
+	'enemizer': (False, True),
+	'spoilers': (False, True),
+	'tournament': (False, True)
+}
+
+EXACT = {'difficulty': 'normal', 'goal': 'ganon', 'mode': 'open', 'enemizer': False, 'spoilers': False, 'tournament': False}
+
+
+class Clock:
+
+	def __init__(self):
+		self.now = 1000.0
+
+	def __call__(self):
+		return self.now
+
+
+@pytest.fixture
+def clock():
+	return Clock()
+
+
+@pytest.fixture
+def workers(app, clock):
+	"""Two queues on the same tables, standing in for two workers"""
+	from app import db  # pylint: disable=import-outside-toplevel
+	from database import QueueEntry, QueueTicket  # pylint: disable=import-outside-toplevel
+
+	def worker():
+		return matchmaking.DatabaseQueue(CATALOG, db, QueueTicket.__table__, QueueEntry.__table__,
+			expire_after=600, widen_after=60, widen_order=('spoilers', 'mode'), clock=clock)
+
+	with app.app_context():
+		db.engine.execute(QueueEntry.__table__.delete())
+		db.engine.execute(QueueTicket.__table__.delete())
+		yield worker(), worker()
+
+
+def test_players_of_different_workers_match(workers):
+	first, second = workers
+	assert first.enqueue(1, EXACT) == []
+	assert len(second) == 1
+	assert second.waiting(1).enqueued_at == 1000.0
+
+	matches = second.enqueue(2, EXACT)
+	assert matches == [matchmaking.Match(dict(EXACT, logic='NoGlitches', variation='none', weapons='randomized'), [1, 2])]
+	assert len(first) == 0
+
+	# Both players find their room, whichever worker they poll
+	first.matched([1, 2], '/pending/7', None)
+	assert second.waiting(1).url == '/pending/7'
+	assert first.waiting(2).url == '/pending/7'
+
+
+def test_matched_tickets_expire(workers, clock):
+	first, second = workers
+	first.enqueue(1, EXACT)
+	second.enqueue(2, EXACT)
+	clock.now += 600
+	assert first.waiting(1) is None
+	# Expired tickets are dropped by the next change
+	first.enqueue(3, EXACT)
+	assert first.waiting(3) is not None
+
+
+def test_incompatible_players_wait(workers):
+	first, second = workers
+	first.enqueue(1, EXACT)
+	assert second.enqueue(2, dict(EXACT, mode='standard')) == []
+	assert len(first) == 2
+
+
+def test_cancel(workers):
+	first, second = workers
+	first.enqueue(1, EXACT)
+	assert second.cancel(1)
+	assert not second.cancel(1)
+	assert first.enqueue(2, EXACT) == []
+
+
+def test_requeue_replaces_the_ticket(workers):
+	first, second = workers
+	first.enqueue(1, EXACT)
+	second.enqueue(1, dict(EXACT, mode='standard'))
+	assert len(first) == 1
+	assert first.enqueue(2, EXACT) == []
+
+
+def test_widening_matches_across_workers(workers, clock):
+	first, second = workers
+	first.enqueue(1, EXACT)
+	second.enqueue(2, dict(EXACT, spoilers=True))
+	assert first.widen() == []
+
+	clock.now += 60
+	matches = second.widen()
+	# Player 2 entered the bucket first, player 1 joined it by widening
+	assert [match.player_ids for match in matches] == [[2, 1]]
+	assert first.widen() == []
+	assert first.waiting(1).widened == 1
+
+
+def test_widening_stops_after_the_last_field(workers, clock):
+	first, _ = workers
+	first.enqueue(1, EXACT)
+	for _ in range(3):
+		clock.now += 60
+		first.widen()
+	ticket = first.waiting(1)
+	assert ticket.widened == 2
+	assert ticket.accepted['mode'] == frozenset(CATALOG['mode'])
+
+
+def test_unknown_values_are_refused(workers):
+	with pytest.raises(ValueError):
+		workers[0].enqueue(1, dict(EXACT, mode='retro'))
+
+
+def queue_form(token: str) -> dict:
+	return {'_csrf_token': token, 'difficulty': 'hard', 'goal': 'ganon', 'logic': 'NoGlitches', 'mode': 'open',
+		'variation': 'none', 'weapons': 'randomized', 'enemizer': 'off', 'spoilers': 'off', 'tournament': 'off'}
+
+
+@pytest.fixture
+def queued(player, csrf_token):
+	"""Player waiting in the queue for the exact settings, returns their client"""
+	assert player.post('/queue', data=queue_form(csrf_token(player))).status_code == 302
+	yield player
+	player.post('/queue/leave', data={'_csrf_token': csrf_token(player)})
+
+
+def new_worker(monkeypatch):
+	"""Answer the next requests as a worker that built its own queue"""
+	import app as worker  # pylint: disable=import-outside-toplevel
+	monkeypatch.setattr(worker, 'match_queue', None)
+	monkeypatch.setattr(worker, 'match_queue_catalog', None)
+
+
+def test_status_on_another_worker(queued, monkeypatch):
+	new_worker(monkeypatch)
+	status = queued.get('/queue/status').get_json()
+	assert status['status'] == 'waiting'
+	assert status['waiting'] >= 1
+
+
+def test_lost_ticket_is_queued_again(queued):
+	from app import db  # pylint: disable=import-outside-toplevel
+	from database import QueueEntry, QueueTicket  # pylint: disable=import-outside-toplevel
+	db.engine.execute(QueueEntry.__table__.delete())
+	db.engine.execute(QueueTicket.__table__.delete())
+	assert queued.get('/queue/status').get_json()['status'] == 'waiting'
+	assert db.session.query(QueueTicket).count() == 1
+
+
+def test_status_after_leaving(queued, csrf_token):
+	queued.post('/queue/leave', data={'_csrf_token': csrf_token(queued)})
+	assert queued.get('/queue/status').get_json()['status'] == 'idle'
+
+
+def test_match_is_handed_out_once(app, queued, csrf_token, monkeypatch):
+	import app as views  # pylint: disable=import-outside-toplevel
+	monkeypatch.setattr(views, 'open_room', lambda settings, player_ids: ('/pending/7', None))
+	other = app.test_client()
+	other.set_cookie('localhost', 'cookies', 'true')
+	other.post('/name', data={'_csrf_token': csrf_token(other), 'name': 'other'})
+	assert other.post('/queue', data=queue_form(csrf_token(other))).status_code == 302
+
+	# Sent to the room once, then free to queue again
+	assert other.get('/queue').headers['Location'].endswith('/pending/7')
+	assert other.get('/queue').status_code == 200
+	assert other.get('/queue/status').get_json()['status'] == 'idle'
+
+	status = queued.get('/queue/status').get_json()
+	assert (status['status'], status['url']) == ('matched', '/pending/7')
+	assert queued.get('/queue/status').get_json()['status'] == 'idle'
+	assert queued.get('/queue').status_code == 200
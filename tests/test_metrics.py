@@ -0,0 +1,40 @@
+"""Access to /metrics"""
+import pytest
+import metrics
+
+
+@pytest.mark.parametrize('token, authorization, production, allowed', [
+	(None, '', False, True),
+	(None, '', True, False),
+	('secret', '', False, False),
+	('secret', 'Bearer wrong', True, False),
+	('secret', 'Bearer secret', True, True),
+	('secret', 'Bearer secret', False, True),
+])
+def test_authorized(monkeypatch, token, authorization, production, allowed):
+	monkeypatch.setattr(metrics, 'METRICS_TOKEN', token)
+	assert metrics.authorized(authorization, production) is allowed
+
+
+def test_served_in_development(client, monkeypatch):
+	monkeypatch.setattr(metrics, 'METRICS_TOKEN', None)
+	response = client.get('/metrics')
+	assert response.status_code == 200
+	assert 'http_requests_total' in response.get_data(as_text=True)
+
+
+def test_token_required_once_set(client, monkeypatch):
+	monkeypatch.setattr(metrics, 'METRICS_TOKEN', 'secret')
+	assert client.get('/metrics').status_code == 404
+	assert client.get('/metrics', headers={'Authorization': 'Bearer secret'}).status_code == 200
+
+
+def test_unhandled_exceptions_are_counted(app, client, monkeypatch):
+	def fail():
+		raise RuntimeError('view failed')
+
+	monkeypatch.setitem(app.view_functions, 'rooms', fail)
+	monkeypatch.setitem(app.config, 'PROPAGATE_EXCEPTIONS', False)
+	before = metrics.requests_total.values.get(('rooms', 'GET', '500'), 0)
+	assert client.get('/rooms').status_code == 500
+	assert metrics.requests_total.values.get(('rooms', 'GET', '500'), 0) == before + 1
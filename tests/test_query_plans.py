@@ -0,0 +1,17 @@
+"""Every query of bench/query_plans.py is served by an index"""
+import pytest
+from app import app as flask_app, db
+from bench import query_plans
+
+with flask_app.app_context():
+	QUERIES = sorted(query_plans.route_queries())
+
+
+@pytest.mark.parametrize('name', QUERIES)
+def test_query_uses_index(app, name):
+	with app.app_context():
+		try:
+			plan = query_plans.explain(query_plans.route_queries()[name])
+		finally:
+			db.session.rollback()
+	assert not query_plans.problems(plan, name in query_plans.BOUNDED_SORTS), '\n'.join(plan)
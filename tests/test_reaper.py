@@ -0,0 +1,40 @@
+"""Sweeps of expired rooms"""
+import pytest
+from sqlalchemy import func, select
+import reaper
+
+
+def test_sweep_runs(app):
+	with app.app_context():
+		assert isinstance(reaper.sweep_unless_busy(), reaper.SweepResult)
+
+
+def test_sweep_is_skipped_while_another_process_sweeps(app):
+	from app import db  # pylint: disable=import-outside-toplevel
+	with app.app_context():
+		if db.engine.dialect.name != 'postgresql':
+			pytest.skip('advisory locks need PostgreSQL')
+		with db.engine.connect() as other:
+			assert other.scalar(select([func.pg_try_advisory_lock(reaper.REAPER_LOCK_KEY)]))
+			assert reaper.sweep_unless_busy() is None
+			other.scalar(select([func.pg_advisory_unlock(reaper.REAPER_LOCK_KEY)]))
+		assert reaper.sweep_unless_busy() is not None
+
+
+def test_lost_seed_jobs_fail_their_rooms(app):
+	from datetime import datetime, timedelta  # pylint: disable=import-outside-toplevel
+	from app import db  # pylint: disable=import-outside-toplevel
+	from database import Room, ROOM_FAILED, ROOM_PENDING  # pylint: disable=import-outside-toplevel
+	import seed_jobs  # pylint: disable=import-outside-toplevel
+	with app.app_context():
+		template = Room.query.first()
+		rooms = [Room(template.settings_id, None, template.creator_id, None, status=ROOM_PENDING) for _ in range(2)]
+		rooms[0].create_time -= timedelta(seconds=seed_jobs.SEED_JOB_TIMEOUT + 1)
+		db.session.add_all(rooms)
+		db.session.commit()
+		room_ids = [room.id for room in rooms]
+		reaper.sweep()
+		assert [Room.query.get(room_id).status for room_id in room_ids] == [ROOM_FAILED, ROOM_PENDING]
+		for room in rooms:
+			db.session.delete(room)
+		db.session.commit()
@@ -0,0 +1,97 @@
+"""Reads of read-only views on replicas, and back on the primary when one fails"""
+import shutil
+import pytest
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+import routing
+
+
+@pytest.fixture
+def statements(app):
+	"""Statements run on each engine, by engine name"""
+	from app import db  # pylint: disable=import-outside-toplevel
+	counts = []
+	with app.app_context():
+		engine = db.engine
+
+	def listener(*_):
+		counts.append('primary')
+
+	event.listen(engine, 'before_cursor_execute', listener)
+	yield counts
+	event.remove(engine, 'before_cursor_execute', listener)
+
+
+def use_replica(monkeypatch, url: str) -> routing.Replica:
+	replica = routing.Replica('replica0', url)
+	monkeypatch.setattr(routing, 'replicas', [replica])
+	return replica
+
+
+@pytest.fixture
+def lagging_replica(app, monkeypatch):
+	"""Copy of the SQLite test database as of now, a replica that does not see later writes"""
+	from app import db  # pylint: disable=import-outside-toplevel
+	with app.app_context():
+		url = make_url(str(db.engine.url))
+	if url.drivername != 'sqlite':
+		pytest.skip('copies the SQLite test database')
+	copy = f'{url.database}.replica'
+	shutil.copyfile(url.database, copy)
+	return use_replica(monkeypatch, f'sqlite:///{copy}')
+
+
+@pytest.mark.parametrize('path', ['/rooms', '/api/v1/rooms'])
+def test_failed_replica_reads_from_the_primary(client, statements, monkeypatch, path):
+	replica = use_replica(monkeypatch, 'sqlite:////nonexistent/replica.db')
+	assert client.get(path).status_code == 200
+	assert not replica.healthy
+	assert statements
+
+	# Left out until a check passes again
+	statements.clear()
+	assert client.get(path).status_code == 200
+	assert statements
+
+
+def test_reads_go_to_a_healthy_replica(client, lagging_replica, statements):
+	assert client.get('/api/v1/rooms').status_code == 200
+	assert lagging_replica.healthy
+	assert not statements
+
+
+def test_join_is_decided_on_the_primary(player, room, lagging_replica):
+	assert player.get(f'/room/{room}').status_code == 200
+	# The replica still misses the join, the player's next visit must not join twice
+	with player.session_transaction() as session:
+		session['_primary_until'] = 0
+	response = player.get(f'/room/{room}')
+	assert response.status_code == 200
+	assert 'tester' in response.get_data(as_text=True)
+	assert lagging_replica.healthy
+
+
+@pytest.fixture
+def new_room(app, lagging_replica):
+	"""Hash code of a room created on the primary after the replica was copied"""
+	from app import db  # pylint: disable=import-outside-toplevel
+	from database import Room  # pylint: disable=import-outside-toplevel
+	with app.app_context():
+		template = Room.query.first()
+		room = Room(template.settings_id, None, template.creator_id, 'lagging0001')
+		db.session.add(room)
+		db.session.commit()
+		yield room.hash_code
+		db.session.delete(room)
+		db.session.commit()
+
+
+@pytest.mark.parametrize('path', ['/api/v1/rooms/{}', '/api/v1/rooms/{}/times'])
+def test_missing_room_is_read_from_the_primary(client, new_room, path):
+	assert client.get(path.format(new_room)).status_code == 200
+
+
+def test_missing_room_page_is_read_from_the_primary(player, new_room):
+	response = player.get(f'/room/{new_room}')
+	assert response.status_code == 200
+	assert 'Room does not exist.' not in response.get_data(as_text=True)
@@ -0,0 +1,57 @@
+"""Streaming parse of seed responses"""
+import json
+import pytest
+from alttpr_api import parse_seed
+
+SEED = {
+	'logic': 'v31',
+	'patch': [{'1234': [1, 2, 3]}, {'5678': [255, 0]}],
+	'spoiler': {'meta': {'build': '2019-03-01', 'name': None}, 'Light World': {'Link\'s House': 'Lamp'}},
+	'hash': 'zYxWvUtSr1',
+	'generated': '2019-03-20T12:00:00+00:00'
+}
+
+EXPECTED = {'hash': 'zYxWvUtSr1', 'generated': '2019-03-20T12:00:00+00:00', 'spoiler': {'meta': {'build': '2019-03-01', 'name': None}}}
+
+
+def chunks_of(text: str, size: int) -> list:
+	return [text[start:start + size] for start in range(0, len(text), size)]
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 64, 100000])
+def test_kept_fields_across_chunk_sizes(size):
+	assert parse_seed(chunks_of(json.dumps(SEED), size)) == EXPECTED
+
+
+def test_key_split_across_chunks():
+	text = json.dumps(SEED)
+	split = text.index('"hash"') + 3
+	assert parse_seed([text[:split], text[split:]]) == EXPECTED
+
+
+def test_empty_object():
+	assert parse_seed(['{', ' }']) == {}
+
+
+@pytest.mark.parametrize('chunks', [[], [''], ['', '']])
+def test_empty_body(chunks):
+	with pytest.raises(ValueError):
+		parse_seed(chunks)
+
+
+@pytest.mark.parametrize('cut', [1, 9, 12, 40, -1])
+def test_truncated_body(cut):
+	text = json.dumps(SEED)
+	with pytest.raises(ValueError):
+		parse_seed(chunks_of(text[:cut], 5))
+
+
+def test_truncated_after_value():
+	with pytest.raises(ValueError):
+		parse_seed(['{"hash": "x"'])
+
+
+@pytest.mark.parametrize('text', ['[]', '{"hash" "x"}', '{"hash": "x" "generated": 1}', '{hash: 1}'])
+def test_malformed_body(text):
+	with pytest.raises(ValueError):
+		parse_seed([text])
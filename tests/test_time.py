@@ -0,0 +1,38 @@
+"""Posting a finish time"""
+import pytest
+import validation
+
+
+@pytest.mark.parametrize('hours, minutes, seconds, valid', [
+	('1', '30', '05', True),
+	('0', '0', '1', True),
+	('0', '0', '0', False),
+	('-1', '30', '0', False),
+	('1', '-5', '0', False),
+	('a', '30', '0', False),
+	('1', '60', '0', False),
+	('1', '30', '60', False),
+	('', '30', '0', False),
+	('1', '30', None, False),
+])
+def test_validate_time(hours, minutes, seconds, valid):
+	assert validation.validate_time(hours, minutes, seconds)[0] is valid
+
+
+@pytest.mark.parametrize('form', [
+	{'hours': '0', 'minutes': '0', 'seconds': '0'},
+	{'hours': '-1', 'minutes': '0', 'seconds': '0'},
+	{'hours': 'one', 'minutes': '0', 'seconds': '0'},
+	{'hours': '1', 'minutes': '0'},
+])
+def test_bad_time_is_rejected(app, player, room, csrf_token, form):
+	from database import Rating, Result, RoomPlayer, Room  # pylint: disable=import-outside-toplevel
+	assert player.get(f'/room/{room}').status_code == 200
+	response = player.post(f'/time/{room}', data=dict(form, _csrf_token=csrf_token(player)))
+	assert response.status_code == 302
+	with app.app_context():
+		room_id = Room.query.filter_by(hash_code=room).first().id
+		player_id = RoomPlayer.query.filter_by(room_id=room_id).order_by(RoomPlayer.player_id.desc()).first().player_id
+		assert RoomPlayer.query.get((room_id, player_id)).time is None
+		assert Result.query.filter_by(room_id=room_id, player_id=player_id).count() == 0
+		assert Rating.query.filter_by(player_id=player_id).count() == 0
@@ -43,11 +43,13 @@ def validate_time(hours: str, minutes: str, seconds: str) -> (bool, str):
 		return False, 'Missing minutes.'
 	if not seconds:
 		return False, 'Missing seconds.'
-	if hours.isdigit() and minutes.isdigit() and seconds.isdigit():
+	if not (hours.isdigit() and minutes.isdigit() and seconds.isdigit()):
 		return False, 'Values must be numeric.'
 	hours, minutes, seconds = int(hours), int(minutes), int(seconds)
 	if hours < 0:
 		return False, 'Hours must be larger than or equal to 0.'
+	if hours == minutes == seconds == 0:
+		return False, 'Time must be larger than 0.'
 	if minutes < 0 or minutes > 59:
 		return False, 'Minutes must be between 0 and 59.'
 	if seconds < 0 or seconds > 59: